@@ -0,0 +1,38 @@
+"""Save timings as a baseline, and compare timings to one."""
+
+import json
+import pathlib
+import sys
+
+import click
+
+
+def report(
+    timings: dict[str, float],
+    save=None,
+    compare=None,
+    threshold=0.25,
+    scale=1000,
+    unit="ms",
+):
+    """Print the timings, in seconds shown as `unit`, and their change from the baseline in `compare`.
+
+    Exits with 1 if a timing is more than `threshold` slower than its baseline.
+    """
+    baseline = json.loads(pathlib.Path(compare).read_text()) if compare else {}
+    width = max(map(len, timings), default=0) + 2
+    regressions = []
+    for name, seconds in timings.items():
+        line = f"{name:<{width}} {seconds * scale:10.2f}{unit}"
+        if name in baseline:
+            change = seconds / baseline[name] - 1
+            line += f" {change:+7.1%}"
+            if change > threshold:
+                regressions.append(name)
+                line += " REGRESSION"
+        click.echo(line)
+    if save:
+        pathlib.Path(save).write_text(json.dumps(timings, indent=2) + "\n")
+    if regressions:
+        click.secho(f"Slower than the baseline: {', '.join(regressions)}", fg="red")
+        sys.exit(1)
@@ -0,0 +1,167 @@
+"""Peak memory of the prep stages that grow with the study, against budgets per million resources.
+
+Each stage is run on a synthetic study (`fa_submit synth`) under tracemalloc, `prep` in a
+fresh process whose peak RSS is read from its --metrics.  A stage fails when its peak is
+over its budget, a fixed base plus an allowance per million resources.
+
+    python benchmarks/memory.py --resources 1000000
+    python benchmarks/memory.py --resources 100000 assay vocabulary
+"""
+
+import gc
+import json
+import pathlib
+import subprocess
+import sys
+import tempfile
+import tracemalloc
+from typing import Callable
+
+import click
+import orjson
+
+from fhir_aggregator_submission import prep
+from fhir_aggregator_submission.references import ReferenceIndex
+from fhir_aggregator_submission.synth import Cardinalities, Study
+from fhir_aggregator_submission.vocabulary import VocabularyCollector
+
+MB = 1024 * 1024
+
+# stage: (base MB, MB per million resources), about 1.3x their peaks at 20k, 200k and 1M resources.
+# The assay and reference indexes spill to disk past their memory budget, so their peaks level
+# off for larger studies.
+BUDGETS = {
+    "read": (24, 4),
+    "assay": (16, 80),
+    "validate_references": (16, 140),
+    "vocabulary": (24, 8),
+    "prep": (120, 200),
+}
+
+
+def read_ndjson(meta: pathlib.Path):
+    for path in sorted(meta.glob("*.ndjson")):
+        yield from prep.read_ndjson(path)
+
+
+def read(meta: pathlib.Path):
+    """Parsing the input files, their line offsets are found a chunk of the file at a time."""
+    for _ in read_ndjson(meta):
+        pass
+
+
+def assay(meta: pathlib.Path):
+    """create_assays, its specimen and group indexes."""
+    for _ in prep.create_assays("R4", meta):
+        pass
+
+
+def validate_references(meta: pathlib.Path):
+    """The ids and references collected by validate, and their check."""
+    index = ReferenceIndex()
+    try:
+        for resource in read_ndjson(meta):
+            index.add_resource(resource)
+        assert not len(index.dangling())
+    finally:
+        index.close()
+
+
+def vocabulary(meta: pathlib.Path):
+    """The vocabulary dictionaries, and the Observations made from them."""
+    collector = VocabularyCollector()
+    for resource in read_ndjson(meta):
+        collector.collect(resource)
+    collector.to_observations()
+
+
+STAGES: dict[str, Callable[[pathlib.Path], None]] = {
+    "read": read,
+    "assay": assay,
+    "validate_references": validate_references,
+    "vocabulary": vocabulary,
+}
+
+
+def traced_peak(stage: Callable[[pathlib.Path], None], meta: pathlib.Path) -> int:
+    """The peak bytes allocated by Python (and numpy) while running the stage."""
+    gc.collect()
+    tracemalloc.start()
+    try:
+        stage(meta)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def prep_peak(meta: pathlib.Path) -> int:
+    """The peak RSS of a default prep of the study, in a fresh process."""
+    with tempfile.TemporaryDirectory() as directory:
+        metrics_path = pathlib.Path(directory) / "metrics.json"
+        subprocess.run(
+            [
+                sys.executable,
+                "-c",
+                "from fhir_aggregator_submission.prep import cli; cli()",
+                "prep",
+                str(meta),
+                str(pathlib.Path(directory) / "output"),
+                "--metrics",
+                str(metrics_path),
+            ],
+            check=True,
+            capture_output=True,
+        )
+        return orjson.loads(metrics_path.read_bytes())["peak_rss_bytes"]
+
+
+@click.command()
+@click.argument("stages", nargs=-1, type=click.Choice([*BUDGETS]))
+@click.option(
+    "--resources",
+    default=100_000,
+    show_default=True,
+    type=click.IntRange(min=1),
+    help="Size of the synthetic study",
+)
+@click.option(
+    "--budgets",
+    type=click.Path(exists=True),
+    help="JSON file of {stage: [base MB, MB per million resources]} to use instead of the defaults",
+)
+def main(stages, resources, budgets):
+    """Check the peak memory of each of STAGES, default all, against its budget."""
+    limits = {
+        **BUDGETS,
+        **(json.loads(pathlib.Path(budgets).read_text()) if budgets else {}),
+    }
+    over = []
+    with tempfile.TemporaryDirectory() as directory:
+        meta = pathlib.Path(directory) / "META"
+        cardinalities = Cardinalities()
+        study = Study("MEMORY", cardinalities.patients(resources), cardinalities)
+        study.write(meta)
+        count = sum(study.counts().values())
+        millions = count / 1_000_000
+        for stage in stages or BUDGETS:
+            if stage == "prep":
+                peak = prep_peak(meta)
+            else:
+                peak = traced_peak(STAGES[stage], meta)
+            base, per_million = limits[stage]
+            budget = (base + per_million * millions) * MB
+            line = f"{stage:<20} {peak / MB:8.1f}MB of {budget / MB:8.1f}MB  ({peak / MB / millions:8.1f}MB per million resources)"
+            if peak > budget:
+                over.append(stage)
+                line += " OVER BUDGET"
+            click.echo(line)
+    if over:
+        click.secho(
+            f"Over their memory budget at {count:,} resources: {', '.join(over)}",
+            fg="red",
+        )
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,261 @@
+"""Microbenchmarks of the transformers and collectors, on the resources of a small synthetic study.
+
+Each benchmark is timed per resource, the best of --repeat rounds.
+
+    python benchmarks/micro.py --save micro-baseline.json
+    python benchmarks/micro.py --compare micro-baseline.json
+    python benchmarks/micro.py --compare micro-baseline.json validate
+"""
+
+import copy
+import math
+import pathlib
+import tempfile
+import time
+from typing import Callable
+
+import click
+import orjson
+
+from baseline import report
+from fhir_aggregator_submission import find_key_with_path
+from fhir_aggregator_submission import models
+from fhir_aggregator_submission import prep
+from fhir_aggregator_submission.codings import find_codings
+from fhir_aggregator_submission.synth import Cardinalities, Study
+from fhir_aggregator_submission.transform import R4_TRANSFORMERS
+from fhir_aggregator_submission.vocabulary import (
+    extract_coding_values,
+    extract_extension_values,
+    tree,
+)
+
+# Each round of a benchmark runs for at least this long, like timeit's autorange.
+MIN_SECONDS = 0.05
+
+# The synthetic study the benchmarks run on, a few resources of each type.
+STUDY = Study(
+    "benchmark-study",
+    2,
+    Cardinalities(
+        specimens_per_patient=2, documents_per_specimen=1, observations_per_patient=2
+    ),
+)
+
+# R5 resources of the types the study doesn't have, for their transform_* function.
+SAMPLES: dict[str, dict] = {
+    "BodyStructure": {
+        "resourceType": "BodyStructure",
+        "id": "b1",
+        "includedStructure": [{"structure": {"text": "Lung"}}],
+        "patient": {"reference": "Patient/p1"},
+    },
+    "Encounter": {
+        "resourceType": "Encounter",
+        "id": "e1",
+        "status": "completed",
+        "class": [{"coding": [{"code": "AMB", "display": "ambulatory"}]}],
+        "subject": {"reference": "Patient/p1"},
+    },
+    "ImagingStudy": {
+        "resourceType": "ImagingStudy",
+        "id": "i1",
+        "status": "available",
+        "basedOn": [{"reference": "ServiceRequest/s1"}],
+        "series": [
+            {
+                "uid": "1.2.3",
+                "modality": {
+                    "coding": [{"system": "http://dicom.nema.org", "code": "CT"}]
+                },
+            }
+        ],
+    },
+    "Medication": {
+        "resourceType": "Medication",
+        "id": "m1",
+        "code": {"coding": [{"system": "http://rxnorm", "code": "1"}]},
+    },
+    "MedicationAdministration": {
+        "resourceType": "MedicationAdministration",
+        "id": "ma1",
+        "status": "completed",
+        "medication": {
+            "concept": {"coding": [{"system": "http://rxnorm", "code": "1"}]}
+        },
+        "occurenceDateTime": "2020-01-01",
+        "category": [{"text": "inpatient"}],
+        "subject": {"reference": "Patient/p1"},
+    },
+    "ResearchSubject": {
+        "resourceType": "ResearchSubject",
+        "id": "rs1",
+        "status": "active",
+        "study": {"reference": "ResearchStudy/s1"},
+        "subject": {"reference": "Patient/p1"},
+    },
+}
+
+
+def load_resources() -> dict[str, list[dict]]:
+    """The study's resources and the samples, per resourceType."""
+    resources = {_: list(STUDY.resources(_)) for _ in STUDY.counts()}
+    for resource_type, sample in SAMPLES.items():
+        resources.setdefault(resource_type, [sample])
+    return resources
+
+
+def without_part_of(resource: dict) -> dict:
+    """The resource as it is before part-of, without the part-of-study extension."""
+    extension = [
+        _ for _ in resource.get("extension", []) if "part-of-study" not in _["url"]
+    ]
+    return {**resource, "extension": extension}
+
+
+def benchmarks(
+    output_path: pathlib.Path,
+) -> dict[str, tuple[Callable, Callable[[], list[tuple]]]]:
+    """{name: (function, calls)}, calls returns the argument tuples of one round, fresh copies as functions change them."""
+    resources = load_resources()
+    all_resources = [_ for type_resources in resources.values() for _ in type_resources]
+    study_id = STUDY.study_id
+
+    def each(items: list[dict], *args) -> Callable[[], list[tuple]]:
+        # parsing is faster than copy.deepcopy
+        data = orjson.dumps(items)
+        return lambda: [(_, *args) for _ in orjson.loads(data)]
+
+    def serialized(items: list[dict]) -> Callable[[], list[tuple]]:
+        lines = [(orjson.dumps(_),) for _ in items]
+        return lambda: lines
+
+    def counted(items: list[dict]) -> Callable[[], list[tuple]]:
+        # the counts of a round go to one dictionary, as when collecting a unit
+        def calls():
+            dictionary = tree()
+            return [(_, dictionary) for _ in items]
+
+        return calls
+
+    selected: dict[str, tuple[Callable, Callable[[], list[tuple]]]] = {
+        "apply_part_of": (
+            prep.apply_part_of,
+            each([without_part_of(_) for _ in all_resources], study_id),
+        ),
+        "reseed": (prep.reseed, each(all_resources, "benchmark")),
+    }
+    for fhir_version in ["R4", "R5"]:
+        for resource_type, type_resources in resources.items():
+            if fhir_version == "R4" and resource_type in R4_TRANSFORMERS:
+                # validated after the r4 transformer
+                type_resources = [
+                    R4_TRANSFORMERS[resource_type](_)
+                    for _ in copy.deepcopy(type_resources)
+                ]
+                type_resources = [_ for _ in type_resources if _]
+            if resource_type in SAMPLES or not type_resources:
+                continue
+            selected[f"validate {fhir_version} {resource_type}"] = (
+                prep.validate,
+                each(type_resources, fhir_version),
+            )
+            # the model on its own, from the dict validate is given or from its JSON line
+            klass = models.model_class(fhir_version, resource_type)
+            selected[f"model_validate {fhir_version} {resource_type}"] = (
+                klass.model_validate,
+                each(type_resources),
+            )
+            selected[f"model_validate_json {fhir_version} {resource_type}"] = (
+                klass.model_validate_json,
+                serialized(type_resources),
+            )
+    for resource_type, transformer in R4_TRANSFORMERS.items():
+        selected[transformer.__name__] = (transformer, each(resources[resource_type]))
+    selected["find_key_with_path"] = (
+        find_key_with_path,
+        each(all_resources, "coding", ["extension"]),
+    )
+    selected["find_codings"] = (find_codings, each(all_resources, "R4"))
+    selected["extract_coding_values"] = (
+        extract_coding_values,
+        counted(all_resources),
+    )
+    selected["extract_extension_values"] = (
+        extract_extension_values,
+        counted(all_resources),
+    )
+    documents = resources["DocumentReference"]
+    selected["create_assay_refactor_docs"] = (
+        prep.create_assay_refactor_docs,
+        lambda: [
+            (
+                f"assay-{_['id']}",
+                "Patient/p1",
+                ["Specimen/s1", "Specimen/s2"],
+                [_],
+                study_id,
+                "R4",
+            )
+            for _ in orjson.loads(orjson.dumps(documents))
+        ],
+    )
+    selected["update_mime_type"] = (prep.update_mime_type, each(documents))
+    emitters = prep.Emitters(output_path)
+    selected["Emitters.emit"] = (emitters.emit, each(all_resources))
+    return selected
+
+
+def measure(function: Callable, calls: Callable[[], list[tuple]], repeat: int) -> float:
+    """Seconds per call of function, the best of `repeat` rounds of at least MIN_SECONDS."""
+    best = float("inf")
+    rounds = 1
+    for _ in range(repeat + 1):
+        arguments = [args for _ in range(rounds) for args in calls()]
+        start = time.perf_counter()
+        for args in arguments:
+            function(*args)
+        elapsed = time.perf_counter() - start
+        # validate collects the ids and references it sees
+        prep.reset_collectors()
+        if rounds == 1 and elapsed < MIN_SECONDS:
+            # a warm up round, its time sets the rounds to repeat
+            rounds = math.ceil(MIN_SECONDS / max(elapsed, 1e-6))
+            continue
+        best = min(best, elapsed / len(arguments))
+    return best
+
+
+@click.command()
+@click.argument("patterns", nargs=-1)
+@click.option("--repeat", default=5, show_default=True, help="Rounds of each benchmark")
+@click.option("--save", type=click.Path(), help="Write the timings to this file")
+@click.option(
+    "--compare",
+    type=click.Path(exists=True),
+    help="Compare to the timings in this file",
+)
+@click.option(
+    "--threshold",
+    default=0.25,
+    show_default=True,
+    help="With --compare, fail if a timing is this fraction slower than the baseline",
+)
+def main(patterns, repeat, save, compare, threshold):
+    """Time the transformers and collectors per resource, in microseconds.
+
+    PATTERNS only run the benchmarks whose name contains one of them.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        output_path = pathlib.Path(directory) / "output"
+        output_path.mkdir()
+        timings = {}
+        for name, (function, calls) in benchmarks(output_path).items():
+            if patterns and not any(_ in name for _ in patterns):
+                continue
+            timings[name] = measure(function, calls, repeat)
+    report(timings, save, compare, threshold, scale=1_000_000, unit="µs")
+
+
+if __name__ == "__main__":
+    main()
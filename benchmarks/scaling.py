@@ -0,0 +1,268 @@
+"""End to end benchmark of prep on synthetic studies of growing size.
+
+Each size is generated once with `fa_submit synth` (and kept in OUTPUT/data for the next run),
+then prepped with each transformer combination and worker count.  The wall time, resources
+per second and peak RSS of each run are written to OUTPUT/scaling.csv, a table to
+OUTPUT/scaling.md and the resources per second by size to OUTPUT/scaling.svg.
+
+    python benchmarks/scaling.py --sizes 10000,100000,1000000 --workers 1,8
+    python benchmarks/scaling.py --sizes 10000 --transformers part-of,validate
+"""
+
+import csv
+import math
+import os
+import pathlib
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import click
+import orjson
+
+from fhir_aggregator_submission.synth import Cardinalities, Study
+
+CLI = "from fhir_aggregator_submission.prep import cli; cli()"
+
+TRANSFORMERS = ["assay,r4,part-of,vocabulary,validate", "part-of,validate", "reseed"]
+
+COLUMNS = [
+    "resources",
+    "transformers",
+    "workers",
+    "exit_code",
+    "wall_seconds",
+    "cpu_seconds",
+    "resources_per_second",
+    "peak_rss_mb",
+    "peak_rss_workers_mb",
+    "input_mb",
+]
+
+# the chart's colours, one per transformers and workers combination
+COLOURS = ["#1f77b4", "#ff7f0e", "#2ca02c", "#d62728", "#9467bd", "#8c564b"]
+
+
+def generate(
+    data_path: pathlib.Path, resources: int, seed: int
+) -> tuple[pathlib.Path, int]:
+    """The META directory of a synthetic study of about `resources` resources, generated if it isn't there yet, and its resource count."""
+    meta = data_path / f"{resources}-{seed}" / "META"
+    done = meta / ".complete"
+    cardinalities = Cardinalities()
+    study = Study("SCALING", cardinalities.patients(resources), cardinalities, seed)
+    if not done.exists():
+        shutil.rmtree(meta, ignore_errors=True)
+        click.echo(f"Generating {resources:,} resources in {meta}", err=True)
+        study.write(meta)
+        done.touch()
+    return meta, sum(study.counts().values())
+
+
+def run_prep(meta: pathlib.Path, transformers: str, workers: int) -> dict:
+    """Prep the study in a fresh process, and return its row of the results."""
+    with tempfile.TemporaryDirectory() as directory:
+        metrics_path = pathlib.Path(directory) / "metrics.json"
+        args = [
+            sys.executable,
+            "-c",
+            CLI,
+            "prep",
+            str(meta),
+            str(pathlib.Path(directory) / "output"),
+            "--transformers",
+            transformers,
+            "--workers",
+            str(workers),
+            "--metrics",
+            str(metrics_path),
+        ]
+        if "reseed" in transformers:
+            args += ["--seed", "scaling"]
+        # validated resources are not cached between runs, nor in the user's cache
+        env = {**os.environ, "FHIR_AGGREGATOR_CACHE": directory}
+        start = time.perf_counter()
+        process = subprocess.run(args, capture_output=True, env=env)
+        wall = time.perf_counter() - start
+        metrics = (
+            orjson.loads(metrics_path.read_bytes()) if metrics_path.exists() else {}
+        )
+    resources = metrics.get("resources_read", 0)
+    mb = 1024 * 1024
+    return {
+        "transformers": transformers,
+        "workers": workers,
+        "exit_code": process.returncode,
+        # from starting the interpreter to exiting
+        "wall_seconds": round(wall, 3),
+        "cpu_seconds": round(metrics.get("cpu_seconds", 0), 3),
+        "resources_per_second": round(resources / wall),
+        "peak_rss_mb": round(metrics.get("peak_rss_bytes", 0) / mb, 1),
+        "peak_rss_workers_mb": round(metrics.get("peak_rss_children_bytes", 0) / mb, 1),
+        "stderr": process.stderr.decode(errors="replace"),
+    }
+
+
+def to_markdown(rows: list[dict]) -> str:
+    lines = ["| " + " | ".join(COLUMNS) + " |", "|" + "---|" * len(COLUMNS)]
+    for row in rows:
+        lines.append(
+            "| "
+            + " | ".join(
+                f"{row[_]:,}" if isinstance(row[_], int) else str(row[_])
+                for _ in COLUMNS
+            )
+            + " |"
+        )
+    return "\n".join(lines) + "\n"
+
+
+def to_svg(rows: list[dict], width=720, height=420, margin=60) -> str:
+    """A log-log chart of resources per second by study size, a line per transformers and workers."""
+    rows = [_ for _ in rows if _["exit_code"] == 0 and _["resources_per_second"]]
+    if not rows:
+        return f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}"/>\n'
+    xs = [math.log10(_["resources"]) for _ in rows]
+    ys = [math.log10(_["resources_per_second"]) for _ in rows]
+    x_range = (math.floor(min(xs)), math.ceil(max(xs)) + (min(xs) == max(xs)))
+    y_range = (math.floor(min(ys)), math.ceil(max(ys)) + (min(ys) == max(ys)))
+
+    def x(value):
+        return margin + (math.log10(value) - x_range[0]) / (x_range[1] - x_range[0]) * (
+            width - 2 * margin
+        )
+
+    def y(value):
+        return (
+            height
+            - margin
+            - (math.log10(value) - y_range[0])
+            / (y_range[1] - y_range[0])
+            * (height - 2 * margin)
+        )
+
+    svg = [
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}" font-family="sans-serif" font-size="12">',
+        f'<rect width="{width}" height="{height}" fill="white"/>',
+        f'<text x="{width / 2}" y="{height - 15}" text-anchor="middle">resources</text>',
+        f'<text x="15" y="{height / 2}" text-anchor="middle" transform="rotate(-90 15 {height / 2})">resources per second</text>',
+    ]
+    for power in range(x_range[0], x_range[1] + 1):
+        position = x(10**power)
+        svg.append(
+            f'<line x1="{position:.1f}" y1="{margin}" x2="{position:.1f}" y2="{height - margin}" stroke="#ddd"/>'
+        )
+        svg.append(
+            f'<text x="{position:.1f}" y="{height - margin + 15}" text-anchor="middle">1e{power}</text>'
+        )
+    for power in range(y_range[0], y_range[1] + 1):
+        position = y(10**power)
+        svg.append(
+            f'<line x1="{margin}" y1="{position:.1f}" x2="{width - margin}" y2="{position:.1f}" stroke="#ddd"/>'
+        )
+        svg.append(
+            f'<text x="{margin - 5}" y="{position + 4:.1f}" text-anchor="end">1e{power}</text>'
+        )
+    series: dict[str, list[dict]] = {}
+    for row in rows:
+        series.setdefault(f"{row['transformers']} workers={row['workers']}", []).append(
+            row
+        )
+    for number, (label, points) in enumerate(series.items()):
+        colour = COLOURS[number % len(COLOURS)]
+        points = sorted(points, key=lambda _: _["resources"])
+        coordinates = " ".join(
+            f"{x(_['resources']):.1f},{y(_['resources_per_second']):.1f}"
+            for _ in points
+        )
+        svg.append(
+            f'<polyline points="{coordinates}" fill="none" stroke="{colour}" stroke-width="2"/>'
+        )
+        for point in points:
+            svg.append(
+                f'<circle cx="{x(point["resources"]):.1f}" cy="{y(point["resources_per_second"]):.1f}" r="3" fill="{colour}"/>'
+            )
+        svg.append(
+            f'<text x="{margin + 10}" y="{margin + 15 * (number + 1)}" fill="{colour}">{label}</text>'
+        )
+    svg.append("</svg>")
+    return "\n".join(svg) + "\n"
+
+
+def integers(ctx, param, value: str) -> list[int]:
+    try:
+        return [int(_) for _ in value.split(",")]
+    except ValueError:
+        raise click.BadParameter(
+            f"{value} is not a list of integers, e.g. 10000,100000"
+        )
+
+
+@click.command()
+@click.option(
+    "--sizes",
+    default="10000,100000",
+    show_default=True,
+    callback=integers,
+    help="CSV resources per study, e.g. 10000,100000,1000000,10000000",
+)
+@click.option(
+    "--transformers",
+    multiple=True,
+    default=TRANSFORMERS,
+    show_default=True,
+    help="Transformer combinations, repeatable",
+)
+@click.option(
+    "--workers",
+    default="1",
+    show_default=True,
+    callback=integers,
+    help="CSV worker counts, e.g. 1,4,16",
+)
+@click.option(
+    "--output",
+    default="scaling-results",
+    show_default=True,
+    type=click.Path(file_okay=False),
+    help="Directory for the generated studies and the results",
+)
+@click.option("--seed", default=0, show_default=True, help="The synth seed")
+def main(sizes, transformers, workers, output, seed):
+    """Prep synthetic studies of each size with each transformer combination and worker count."""
+    output_path = pathlib.Path(output)
+    output_path.mkdir(parents=True, exist_ok=True)
+    rows = []
+    failed = False
+    for resources in sizes:
+        meta, count = generate(output_path / "data", resources, seed)
+        input_mb = sum(_.stat().st_size for _ in meta.glob("*.ndjson")) / 1024 / 1024
+        for combination in transformers:
+            for worker_count in workers:
+                row = run_prep(meta, combination, worker_count)
+                stderr = row.pop("stderr")
+                row.update(resources=count, input_mb=round(input_mb, 1))
+                rows.append(row)
+                click.echo(
+                    f"{resources:>12,} {combination:<40} workers={worker_count:<3} "
+                    f"{row['wall_seconds']:8.1f}s {row['resources_per_second']:>10,}/s "
+                    f"{row['peak_rss_mb']:8.1f}MB"
+                )
+                if row["exit_code"]:
+                    failed = True
+                    click.secho(stderr[-2000:], fg="red", err=True)
+    with open(output_path / "scaling.csv", "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=COLUMNS)
+        writer.writeheader()
+        writer.writerows(rows)
+    (output_path / "scaling.md").write_text(to_markdown(rows))
+    (output_path / "scaling.svg").write_text(to_svg(rows))
+    click.echo(f"Results in {output_path}/scaling.csv, .md and .svg", err=True)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""Measure how long fa_submit takes to start.
+
+`--help`, and a prep without validation on a tiny META directory, should not load the FHIR models.
+
+    python benchmarks/startup.py --save startup-baseline.json
+    python benchmarks/startup.py --compare startup-baseline.json
+"""
+
+import pathlib
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import click
+import orjson
+
+from baseline import report
+
+CLI = "from fhir_aggregator_submission.prep import cli; cli()"
+
+
+def tiny_meta(path: pathlib.Path):
+    """A META directory with a ResearchStudy and a few Patients that are part of it."""
+    path.mkdir()
+    study = {"resourceType": "ResearchStudy", "id": "startup", "status": "active"}
+    (path / "ResearchStudy.ndjson").write_bytes(orjson.dumps(study) + b"\n")
+    with open(path / "Patient.ndjson", "wb") as f:
+        for i in range(10):
+            f.write(orjson.dumps({"resourceType": "Patient", "id": f"p{i}"}) + b"\n")
+
+
+def timed(args: list[str], runs: int) -> float:
+    """The median wall time of running the command."""
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(args, check=True, capture_output=True)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def measure(runs: int) -> dict[str, float]:
+    """Seconds to start the CLI for each scenario."""
+    with tempfile.TemporaryDirectory() as directory:
+        meta = pathlib.Path(directory) / "META"
+        tiny_meta(meta)
+        output = str(pathlib.Path(directory) / "output")
+        prep = [sys.executable, "-c", CLI, "prep", str(meta), output]
+        return {
+            "import": timed(
+                [sys.executable, "-c", "import fhir_aggregator_submission.prep"], runs
+            ),
+            "help": timed([sys.executable, "-c", CLI, "--help"], runs),
+            "prep part-of": timed(prep + ["--transformers", "part-of"], runs),
+            "prep part-of,validate": timed(
+                prep + ["--transformers", "part-of,validate"], runs
+            ),
+        }
+
+
+@click.command()
+@click.option("--runs", default=5, show_default=True, help="Runs of each command")
+@click.option("--save", type=click.Path(), help="Write the timings to this file")
+@click.option(
+    "--compare",
+    type=click.Path(exists=True),
+    help="Compare to the timings in this file",
+)
+@click.option(
+    "--threshold",
+    default=0.25,
+    show_default=True,
+    help="With --compare, fail if a timing is this fraction slower than the baseline",
+)
+def main(runs, save, compare, threshold):
+    """Measure the startup time of fa_submit."""
+    report(measure(runs), save, compare, threshold)
+
+
+if __name__ == "__main__":
+    main()
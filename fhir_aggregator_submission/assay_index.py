@@ -0,0 +1,102 @@
+import os
+import sqlite3
+import tempfile
+
+# Default number of bytes an index may hold in memory before it spills to disk.
+DEFAULT_MEMORY_BUDGET = 256 * 1024 * 1024
+# Rough per-entry cost of a python dict item holding two small strings.
+ENTRY_OVERHEAD = 160
+
+
+class SpillingIndex:
+    """A str -> str|bytes mapping kept in memory until it exceeds its budget, then moved to sqlite.
+
+    Used by `create_assays` to look up specimen -> patient and group -> specimen references
+    without holding whole resources in memory.
+    """
+
+    def __init__(self, memory_budget: int = DEFAULT_MEMORY_BUDGET, directory=None):
+        """Initialize the index, spill files are created in `directory` (default: system temp)."""
+        self._memory_budget = memory_budget
+        self._directory = directory
+        self._items: dict[str, str | bytes] = {}
+        self._bytes = 0
+        self._length = 0
+        self._db: sqlite3.Connection | None = None
+        self._db_path: str | None = None
+
+    @property
+    def spilled(self) -> bool:
+        """True if the index has moved to disk."""
+        return self._db is not None
+
+    def __setitem__(self, key: str, value: str | bytes):
+        if self._db is None:
+            if key not in self._items:
+                self._length += 1
+                self._bytes += len(key) + len(value) + ENTRY_OVERHEAD
+            self._items[key] = value
+            if self._bytes > self._memory_budget:
+                self._spill()
+            return
+        if key not in self:
+            self._length += 1
+        self._db.execute("INSERT OR REPLACE INTO items VALUES (?, ?)", (key, value))
+
+    def __getitem__(self, key: str) -> str | bytes:
+        if self._db is None:
+            return self._items[key]
+        row = self._db.execute(
+            "SELECT value FROM items WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return row[0]
+
+    def get(self, key: str, default=None):
+        """Return the value for key if key is in the index, else default."""
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key) -> bool:
+        if self._db is None:
+            return key in self._items
+        return (
+            self._db.execute("SELECT 1 FROM items WHERE key = ?", (key,)).fetchone()
+            is not None
+        )
+
+    def __len__(self) -> int:
+        return self._length
+
+    def _spill(self):
+        """Move the in memory items to a sqlite database."""
+        fd, self._db_path = tempfile.mkstemp(
+            prefix="assay-index-", suffix=".sqlite", dir=self._directory
+        )
+        os.close(fd)
+        self._db = sqlite3.connect(self._db_path)
+        self._db.execute("PRAGMA journal_mode = OFF")
+        self._db.execute("PRAGMA synchronous = OFF")
+        self._db.execute("CREATE TABLE items (key TEXT PRIMARY KEY, value)")
+        self._db.executemany("INSERT INTO items VALUES (?, ?)", self._items.items())
+        self._items = {}
+        self._bytes = 0
+
+    def close(self):
+        """Release the memory and remove any spill file."""
+        self._items = {}
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+        if self._db_path:
+            os.remove(self._db_path)
+            self._db_path = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
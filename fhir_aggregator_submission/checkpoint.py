@@ -0,0 +1,343 @@
+import os
+import pathlib
+import shutil
+import time
+from typing import Any
+
+import numpy as np
+import orjson
+
+from fhir_aggregator_submission.errors import ErrorReport
+from fhir_aggregator_submission.incremental import (
+    Unit,
+    UnitSummary,
+    dump_summary,
+    load_summary,
+    load_vocabulary,
+)
+from fhir_aggregator_submission.outputs import output_parts, output_size
+from fhir_aggregator_submission.references import (
+    ID_DTYPE,
+    REFERENCE_DTYPE,
+    ReferenceIndex,
+)
+from fhir_aggregator_submission.vocabulary import VocabularyCollector
+
+CHECKPOINT_NAME = "prep-checkpoint.json"
+CHECKPOINT_DIR = ".prep-checkpoint"
+# Seconds between checkpoints for a --resume run without --checkpoint-interval, checkpoints are
+# off by default.
+DEFAULT_INTERVAL = 300
+LOGS = {"ids": ID_DTYPE, "references": REFERENCE_DTYPE}
+
+
+class CheckpointError(Exception):
+    """The checkpoint can't be used to resume this run."""
+
+
+def input_stats(input_path) -> dict[str, list[int]]:
+    """Size and mtime of each input file, a run can only be resumed if they are unchanged."""
+    stats = {}
+    for path in sorted(pathlib.Path(input_path).glob("*.ndjson")):
+        stat = path.stat()
+        stats[path.name] = [stat.st_size, stat.st_mtime_ns]
+    return stats
+
+
+def write_durably(path: pathlib.Path, data: bytes):
+    """Replace the file at path with data, the file is either the old or the new version after a crash."""
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class Checkpoint:
+    """Periodically save the progress of a prep run, so `prep --resume` can continue it.
+
+    The checkpoint (OUTPUT_PATH/prep-checkpoint.json) records the units already completed, the
+    byte offset reached in the input file being processed, the size of each output file and the
+    vocabulary counts.  Id and reference hashes are appended to logs in
+    OUTPUT_PATH/.prep-checkpoint, so a checkpoint only writes what was collected since the
+    previous one.  On resume the output
+    files and logs are truncated to the recorded sizes and the input is read from the offset, so
+    the result is the same as an uninterrupted run.
+
+    With several workers, completed shards are kept in OUTPUT_PATH/.prep-checkpoint/shards and
+    only the missing ones are processed on resume.
+    """
+
+    def __init__(
+        self,
+        output_path,
+        settings: dict[str, Any],
+        inputs: dict[str, list[int]],
+        index: ReferenceIndex,
+        interval: float = DEFAULT_INTERVAL,
+    ):
+        """Initialize the checkpoint, `index` holds the ids and references of the run."""
+        self.output_path = pathlib.Path(output_path)
+        self.path = self.output_path / CHECKPOINT_NAME
+        self.directory = self.output_path / CHECKPOINT_DIR
+        self.settings = settings
+        self.inputs = inputs
+        self.index = index
+        self.interval = interval
+        self.enabled = interval > 0
+        self.completed: list[str] = []
+        self.emitted: list[str] = []
+        self.shards: dict | None = None
+        self.emitters: Any = None
+        self.manifest: Any = None
+        # the run's vocabulary and errors, up to the last completed unit
+        self._vocabulary = VocabularyCollector()
+        self._errors = ErrorReport()
+        # the unit in progress and the state after its last completed resource
+        self._unit: dict | None = None
+        self._reader: Any = None
+        self._mark: tuple | None = None
+        self._partial: UnitSummary | None = None
+        # entries written to the logs
+        self._logged = {name: 0 for name in LOGS}
+        self._saved = time.monotonic()
+
+    def start(self, emitters, manifest):
+        """Begin a new run, removing any previous checkpoint."""
+        self.emitters, self.manifest = emitters, manifest
+        self.remove()
+        if self.enabled:
+            self.directory.mkdir(parents=True)
+            self.save()
+
+    def resume(self, emitters) -> dict:
+        """Load the checkpoint and truncate the outputs and logs to it, returns the saved state.
+
+        The ids and references of completed units are restored, those of the unit in progress
+        are returned by `partial`.  Set `manifest` once it is restored from the state.
+        """
+        self.emitters = emitters
+        if not self.path.exists():
+            raise CheckpointError(f"No checkpoint to resume in {self.output_path}")
+        state = orjson.loads(self.path.read_bytes())
+        if state["settings"] != self.settings:
+            raise CheckpointError(
+                "The checkpoint was written with different options, run without --resume"
+            )
+        if state["inputs"] != self.inputs:
+            raise CheckpointError(
+                "Input files changed since the checkpoint, run without --resume"
+            )
+        for resource_type, size in state["sizes"].items():
+            paths = output_parts(self.output_path, resource_type)
+            if not paths or output_size(self.output_path, resource_type) < size:
+                raise CheckpointError(
+                    f"{resource_type} output is missing or shorter than checkpointed"
+                )
+            emitters.adopt(resource_type, paths, size)
+
+        logs: dict[str, np.ndarray] = {}
+        for name, dtype in LOGS.items():
+            path = self.directory / f"{name}.log"
+            with open(path, "a+b") as log:
+                log.truncate(state["logs"][name] * dtype.itemsize)
+            logs[name] = np.fromfile(path, dtype=dtype)
+            self._logged[name] = state["logs"][name]
+
+        unit = state["unit"]
+        ids_start = unit["ids"] if unit else len(logs["ids"])
+        references_start = unit["references"] if unit else len(logs["references"])
+        sources = {int(k): v for k, v in state["sources"].items()}
+        self.index.extend(
+            logs["ids"][:ids_start], logs["references"][:references_start], sources
+        )
+        if unit:
+            self._unit = unit
+            self._partial = UnitSummary(
+                [
+                    resource_type
+                    for resource_type, size in state["sizes"].items()
+                    if size > unit["sizes"].get(resource_type, 0)
+                ],
+                logs["ids"][ids_start:],
+                logs["references"][references_start:],
+                sources,
+                load_vocabulary(unit["vocabulary"]),
+                ErrorReport.load(unit.get("errors")),
+            )
+        self.completed = state["completed"]
+        self.emitted = state["emitted"]
+        self.shards = state["shards"]
+        self._vocabulary = load_vocabulary(state["vocabulary"])
+        self._errors = ErrorReport.load(state.get("errors"))
+        return state
+
+    @property
+    def vocabulary(self) -> VocabularyCollector:
+        """The run's vocabulary as of the checkpoint."""
+        return self._vocabulary
+
+    @property
+    def errors(self) -> ErrorReport:
+        """The run's errors as of the checkpoint."""
+        return self._errors
+
+    def partial(self, unit: Unit) -> tuple[int, UnitSummary | None]:
+        """The input offset to continue the unit from and what it collected before the checkpoint."""
+        if self._unit and self._unit["name"] == unit.name and self._partial:
+            return self._unit["offset"], self._partial
+        return 0, None
+
+    def begin(self, unit: Unit, reader, vocabulary, errors: ErrorReport | None = None):
+        """Start tracking a unit, the reader is None if the unit can't be resumed part way.
+
+        reader is a LineReader, or any iterable of lines with the `position` it reached.
+        """
+        self._reader = reader
+        self._vocabulary = vocabulary
+        self._errors = errors or ErrorReport()
+        if not (self._unit and self._unit["name"] == unit.name):
+            self._unit = {
+                "name": unit.name,
+                "sizes": dict(self.emitters.sizes),
+                "ids": len(self.index.ids),
+                "references": len(self.index.references),
+            }
+        self._partial = None
+        self._mark = None
+        if reader is not None:
+            self._note()
+
+    def _note(self):
+        """Note the state after the last completed resource."""
+        assert self._reader is not None
+        self._mark = (
+            self._reader.position,
+            dict(self.emitters.sizes),
+            len(self.index.ids),
+            len(self.index.references),
+        )
+
+    def tick(
+        self,
+        unit_vocabulary: VocabularyCollector,
+        unit_errors: ErrorReport | None = None,
+    ):
+        """Call after each resource of a unit, saves a checkpoint if one is due."""
+        if self._reader is None:
+            return
+        self._note()
+        if self.due():
+            self.save(unit_vocabulary, unit_errors)
+
+    def due(self) -> bool:
+        """Whether the next `tick` saves a checkpoint."""
+        return time.monotonic() - self._saved >= self.interval
+
+    def failed(
+        self,
+        unit_vocabulary: VocabularyCollector,
+        unit_errors: ErrorReport | None = None,
+    ):
+        """Save the state after the last completed resource, the failed one is retried on resume."""
+        if self._mark is not None:
+            self.save(unit_vocabulary, unit_errors)
+
+    def end(
+        self,
+        unit: Unit,
+        emitted: list[str],
+        vocabulary: VocabularyCollector,
+        errors: ErrorReport | None = None,
+    ):
+        """Record a completed unit and save a checkpoint."""
+        self.completed.append(unit.name)
+        self.emitted.extend(emitted)
+        self._vocabulary = vocabulary
+        self._errors = errors or ErrorReport()
+        self._unit = None
+        self._reader = None
+        self._mark = None
+        self.save()
+
+    def save(
+        self,
+        unit_vocabulary: VocabularyCollector | None = None,
+        unit_errors: ErrorReport | None = None,
+    ):
+        """Write the checkpoint."""
+        if not self.enabled:
+            return
+        unit = None
+        if self._mark is not None and unit_vocabulary is not None:
+            assert self._unit is not None
+            offset, sizes, ids, references = self._mark
+            unit = {
+                **self._unit,
+                "offset": offset,
+                "vocabulary": unit_vocabulary.research_study_vocabularies,
+                "errors": unit_errors.state() if unit_errors else None,
+            }
+        else:
+            sizes = dict(self.emitters.sizes)
+            ids, references = len(self.index.ids), len(self.index.references)
+        self.emitters.flush()
+        for name, values, count in [
+            ("ids", self.index.ids, ids),
+            ("references", self.index.references, references),
+        ]:
+            if count <= self._logged[name]:
+                continue
+            with open(self.directory / f"{name}.log", "ab") as log:
+                for chunk in values.chunks(self._logged[name], count):
+                    log.write(chunk.tobytes())
+                log.flush()
+                os.fsync(log.fileno())
+            self._logged[name] = count
+        state = {
+            "settings": self.settings,
+            "inputs": self.inputs,
+            "completed": self.completed,
+            "emitted": self.emitted,
+            "unit": unit,
+            "sizes": sizes,
+            "logs": self._logged,
+            "sources": {str(k): v for k, v in self.index.sources.items()},
+            "vocabulary": self._vocabulary.research_study_vocabularies,
+            "errors": self._errors.state() if self._errors else None,
+            "manifest": self.manifest.state() if self.manifest else None,
+            "shards": self.shards,
+        }
+        write_durably(self.path, orjson.dumps(state))
+        self._saved = time.monotonic()
+
+    def shard_directory(self, pending: list[str], shards: list) -> pathlib.Path:
+        """The directory for shard outputs, completed shards are kept if the plan is unchanged."""
+        plan = {"units": pending, "shards": [list(_) for _ in shards]}
+        directory = self.directory / "shards"
+        if plan != self.shards:
+            shutil.rmtree(directory, ignore_errors=True)
+            self.shards = plan
+            self.save()
+        directory.mkdir(exist_ok=True)
+        return directory
+
+    def shard_summary(self, number: int) -> UnitSummary | None:
+        """The summary of a shard completed before the checkpoint, if any."""
+        path = self.directory / "shards" / f"{number:08d}.summary.json"
+        if not path.exists():
+            return None
+        return load_summary(path.read_bytes())
+
+    def shard_done(self, number: int, summary: UnitSummary):
+        """Record a completed shard."""
+        write_durably(
+            self.directory / "shards" / f"{number:08d}.summary.json",
+            dump_summary(summary),
+        )
+
+    def remove(self):
+        """Remove the checkpoint, call once the run is complete."""
+        self.path.unlink(missing_ok=True)
+        shutil.rmtree(self.directory, ignore_errors=True)
@@ -0,0 +1,182 @@
+import functools
+import importlib.metadata
+import os
+import pathlib
+import tempfile
+import types
+import typing
+from typing import Any
+
+import orjson
+
+from fhir_aggregator_submission import models
+from fhir_aggregator_submission.structural import is_resource
+from fhir_aggregator_submission.validation_cache import default_directory
+
+# Bumped when the index changes, so indexes cached by an older version are built again.
+INDEX_VERSION = 1
+# A field that holds a resource, e.g. `contained`, whose codings are found by walking it.
+ANY = "*"
+
+
+def field_types(klass: Any) -> dict[str, Any]:
+    """The model class of each field of a model, ANY for a resource and None for a primitive."""
+    fields: dict[str, Any] = {}
+    for field in klass.model_fields.values():
+        annotation = field.annotation
+        while True:
+            # unwrap Optional[...] and List[...], e.g. of _given: List[Optional[FHIRPrimitiveExtension]]
+            args = tuple(_ for _ in typing.get_args(annotation) if _ is not type(None))
+            origin = typing.get_origin(annotation)
+            if origin in (typing.Union, types.UnionType) and len(args) == 1:
+                annotation = args[0]
+            elif origin in (list, typing.List):
+                annotation = args[0]
+            else:
+                break
+        if typing.get_origin(annotation) in (typing.Union, types.UnionType):
+            # e.g. fhir_comments, a string or a list of them
+            complex = any(
+                hasattr(_, "get_model_klass") for _ in typing.get_args(annotation)
+            )
+            fields[field.alias] = ANY if complex else None
+        elif hasattr(annotation, "get_model_klass"):
+            model = annotation.get_model_klass()
+            fields[field.alias] = ANY if is_resource(model) else model
+        else:
+            fields[field.alias] = None
+    return fields
+
+
+def build_index(fhir_version: str, resource_type: str) -> dict[str, Any]:
+    """The fields of a resourceType, and of its elements, that may hold a `coding` outside an `extension`.
+
+    Returns {"root": the resource's model, "types": {model: {field: model, ANY or None}}}, a field
+    is None if no coding can be found under it.
+    """
+    root = models.model_class(fhir_version, resource_type)
+    fields: dict[Any, dict[str, Any]] = {}
+    pending = [root]
+    while pending:
+        klass = pending.pop()
+        if klass in fields:
+            continue
+        fields[klass] = field_types(klass)
+        pending.extend(
+            _
+            for name, _ in fields[klass].items()
+            if _ not in (None, ANY) and name != "extension"
+        )
+    # the models that may hold a coding: those with a coding field, or a field that holds one
+    holds = {klass for klass, _ in fields.items() if "coding" in _}
+    changed = True
+    while changed:
+        changed = False
+        for klass, klass_fields in fields.items():
+            if klass not in holds and any(
+                _ == ANY or _ in holds
+                for name, _ in klass_fields.items()
+                if name != "extension"
+            ):
+                holds.add(klass)
+                changed = True
+    # models of different packages may share a name
+    names: dict[Any, str] = {}
+    for klass in fields:
+        name = klass.__name__
+        while name in names.values():
+            name += "_"
+        names[klass] = name
+    return {
+        "root": names[root],
+        "types": {
+            names[klass]: {
+                name: (
+                    None
+                    if name == "extension" or _ not in holds and _ != ANY
+                    else _ if _ == ANY else names[_]
+                )
+                for name, _ in klass_fields.items()
+            }
+            for klass, klass_fields in fields.items()
+            if klass in holds or klass is root
+        },
+    }
+
+
+def index_directory(fhir_version: str, directory=None) -> pathlib.Path:
+    """Where the indexes are kept, next to the validation cache of the same versions."""
+    directory = pathlib.Path(directory) if directory else default_directory()
+    version = importlib.metadata.version("fhir.resources")
+    return (
+        directory
+        / f"{fhir_version}-fhir.resources-{version}"
+        / f"codings-{INDEX_VERSION}"
+    )
+
+
+@functools.cache
+def load_index(fhir_version: str, resource_type: str, directory=None) -> dict | None:
+    """The index of a resourceType, built and written to the cache the first time.
+
+    A cached index is read without importing fhir.resources.  None for a resourceType
+    without a model.
+    """
+    if not resource_type.isalnum():
+        return None
+    path = index_directory(fhir_version, directory) / f"{resource_type}.json"
+    try:
+        index = orjson.loads(path.read_bytes())
+    except OSError:
+        try:
+            index = build_index(fhir_version, resource_type)
+        except ValueError:
+            return None
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(suffix=".tmp", dir=path.parent)
+            with os.fdopen(fd, "wb") as f:
+                f.write(orjson.dumps(index))
+            os.replace(tmp, path)
+        except OSError:
+            pass
+    return index
+
+
+def find_codings(resource: dict, fhir_version: str) -> list[tuple[str, Any]]:
+    """The (first key of the path, value) of every `coding` in a resource, outside of extensions.
+
+    The same, and in the same order, as `find_key_with_path(resource, "coding", ["extension"])`,
+    but only the fields of the resourceType's index that may hold a coding are visited.  Keys
+    that are not fields of the model, and resources in fields like `contained`, are walked.
+    """
+    found: list[tuple[str, Any]] = []
+    index = load_index(fhir_version, resource["resourceType"])
+    if index is None:
+        _walk(resource, None, {}, None, found)
+    else:
+        _walk(resource, index["types"][index["root"]], index["types"], None, found)
+    return found
+
+
+def _walk(value, fields: dict | None, index: dict, top: str | None, found: list):
+    """Add the codings in value to found, visiting only its fields that may hold one, or all with fields None."""
+    if isinstance(value, list):
+        for item in value:
+            _walk(item, fields, index, top, found)
+        return
+    if not isinstance(value, dict):
+        return
+    for key, child in value.items():
+        if key == "extension":
+            continue
+        child_top = key if top is None else top
+        if key == "coding":
+            found.append((child_top, child))
+        if fields is None or key not in fields:
+            if isinstance(child, (dict, list)):
+                _walk(child, None, index, child_top, found)
+            continue
+        name = fields[key]
+        if name is not None:
+            _walk(child, None if name == ANY else index[name], index, child_top, found)
@@ -0,0 +1,178 @@
+import pathlib
+from typing import Any
+
+import orjson
+
+from fhir_aggregator_submission import models
+
+# The file `--on-error collect` writes to OUTPUT_PATH, JSON lines that are not FHIR resources, so
+# not named *.ndjson: the upload and bulk import scripts take every *.ndjson file there.
+ERRORS_NAME = "validation-errors.jsonl"
+# Failing resources kept as examples, per resourceType and error location.
+MAX_EXAMPLES = 10
+
+
+def error_details(error: Exception) -> list[dict[str, str]]:
+    """The location, type and message of each problem of a validation error."""
+    if isinstance(error, models.ValidationError):
+        return [
+            {
+                "loc": ".".join(str(_) for _ in detail["loc"]),
+                "type": detail["type"],
+                "msg": detail["msg"],
+            }
+            for detail in error.errors()
+        ]
+    # validate raises an AttributeError for a resource without an id
+    return [{"loc": "id", "type": "missing", "msg": str(error)}]
+
+
+def location(loc: str) -> str:
+    """An error location without its list indexes, e.g. `content.attachment.size`."""
+    return ".".join(_ for _ in loc.split(".") if not _.isdigit())
+
+
+class ErrorReport:
+    """The resources that failed validation and the dangling references of a run.
+
+    Counts failing resources per resourceType, and errors per resourceType and location, and
+    keeps up to `max_examples` failing resources for each location.  Reports of units and
+    worker processes are merged in input order, so the examples are those of a single process
+    run.
+    """
+
+    def __init__(self, max_examples: int = MAX_EXAMPLES):
+        """Initialize an empty report."""
+        self.max_examples = max_examples
+        # resourceType -> failing resources
+        self.resource_types: dict[str, int] = {}
+        # resourceType -> error location -> errors
+        self.locations: dict[str, dict[str, int]] = {}
+        self.examples: list[dict[str, Any]] = []
+        # resourceType, path, count and examples of the references not found
+        self.references: list[dict[str, Any]] = []
+        self._kept: dict[tuple[str, str], int] = {}
+
+    def __len__(self) -> int:
+        """The failing resources and dangling references."""
+        return sum(self.resource_types.values()) + sum(
+            _["count"] for _ in self.references
+        )
+
+    def add(self, resource: dict, error: Exception):
+        """Record a resource that failed validation."""
+        example = {
+            "resourceType": resource["resourceType"],
+            "id": resource.get("id"),
+            "errors": error_details(error),
+            "resource": resource,
+        }
+        resource_type = example["resourceType"]
+        self.resource_types[resource_type] = (
+            self.resource_types.get(resource_type, 0) + 1
+        )
+        locations = self.locations.setdefault(resource_type, {})
+        for loc in {location(_["loc"]) for _ in example["errors"]}:
+            locations[loc] = locations.get(loc, 0) + 1
+        self._keep(example)
+
+    def _keep(self, example: dict[str, Any]):
+        """Keep the example if one of its locations has fewer than max_examples."""
+        keys = {
+            (example["resourceType"], location(_["loc"])) for _ in example["errors"]
+        }
+        if any(self._kept.get(_, 0) < self.max_examples for _ in keys):
+            self.examples.append(example)
+            for key in keys:
+                self._kept[key] = self._kept.get(key, 0) + 1
+
+    def add_references(
+        self, resource_type: str, path: str, count: int, examples: list[str]
+    ):
+        """Record references not found, grouped by the resourceType and path they were found at."""
+        self.references.append(
+            {
+                "resourceType": resource_type,
+                "path": path,
+                "count": count,
+                "examples": examples,
+            }
+        )
+
+    def merge(self, other: "ErrorReport") -> "ErrorReport":
+        """Add a report collected after this one, returns self."""
+        for resource_type, count in other.resource_types.items():
+            self.resource_types[resource_type] = (
+                self.resource_types.get(resource_type, 0) + count
+            )
+        for resource_type, other_locations in other.locations.items():
+            locations = self.locations.setdefault(resource_type, {})
+            for loc, count in other_locations.items():
+                locations[loc] = locations.get(loc, 0) + count
+        for example in other.examples:
+            self._keep(example)
+        self.references.extend(other.references)
+        return self
+
+    def state(self) -> dict[str, Any]:
+        """The report as JSON values, see `load`."""
+        return {
+            "resource_types": self.resource_types,
+            "locations": self.locations,
+            "examples": self.examples,
+            "references": self.references,
+        }
+
+    @classmethod
+    def load(cls, state: dict[str, Any] | None) -> "ErrorReport":
+        """Rebuild a report from its `state`, an empty one for None."""
+        report = cls()
+        if state:
+            loaded = cls()
+            loaded.resource_types = state["resource_types"]
+            loaded.locations = state["locations"]
+            loaded.examples = state["examples"]
+            loaded.references = state["references"]
+            # merge into a new report so more errors can be added to it
+            report.merge(loaded)
+        return report
+
+    def write(self, path: pathlib.Path):
+        """Write the report as NDJSON: a summary line, then the failing resources and dangling references."""
+        with open(path, "wb") as f:
+            f.write(
+                orjson.dumps(
+                    {
+                        "kind": "summary",
+                        "resourceTypes": self.resource_types,
+                        "locations": self.locations,
+                        "references": sum(_["count"] for _ in self.references),
+                    }
+                )
+                + b"\n"
+            )
+            for example in self.examples:
+                f.write(orjson.dumps({"kind": "resource", **example}) + b"\n")
+            for group in self.references:
+                f.write(orjson.dumps({"kind": "reference", **group}) + b"\n")
+
+    def report(self) -> str:
+        """Describe the errors by resourceType and location, most frequent first."""
+        lines = [
+            f"Validation errors: {sum(self.resource_types.values())} resources, "
+            f"{sum(_['count'] for _ in self.references)} references not found"
+        ]
+        for resource_type, count in sorted(
+            self.resource_types.items(), key=lambda item: (-item[1], item[0])
+        ):
+            lines.append(f"  {resource_type}: {count}")
+            for loc, loc_count in sorted(
+                self.locations[resource_type].items(),
+                key=lambda item: (-item[1], item[0]),
+            ):
+                lines.append(f"    {loc or '(resource)'}: {loc_count}")
+        for group in self.references:
+            lines.append(
+                f"  {group['resourceType']} {group['path']}: {group['count']} references not found"
+            )
+        return "\n".join(lines)
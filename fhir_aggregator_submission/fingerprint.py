@@ -0,0 +1,137 @@
+import random
+import re
+from typing import Any
+
+# The fraction of resources of an already validated shape that are still validated in full.
+DEFAULT_SAMPLE_RATE = 0.01
+
+# Formats of FHIR primitives, from the FHIR specification.
+ID = re.compile(r"[A-Za-z0-9\-\.]{1,64}")
+DATE_TIME = re.compile(
+    r"([0-9]([0-9]([0-9][1-9]|[1-9]0)|[1-9]00)|[1-9]000)"
+    r"(-(0[1-9]|1[0-2])(-(0[1-9]|[1-2][0-9]|3[0-1])"
+    r"(T([01][0-9]|2[0-3]):[0-5][0-9]:([0-5][0-9]|60)(\.[0-9]{1,9})?"
+    r"(Z|(\+|-)((0[0-9]|1[0-3]):[0-5][0-9]|14:00)))?)?)?"
+)
+# A relative `Type/id[/_history/version]`, a `#contained` one or an absolute URL/URN.
+REFERENCE = re.compile(
+    r"[A-Z][A-Za-z]+/[A-Za-z0-9\-\.]{1,64}(/_history/[A-Za-z0-9\-\.]{1,64})?"
+    r"|#[A-Za-z0-9\-\.]{0,64}"
+    r"|[a-z][a-z0-9+.\-]*:\S+"
+)
+
+
+def leaves(resource: dict) -> list[tuple[str, Any]]:
+    """The (path, value) of each primitive in a resource, list items share their list's path.
+
+    Empty objects and lists are leaves too, as `{}` and `[]`.
+    """
+    found = []
+    stack: list[tuple[str, Any]] = [("", resource)]
+    while stack:
+        path, value = stack.pop()
+        if isinstance(value, dict):
+            if not value:
+                found.append((path, "{}"))
+            for key, item in value.items():
+                stack.append((f"{path}.{key}" if path else key, item))
+        elif isinstance(value, list):
+            if not value:
+                found.append((path, "[]"))
+            for item in value:
+                stack.append((path, item))
+        else:
+            found.append((path, value))
+    return found
+
+
+def fingerprint(found: list[tuple[str, Any]]) -> int:
+    """The shape of a resource: the set of its key paths and the types of their values."""
+    return hash(frozenset((path, type(value)) for path, value in found))
+
+
+def formats(found: list[tuple[str, Any]]) -> dict[str, re.Pattern]:
+    """The formats to check at each path, from a resource of the shape that passed validation.
+
+    The id, references and strings that look like dates and times in the validated resource.
+    """
+    checks = {"id": ID}
+    for path, value in found:
+        if not isinstance(value, str) or path in checks:
+            continue
+        if path == "reference" or path.endswith(".reference"):
+            checks[path] = REFERENCE
+        elif value[:1].isdigit() and DATE_TIME.fullmatch(value):
+            checks[path] = DATE_TIME
+    return checks
+
+
+class ShapeSampler:
+    """Decides which resources are validated in full with `--validate-mode fingerprint`.
+
+    The first resource of each shape, see `fingerprint`, and a random sample of the others are
+    validated in full.  The rest only have their primitives' formats checked: the id, the
+    references and the dates and times seen in the first resource of their shape.
+    """
+
+    def __init__(self, sample_rate: float = DEFAULT_SAMPLE_RATE):
+        """Initialize the sampler, with no shapes seen."""
+        self._clear(sample_rate)
+
+    def _clear(self, sample_rate: float):
+        self.sample_rate = sample_rate
+        # per shape, the formats to check
+        self._shapes: dict[int, dict[str, re.Pattern]] = {}
+        # the last resource checked whose shape was not known, with its shape and leaves
+        self._unseen: tuple[dict, int, list] | None = None
+        self._random = random.Random()
+        self.full = 0
+        self.structural = 0
+
+    def __getstate__(self):
+        # a worker process learns the shapes itself
+        return {"sample_rate": self.sample_rate}
+
+    def __setstate__(self, state):
+        self._clear(state["sample_rate"])
+
+    def check(self, resource: dict) -> bool:
+        """True if the resource's shape passed validation and its primitives are well formed.
+
+        False if it needs validating in full; the shape of a resource that passes is then
+        learned, see `learn`.
+        """
+        found = leaves(resource)
+        shape = fingerprint(found)
+        checks = self._shapes.get(shape)
+        if checks is None:
+            self._unseen = (resource, shape, found)
+        elif self._random.random() >= self.sample_rate and all(
+            path not in checks
+            or (isinstance(value, str) and checks[path].fullmatch(value))
+            for path, value in found
+        ):
+            self.structural += 1
+            return True
+        self.full += 1
+        return False
+
+    def learn(self, resource: dict):
+        """Remember the shape of a resource that passed validation in full."""
+        unseen, self._unseen = self._unseen, None
+        if unseen is not None and unseen[0] is resource:
+            _, shape, found = unseen
+        else:
+            found = leaves(resource)
+            shape = fingerprint(found)
+        if shape not in self._shapes:
+            self._shapes[shape] = formats(found)
+
+    def merge(self, full: int, structural: int):
+        """Add the counts of a worker."""
+        self.full += full
+        self.structural += structural
+
+    def report(self) -> str:
+        """A one line summary of how the resources were validated."""
+        return f"Validated {self.full:,} resources in full, {self.structural:,} by their shape"
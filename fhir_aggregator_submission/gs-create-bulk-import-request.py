@@ -3,6 +3,8 @@ import subprocess
 
 import click
 
+from fhir_aggregator_submission.outputs import parse_part_name
+
 
 @click.command()
 @click.argument("bucket_path")
@@ -44,6 +46,16 @@ def bulk_import(bucket_path):
     ndjson_files = [
         line for line in result.stdout.splitlines() if line.endswith(".ndjson")
     ]
+    # the parts of a split output, Observation.0001.ndjson ..., are imported by one operation with a wildcard,
+    # the server reads them in parallel
+    gcs_uris: list[str] = []
+    for gcs_uri in ndjson_files:
+        directory, _, name = gcs_uri.rpartition("/")
+        resource_type, part = parse_part_name(name)
+        if part:
+            gcs_uri = f"{directory}/{resource_type}.*.ndjson"
+        if gcs_uri not in gcs_uris:
+            gcs_uris.append(gcs_uri)
 
     # Write the load commands to a shell script
     output_file = f"scripts/gs-bulk-import-request-{project_name}.sh"
@@ -58,7 +70,7 @@ def bulk_import(bucket_path):
         f.write(': "${DATASET_ID:?Need to set DATASET_ID}"\n')
         f.write(': "${LOCATION:?Need to set LOCATION}"\n')
 
-        for _ in ndjson_files:
+        for _ in gcs_uris:
             f.write(
                 f"gcloud healthcare fhir-stores import gcs $FHIR_STORE_ID --dataset=$DATASET_ID --location=$LOCATION --content-structure=resource --async --gcs-uri={_}\n"
             )
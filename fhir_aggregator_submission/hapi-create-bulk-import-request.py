@@ -4,6 +4,8 @@ from pathlib import Path
 import click
 import os
 
+from fhir_aggregator_submission.outputs import parse_part_name
+
 
 @click.command()
 @click.argument("full_path")
@@ -41,16 +43,21 @@ def bulk_import(full_path, project_name, input_source):
     }
 
     for root, dirs, files in os.walk(full_path):
+        # skip prep's working directories, e.g. .prep-cache
+        dirs[:] = [_ for _ in dirs if not _.startswith(".")]
         for file in files:
             if file.endswith(".ndjson"):
                 ndjson_files.append(os.path.join(root, file))
     # read each ndjson file and send it to the bulk import endpoint
-    for ndjson_file in ndjson_files:
+    # the parts of a split output, Observation.0001.ndjson ..., are separate inputs the server imports in parallel
+    for ndjson_file in sorted(
+        ndjson_files, key=lambda _: parse_part_name(Path(_).name)
+    ):
         path = Path(ndjson_file)
         _ = {
             "name": "input",
             "part": [
-                {"name": "type", "valueCode": path.name.split(".")[0]},
+                {"name": "type", "valueCode": parse_part_name(path.name)[0]},
                 {
                     "name": "url",
                     "valueUri": f"https://storage.googleapis.com/fhir-aggregator-public/{project_name}/META/{path.name}",
@@ -0,0 +1,313 @@
+import base64
+import hashlib
+import os
+import pathlib
+import shutil
+from importlib.metadata import PackageNotFoundError, version
+from typing import Any, NamedTuple
+
+import numpy as np
+import orjson
+
+from fhir_aggregator_submission.errors import ErrorReport
+from fhir_aggregator_submission.outputs import (
+    output_parts,
+    output_size,
+    part_name,
+    read_range,
+)
+from fhir_aggregator_submission.references import ID_DTYPE, REFERENCE_DTYPE
+from fhir_aggregator_submission.vocabulary import VocabularyCollector
+
+MANIFEST_NAME = "prep-manifest.json"
+CACHE_DIR = ".prep-cache"
+# the unit of work that creates assays from DocumentReference, Group and Specimen
+ASSAY = "assay"
+ASSAY_INPUTS = ["DocumentReference", "Group", "Specimen"]
+
+
+class Unit(NamedTuple):
+    """A unit of prep work: the assay stage or a single input file."""
+
+    name: str
+    inputs: list[str]
+
+
+class UnitSummary(NamedTuple):
+    """What a unit contributed to the run, beyond the resources it emitted.
+
+    ids and references are arrays of hashes, see `references.ReferenceIndex`.  errors are the
+    resources that failed validation with --on-error collect.
+    """
+
+    emitted: list[str]
+    ids: np.ndarray
+    references: np.ndarray
+    sources: dict[int, list[str]]
+    vocabulary: VocabularyCollector
+    errors: ErrorReport | None = None
+
+
+def plan_units(input_path, transformers: list[str]) -> list[Unit]:
+    """The units of work for the input directory, in processing order."""
+    units = []
+    paths = list(pathlib.Path(input_path).glob("*.ndjson"))
+    if "assay" in transformers:
+        inputs = [
+            pathlib.Path(input_path) / f"{resource_type}.ndjson"
+            for resource_type in ASSAY_INPUTS
+        ]
+        units.append(Unit(ASSAY, [str(_) for _ in inputs if _.exists()]))
+        # assay emits these
+        paths = [_ for _ in paths if _.stem not in ["DocumentReference", "Group"]]
+    for path in paths:
+        units.append(Unit(path.stem, [str(path)]))
+    return units
+
+
+def package_version() -> str:
+    """The installed version of this package."""
+    try:
+        return version("fhir_aggregator_submission")
+    except PackageNotFoundError:
+        return "unknown"
+
+
+def fingerprint(path, previous: dict | None = None) -> dict:
+    """Size, mtime and content hash of a file.  The hash is reused if size and mtime are unchanged."""
+    stat = os.stat(path)
+    if (
+        previous
+        and previous["size"] == stat.st_size
+        and previous["mtime_ns"] == stat.st_mtime_ns
+    ):
+        return previous
+    with open(path, "rb") as f:
+        sha256 = hashlib.file_digest(f, "sha256").hexdigest()
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": sha256}
+
+
+def dump_summary(summary: UnitSummary) -> bytes:
+    """Serialize a unit summary."""
+    data = {
+        "emitted": summary.emitted,
+        "ids": base64.b64encode(summary.ids.tobytes()).decode(),
+        "references": base64.b64encode(summary.references.tobytes()).decode(),
+        "sources": {str(k): v for k, v in summary.sources.items()},
+        "vocabulary": summary.vocabulary.research_study_vocabularies,
+    }
+    if summary.errors:
+        data["errors"] = summary.errors.state()
+    return orjson.dumps(data)
+
+
+def load_vocabulary(research_study_vocabularies: dict) -> VocabularyCollector:
+    """Rebuild a collector from its deserialized `research_study_vocabularies`."""
+    loaded = VocabularyCollector()
+    for research_study_id, (
+        coding_dict,
+        extension_dict,
+    ) in research_study_vocabularies.items():
+        loaded.research_study_vocabularies[research_study_id] = (
+            coding_dict,
+            extension_dict,
+        )
+    # merge into a new collector so more resources can be collected into it
+    return VocabularyCollector().merge(loaded)
+
+
+def load_summary(data: bytes) -> UnitSummary:
+    """Deserialize a unit summary."""
+    summary = orjson.loads(data)
+    return UnitSummary(
+        summary["emitted"],
+        np.frombuffer(base64.b64decode(summary["ids"]), dtype=ID_DTYPE),
+        np.frombuffer(base64.b64decode(summary["references"]), dtype=REFERENCE_DTYPE),
+        {int(k): v for k, v in summary["sources"].items()},
+        load_vocabulary(summary["vocabulary"]),
+        ErrorReport.load(summary.get("errors")),
+    )
+
+
+class RunManifest:
+    """Record what produced each output file, so the next run can reuse unchanged units.
+
+    The manifest (OUTPUT_PATH/prep-manifest.json) holds the run settings and, per unit, the
+    fingerprints of its input files and the byte range it wrote to each output file.  A summary
+    of each unit (ids, references and vocabulary counts) is cached in OUTPUT_PATH/.prep-cache so
+    the vocabulary Observation and reference validation can be recomputed without re-reading it.
+    """
+
+    def __init__(
+        self,
+        output_path,
+        settings: dict[str, Any],
+        enabled: bool = True,
+        state: dict | None = None,
+    ):
+        """Initialize the manifest, loading the previous one if the settings are unchanged.
+
+        Pass the `state` saved in a checkpoint to continue an interrupted run instead.
+        """
+        self.enabled = enabled
+        self.output_path = pathlib.Path(output_path)
+        self.cache_path = self.output_path / CACHE_DIR
+        self.previous_path = self.cache_path / "previous"
+        self.settings = {**settings, "package_version": package_version()}
+        self.units: list[dict] = []
+        self._previous: dict[str, dict] = {}
+        self._previous_outputs: dict[str, dict] = {}
+        self._reusable: dict[str, dict] = {}
+        self._references: dict[str, int] = {}
+        self._started: dict[str, dict[str, int]] = {}
+        if state is not None:
+            self.units = state["units"]
+            self._reusable = state["reusable"]
+            self._references = state["references"]
+            self._started = state["started"]
+        elif enabled:
+            self._load()
+
+    def state(self) -> dict:
+        """The progress of this run, saved in checkpoints."""
+        return {
+            "units": self.units,
+            "reusable": self._reusable,
+            "references": self._references,
+            "started": self._started,
+        }
+
+    def _load(self):
+        """Load the previous manifest, it is removed until this run completes."""
+        manifest_path = self.output_path / MANIFEST_NAME
+        if self.previous_path.exists():
+            # an interrupted run, the outputs are incomplete
+            shutil.rmtree(self.previous_path)
+            manifest_path.unlink(missing_ok=True)
+        if not manifest_path.exists():
+            return
+        manifest = orjson.loads(manifest_path.read_bytes())
+        manifest_path.unlink()
+        if manifest.get("settings") != self.settings:
+            return
+        self._previous = {_["name"]: _ for _ in manifest["units"]}
+        self._previous_outputs = manifest["outputs"]
+
+    def prepare(self, units: list[Unit]):
+        """Decide which units can be reused and move the previous outputs aside."""
+        if not self.enabled:
+            return
+        for unit in units:
+            previous = self._previous.get(unit.name)
+            if not previous:
+                continue
+            inputs = {
+                pathlib.Path(path).name: fingerprint(
+                    path, previous["inputs"].get(pathlib.Path(path).name)
+                )
+                for path in unit.inputs
+            }
+            if {k: (v["size"], v["sha256"]) for k, v in inputs.items()} != {
+                k: (v["size"], v["sha256"]) for k, v in previous["inputs"].items()
+            }:
+                continue
+            if not (self.cache_path / f"{unit.name}.summary.json").exists():
+                continue
+            outputs_intact = all(
+                output_parts(self.output_path, resource_type)
+                and output_size(self.output_path, resource_type)
+                == self._previous_outputs.get(part_name(resource_type), {}).get("size")
+                for resource_type in previous["outputs"]
+            )
+            if not outputs_intact:
+                continue
+            self._reusable[unit.name] = {**previous, "inputs": inputs}
+            for resource_type in previous["outputs"]:
+                self._references[resource_type] = (
+                    self._references.get(resource_type, 0) + 1
+                )
+        if self._reusable:
+            self.previous_path.mkdir(parents=True, exist_ok=True)
+            for path in self.output_path.glob("*.ndjson"):
+                os.replace(path, self.previous_path / path.name)
+
+    def reusable(self, unit: Unit) -> bool:
+        """True if the unit's inputs and the settings are unchanged since the last run."""
+        return unit.name in self._reusable
+
+    def outputs(self, unit: Unit) -> list[str]:
+        """The resourceTypes a reusable unit emitted in the last run."""
+        return list(self._reusable[unit.name]["outputs"])
+
+    def restorable(self, unit: Unit) -> bool:
+        """True if the previous output of a reusable unit is still available."""
+        return all(
+            output_parts(self.previous_path, resource_type)
+            for resource_type in self._reusable[unit.name]["outputs"]
+        )
+
+    def begin(self, unit: Unit, emitters):
+        """Note where the unit's output starts."""
+        if self.enabled:
+            self._started[unit.name] = dict(emitters.sizes)
+
+    def end(self, unit: Unit, emitters, summary: UnitSummary, inputs=None):
+        """Record the unit's output byte ranges and cache its summary."""
+        if not self.enabled:
+            return
+        started = self._started.pop(unit.name)
+        outputs = {}
+        for resource_type, size in emitters.sizes.items():
+            offset = started.get(resource_type, 0)
+            if size > offset:
+                outputs[resource_type] = [offset, size - offset]
+        if inputs is None:
+            inputs = {
+                pathlib.Path(path).name: fingerprint(path) for path in unit.inputs
+            }
+        self.units.append({"name": unit.name, "inputs": inputs, "outputs": outputs})
+        self.cache_path.mkdir(parents=True, exist_ok=True)
+        (self.cache_path / f"{unit.name}.summary.json").write_bytes(
+            dump_summary(summary)
+        )
+
+    def restore(self, unit: Unit, emitters) -> UnitSummary:
+        """Copy a reused unit's output from the previous run and return its cached summary."""
+        record = self._reusable[unit.name]
+        self.begin(unit, emitters)
+        for resource_type, (offset, length) in record["outputs"].items():
+            previous = output_parts(self.previous_path, resource_type)
+            self._references[resource_type] -= 1
+            if (
+                offset == 0
+                and self._references[resource_type] == 0
+                and not emitters.is_open(resource_type)
+            ):
+                # the only part of the output we need, take it over rather than copy it
+                emitters.adopt(resource_type, previous, length)
+                continue
+            for chunk in read_range(previous, offset, length):
+                emitters.write(resource_type, chunk)
+        summary = load_summary(
+            (self.cache_path / f"{unit.name}.summary.json").read_bytes()
+        )
+        self.end(unit, emitters, summary, inputs=record["inputs"])
+        return summary
+
+    def save(self, emitters):
+        """Write the manifest for this run, call once all output has been written."""
+        if not self.enabled:
+            return
+        outputs: dict[str, dict] = {}
+        for resource_type, size in emitters.sizes.items():
+            outputs[part_name(resource_type)] = {
+                "size": size,
+                "units": [
+                    _["name"] for _ in self.units if resource_type in _["outputs"]
+                ],
+            }
+        manifest = {"settings": self.settings, "units": self.units, "outputs": outputs}
+        (self.output_path / MANIFEST_NAME).write_bytes(
+            orjson.dumps(manifest, option=orjson.OPT_INDENT_2)
+        )
+        shutil.rmtree(self.previous_path, ignore_errors=True)
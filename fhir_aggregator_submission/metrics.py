@@ -0,0 +1,348 @@
+import contextlib
+import os
+import pathlib
+import resource
+import sys
+import tempfile
+import time
+from typing import Callable, Iterable, Iterator
+
+import orjson
+
+from fhir_aggregator_submission.outputs import read_range
+
+# ru_maxrss is in kilobytes, except on macOS where it is in bytes.
+RSS_UNIT = 1 if sys.platform == "darwin" else 1024
+# Prefix of the metrics in the Prometheus textfile.
+PROMETHEUS_PREFIX = "fa_submit_prep"
+
+
+def function_name(function: Callable) -> str:
+    """The name of a stage's function, through functools.partial."""
+    function = getattr(function, "func", function)
+    return getattr(function, "__name__", repr(function))
+
+
+class RunMetrics:
+    """Wall and CPU time, resources in and out, per resourceType and stage of a prep run.
+
+    The stages are the transformers (part-of, r4, validate, reseed, vocabulary), `read` and
+    `assay` that yield the input resources, `emit` that serializes and writes a resource,
+    `write` that writes lines as they are (unchanged input lines, restored or merged output),
+    and the run level `vocabulary_observations` and `validate_references`.  CPU time is that of
+    the thread running the stage.  A pool worker starts its own metrics, they are merged back
+    into the parent's with `merge`.
+    """
+
+    def __init__(self):
+        self._clear()
+
+    def _clear(self):
+        self.started = time.perf_counter()
+        # per (resourceType, stage): [calls, resources out, wall seconds, cpu seconds]
+        self.stages: dict[tuple[str, str], list] = {}
+        self.functions: dict[tuple[str, str], str] = {}
+        # bytes of input read, per unit
+        self.bytes_read: dict[str, int] = {}
+        # lines in the output, per resourceType, counted by the parent's emitters
+        self.written: dict[str, int] = {}
+
+    def __getstate__(self):
+        return {}
+
+    def __setstate__(self, state):
+        self._clear()
+
+    def counts(self, resource_type: str, stage: str, function: str = "") -> list:
+        """The [calls, resources out, wall, cpu] of a stage, updated in place."""
+        key = (resource_type, stage)
+        if key not in self.stages:
+            self.stages[key] = [0, 0, 0.0, 0.0]
+            self.functions[key] = function
+        return self.stages[key]
+
+    def timed(self, resource_type: str, stage: str, function: Callable) -> Callable:
+        """Wrap a transformer, `resource -> resource | None`, to record its calls."""
+        counts = self.counts(resource_type, stage, function_name(function))
+
+        def timed_stage(resource):
+            wall, cpu = time.perf_counter(), time.thread_time()
+            resource = function(resource)
+            counts[2] += time.perf_counter() - wall
+            counts[3] += time.thread_time() - cpu
+            counts[0] += 1
+            if resource:
+                counts[1] += 1
+            return resource
+
+        return timed_stage
+
+    def timed_iter(self, stage: str, resources: Iterable[tuple]) -> Iterator[tuple]:
+        """Yield the (resource, line) pairs, recording the time taken to produce each."""
+        iterator = iter(resources)
+        while True:
+            wall, cpu = time.perf_counter(), time.thread_time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            counts = self.counts(item[0]["resourceType"], stage)
+            counts[2] += time.perf_counter() - wall
+            counts[3] += time.thread_time() - cpu
+            counts[0] += 1
+            counts[1] += 1
+            yield item
+
+    @contextlib.contextmanager
+    def span(self, resource_type: str, stage: str):
+        """Record one call of a stage that runs once, e.g. validate_references."""
+        counts = self.counts(resource_type, stage)
+        wall, cpu = time.perf_counter(), time.thread_time()
+        try:
+            yield
+        finally:
+            counts[2] += time.perf_counter() - wall
+            counts[3] += time.thread_time() - cpu
+            counts[0] += 1
+            counts[1] += 1
+
+    def read(self, unit: str, nbytes: int):
+        """Count bytes of input read by a unit."""
+        self.bytes_read[unit] = self.bytes_read.get(unit, 0) + nbytes
+
+    def to_dict(self) -> dict:
+        """The stages and bytes read, as a worker hands them back to the parent."""
+        return {
+            "stages": [
+                [resource_type, stage, self.functions[(resource_type, stage)], *counts]
+                for (resource_type, stage), counts in self.stages.items()
+            ],
+            "bytes_read": self.bytes_read,
+        }
+
+    def merge(self, other: dict):
+        """Add the metrics of a worker, see `to_dict`."""
+        for resource_type, stage, function, *counts in other["stages"]:
+            mine = self.counts(resource_type, stage, function)
+            for i, value in enumerate(counts):
+                mine[i] += value
+        for unit, nbytes in other["bytes_read"].items():
+            self.read(unit, nbytes)
+
+    def report(self, bytes_written: dict[str, int], **run) -> dict:
+        """The metrics of the run, `run` are added as is, e.g. the study and transformers."""
+        wall = time.perf_counter() - self.started
+        own = resource.getrusage(resource.RUSAGE_SELF)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        cpu = time.process_time() + children.ru_utime + children.ru_stime
+        resource_types: dict[str, dict] = {}
+
+        def totals(resource_type) -> dict:
+            return resource_types.setdefault(
+                resource_type,
+                {"resources_read": 0, "resources_written": 0, "bytes_written": 0},
+            )
+
+        stages = []
+        # per resourceType, the stages in the order they were first run
+        for (resource_type, stage), (calls, out, stage_wall, stage_cpu) in sorted(
+            self.stages.items(), key=lambda item: item[0][0]
+        ):
+            stages.append(
+                {
+                    "resource_type": resource_type,
+                    "stage": stage,
+                    "function": self.functions[(resource_type, stage)],
+                    "resources_in": calls,
+                    "resources_out": out,
+                    "dropped": calls - out,
+                    "wall_seconds": stage_wall,
+                    "cpu_seconds": stage_cpu,
+                }
+            )
+            if stage in ("read", "assay"):
+                totals(resource_type)["resources_read"] += out
+        for resource_type, lines in self.written.items():
+            totals(resource_type)["resources_written"] = lines
+        for resource_type, size in bytes_written.items():
+            totals(resource_type)["bytes_written"] = size
+        resources_written = sum(self.written.values())
+        return {
+            **run,
+            "wall_seconds": wall,
+            "cpu_seconds": cpu,
+            "peak_rss_bytes": own.ru_maxrss * RSS_UNIT,
+            "peak_rss_children_bytes": children.ru_maxrss * RSS_UNIT,
+            "resources_read": sum(_["resources_read"] for _ in resource_types.values()),
+            "resources_written": resources_written,
+            "resources_per_second": resources_written / wall if wall else 0.0,
+            "bytes_read": sum(self.bytes_read.values()),
+            "bytes_written": sum(bytes_written.values()),
+            "inputs": {
+                unit: {"bytes_read": nbytes}
+                for unit, nbytes in sorted(self.bytes_read.items())
+            },
+            "resource_types": dict(sorted(resource_types.items())),
+            "stages": stages,
+        }
+
+
+class MeteredEmitters:
+    """Emitters that record the time taken to write, and count the lines written, per resourceType."""
+
+    def __init__(self, emitters, metrics: RunMetrics):
+        self._emitters = emitters
+        self.metrics = metrics
+
+    def emit(self, resource):
+        """Write the resource to the output path."""
+        if not resource:
+            return
+        resource_type = resource["resourceType"]
+        counts = self.metrics.counts(resource_type, "emit", "emit")
+        wall, cpu = time.perf_counter(), time.thread_time()
+        self._emitters.emit(resource)
+        counts[2] += time.perf_counter() - wall
+        counts[3] += time.thread_time() - cpu
+        counts[0] += 1
+        counts[1] += 1
+        self._wrote(resource_type, 1)
+
+    def write(self, resource_type, data):
+        """Write already serialized NDJSON lines for resource_type."""
+        counts = self.metrics.counts(resource_type, "write", "write")
+        wall, cpu = time.perf_counter(), time.thread_time()
+        self._emitters.write(resource_type, data)
+        counts[2] += time.perf_counter() - wall
+        counts[3] += time.thread_time() - cpu
+        # an input line is a memoryview of the mapped file
+        lines = (data if isinstance(data, bytes) else bytes(data)).count(b"\n")
+        counts[0] += lines
+        counts[1] += lines
+        self._wrote(resource_type, lines)
+
+    def adopt(self, resource_type, paths, length):
+        """Start the output for resource_type with the first `length` bytes of existing files."""
+        lines = sum(_.count(b"\n") for _ in read_range(paths, 0, length))
+        self._emitters.adopt(resource_type, paths, length)
+        self._wrote(resource_type, lines)
+
+    def _wrote(self, resource_type, lines):
+        written = self.metrics.written
+        written[resource_type] = written.get(resource_type, 0) + lines
+
+    def __getattr__(self, name):
+        # sizes, is_open, flush and close are the wrapped emitters'
+        return getattr(self._emitters, name)
+
+
+def span(metrics: RunMetrics | None, resource_type: str, stage: str):
+    """metrics.span, or nothing when metrics are not recorded."""
+    if metrics is None:
+        return contextlib.nullcontext()
+    return metrics.span(resource_type, stage)
+
+
+def _label(value) -> str:
+    """A Prometheus label value, escaped."""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def to_prometheus(report: dict, labels: dict[str, str]) -> str:
+    """The report in the Prometheus text format, for the node exporter's textfile collector.
+
+    The values are those of the last run, so they are gauges.
+    """
+    families: dict[str, tuple[str, list]] = {}
+
+    def add(name, help, value, **extra):
+        samples = families.setdefault(f"{PROMETHEUS_PREFIX}_{name}", (help, []))[1]
+        samples.append(({**labels, **extra}, value))
+
+    add("last_run_timestamp_seconds", "When the run finished", time.time())
+    add("wall_seconds", "Wall time of the run", report["wall_seconds"])
+    add("cpu_seconds", "CPU time of the run and its workers", report["cpu_seconds"])
+    add(
+        "peak_rss_bytes",
+        "Peak resident set size",
+        report["peak_rss_bytes"],
+        process="main",
+    )
+    add(
+        "peak_rss_bytes",
+        "Peak resident set size",
+        report["peak_rss_children_bytes"],
+        process="workers",
+    )
+    add(
+        "resources_per_second",
+        "Resources written per second",
+        report["resources_per_second"],
+    )
+    for unit, values in report["inputs"].items():
+        add("bytes_read", "Bytes of input read", values["bytes_read"], unit=unit)
+    for resource_type, values in report["resource_types"].items():
+        for name in ["resources_read", "resources_written", "bytes_written"]:
+            add(
+                name,
+                name.replace("_", " ").capitalize(),
+                values[name],
+                resource_type=resource_type,
+            )
+    for stage in report["stages"]:
+        keys = {"resource_type": stage["resource_type"], "stage": stage["stage"]}
+        add(
+            "stage_wall_seconds",
+            "Wall time spent in a stage",
+            stage["wall_seconds"],
+            **keys,
+        )
+        add(
+            "stage_cpu_seconds",
+            "CPU time spent in a stage",
+            stage["cpu_seconds"],
+            **keys,
+        )
+        add(
+            "stage_resources_in",
+            "Resources into a stage",
+            stage["resources_in"],
+            **keys,
+        )
+        add(
+            "stage_resources_out",
+            "Resources out of a stage",
+            stage["resources_out"],
+            **keys,
+        )
+        add("stage_dropped", "Resources a stage dropped", stage["dropped"], **keys)
+
+    lines = []
+    for name, (help, samples) in families.items():
+        lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} gauge")
+        for sample_labels, value in samples:
+            text = ",".join(f'{k}="{_label(v)}"' for k, v in sample_labels.items())
+            lines.append(f"{name}{{{text}}} {value!r}")
+    return "\n".join(lines) + "\n"
+
+
+def write_atomically(path, data: bytes):
+    """Write data to path through a temporary file, so a reader never sees part of it."""
+    path = pathlib.Path(path)
+    fd, tmp = tempfile.mkstemp(prefix=f".{path.name}.", dir=path.parent)
+    # mkstemp makes the file private, the node exporter runs as another user
+    umask = os.umask(0)
+    os.umask(umask)
+    os.chmod(tmp, 0o666 & ~umask)
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def save_metrics(report: dict, path=None, textfile=None, labels: dict | None = None):
+    """Write the report as JSON to path, and in the Prometheus text format to textfile."""
+    if path:
+        write_atomically(path, orjson.dumps(report, option=orjson.OPT_INDENT_2))
+    if textfile:
+        write_atomically(textfile, to_prometheus(report, labels or {}).encode())
@@ -0,0 +1,27 @@
+import functools
+import importlib
+from typing import Any
+
+# The fhir.resources package with the models of each FHIR version.
+FHIR_PACKAGES = {"R4": "fhir.resources.R4B", "R5": "fhir.resources"}
+
+
+@functools.cache
+def model_class(fhir_version: str, resource_type: str) -> Any:
+    """The fhir.resources model class of a resourceType.
+
+    fhir.resources, and the module of each model, are imported the first time they are needed,
+    so a command that doesn't validate, or `--help`, doesn't pay for them.
+    """
+    package = importlib.import_module(FHIR_PACKAGES[fhir_version])
+    return package.get_fhir_model_class(resource_type)
+
+
+def __getattr__(name: str) -> Any:
+    # `except models.ValidationError` imports pydantic only once there is an exception to match,
+    # by then a model has been loaded and pydantic with it
+    if name == "ValidationError":
+        from pydantic import ValidationError
+
+        return ValidationError
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,173 @@
+import mmap
+import os
+import pathlib
+import tempfile
+from typing import Iterator
+
+import numpy as np
+
+# The line offset index of `Type.ndjson` is cached in `Type.ndjson.idx`.
+INDEX_SUFFIX = ".idx"
+# The index starts with this, the size and the mtime_ns of the file it was built from.
+INDEX_MAGIC = int.from_bytes(b"NDJSONIX", "little")
+INDEX_HEADER = 3
+# Bytes scanned for newlines at a time, the scan allocates as many.
+SCAN_BYTES = 16 * 1024 * 1024
+# Line offsets converted to Python ints at a time while iterating.
+BATCH_LINES = 64 * 1024
+# The pages of the map behind the lines read are released every this many bytes, so a
+# read keeps a window of the file resident rather than all of it.
+RELEASE_BYTES = 16 * 1024 * 1024
+NEWLINE = ord("\n")
+
+
+def _map(path) -> mmap.mmap | None:
+    """Memory map a file for reading, None if it is empty."""
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return None
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _release(mm: mmap.mmap, start: int, stop: int) -> int:
+    """Drop the resident pages of the map in [start, stop) rounded down to a page, returns the new start.
+
+    A line still in use is read back from the file if it is accessed.
+    """
+    stop -= stop % mmap.PAGESIZE
+    if stop > start and hasattr(mmap, "MADV_DONTNEED"):
+        mm.madvise(mmap.MADV_DONTNEED, start, stop - start)
+    return max(start, stop)
+
+
+def _line_ends(mm: mmap.mmap, start: int, stop: int) -> Iterator[np.ndarray]:
+    """The offsets just past each line in [start, stop), a chunk at a time.
+
+    A last line without a newline ends at stop.
+    """
+    for chunk in range(start, stop, SCAN_BYTES):
+        count = min(SCAN_BYTES, stop - chunk)
+        data = np.frombuffer(mm, dtype=np.uint8, count=count, offset=chunk)
+        ends = np.flatnonzero(data == NEWLINE) + (chunk + 1)
+        del data
+        _release(mm, chunk - chunk % mmap.PAGESIZE, chunk + count)
+        if chunk + count == stop and (not len(ends) or ends[-1] != stop):
+            ends = np.append(ends, stop)
+        yield ends
+
+
+def index_path(path) -> pathlib.Path:
+    """The path of the line offset index of an NDJSON file."""
+    path = pathlib.Path(path)
+    return path.with_name(path.name + INDEX_SUFFIX)
+
+
+def _load_index(path, stat: os.stat_result) -> np.ndarray | None:
+    """The cached line offsets of path, None if there are none or they are stale."""
+    try:
+        index = np.memmap(index_path(path), dtype="<u8", mode="r")
+    except (OSError, ValueError):
+        return None
+    if len(index) <= INDEX_HEADER or index[:INDEX_HEADER].tolist() != [
+        INDEX_MAGIC,
+        stat.st_size,
+        stat.st_mtime_ns,
+    ]:
+        return None
+    return index[INDEX_HEADER:]
+
+
+def _save_index(path, stat: os.stat_result, offsets: np.ndarray):
+    """Cache the line offsets of path next to it, skipped if the directory is not writable."""
+    target = index_path(path)
+    try:
+        fd, tmp = tempfile.mkstemp(prefix=target.name, dir=target.parent)
+    except OSError:
+        return
+    with os.fdopen(fd, "wb") as f:
+        header = [INDEX_MAGIC, stat.st_size, stat.st_mtime_ns]
+        f.write(np.array(header, dtype="<u8").tobytes())
+        f.write(offsets.astype("<u8").tobytes())
+    os.replace(tmp, target)
+
+
+def line_offsets(path, cache: bool = True) -> np.ndarray:
+    """The offset of the start of each line of an NDJSON file, followed by the file size.
+
+    The offsets are cached in a `.idx` file next to it, and rebuilt if the file changed.
+    """
+    stat = os.stat(path)
+    if cache:
+        offsets = _load_index(path, stat)
+        if offsets is not None:
+            return offsets
+    mm = _map(path)
+    if mm is None:
+        offsets = np.zeros(1, dtype="<u8")
+    else:
+        offsets = np.concatenate(
+            [np.zeros(1, dtype="<u8"), *_line_ends(mm, 0, stat.st_size)]
+        ).astype("<u8")
+        mm.close()
+    if cache:
+        _save_index(path, stat, offsets)
+    return offsets
+
+
+def count_lines(path) -> int:
+    """The number of lines in an NDJSON file, from its index."""
+    return len(line_offsets(path)) - 1
+
+
+class LineReader:
+    """Iterate over the lines of a memory-mapped file from a byte offset, `position` is the offset reached.
+
+    Lines are memoryview slices of the map, with their newline, so they are passed to
+    `orjson.loads` without copies.  Lines can be read up to a byte offset `end`, and by line
+    number with `line`.  A cached `.idx` index is used if it is up to date, see `line_offsets`.
+    """
+
+    def __init__(self, path, offset: int = 0, end: int | None = None):
+        """Initialize the reader, nothing is read until it is iterated."""
+        self.path = path
+        self.position = offset
+        self.end = end
+
+    def __len__(self) -> int:
+        return count_lines(self.path)
+
+    def line(self, number: int) -> bytes:
+        """The line with this number, counting from 0."""
+        offsets = line_offsets(self.path)
+        start, end = offsets[number], offsets[number + 1]
+        with open(self.path, "rb") as f:
+            f.seek(int(start))
+            return f.read(int(end - start))
+
+    def _ends(self, mm: mmap.mmap, stop: int) -> Iterator[np.ndarray]:
+        """The offsets just past the lines to read, a batch at a time."""
+        offsets = _load_index(self.path, os.stat(self.path))
+        if offsets is None:
+            yield from _line_ends(mm, self.position, stop)
+            return
+        first = np.searchsorted(offsets, self.position, side="right")
+        last = np.searchsorted(offsets, stop, side="right") - 1
+        for batch in range(first, last + 1, BATCH_LINES):
+            yield offsets[batch : min(batch + BATCH_LINES, last + 1)]
+
+    def __iter__(self) -> Iterator[memoryview]:
+        mm = _map(self.path)
+        if mm is None:
+            return
+        stop = len(mm) if self.end is None else self.end
+        # the map is closed once the lines handed out are released
+        view = memoryview(mm)
+        start = self.position
+        released = start - start % mmap.PAGESIZE
+        for ends in self._ends(mm, stop):
+            for end in ends.tolist():
+                self.position = end
+                yield view[start:end]
+                start = end
+                if start - released >= RELEASE_BYTES:
+                    released = _release(mm, released, start)
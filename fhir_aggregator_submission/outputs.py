@@ -0,0 +1,75 @@
+import pathlib
+from typing import Iterator
+
+# Bytes copied at a time between output files.
+COPY_CHUNK = 1024 * 1024
+
+
+def part_name(resource_type: str, part: int = 0) -> str:
+    """The file name of a part of the output for resource_type, part 0 is the whole, unsplit output."""
+    if not part:
+        return f"{resource_type}.ndjson"
+    return f"{resource_type}.{part:04d}.ndjson"
+
+
+def parse_part_name(name: str) -> tuple[str, int]:
+    """The resourceType and part number of an output file name, e.g. `Observation.0002.ndjson` -> ("Observation", 2)."""
+    stem = name.removesuffix(".ndjson")
+    resource_type, _, part = stem.partition(".")
+    return resource_type, int(part) if part.isdigit() else 0
+
+
+def _numbered_parts(directory: pathlib.Path, resource_type: str) -> list[pathlib.Path]:
+    """The `Type.NNNN.ndjson` files in directory, in order."""
+    parts = []
+    for path in directory.glob(f"{resource_type}.*.ndjson"):
+        name, part = parse_part_name(path.name)
+        if name == resource_type and part:
+            parts.append((part, path))
+    return [path for _, path in sorted(parts)]
+
+
+def output_parts(directory, resource_type: str) -> list[pathlib.Path]:
+    """The files holding the output for resource_type, in order.
+
+    Either a single `Type.ndjson` or, once split with `--max-file-bytes`/`--max-file-lines`,
+    `Type.0001.ndjson`, `Type.0002.ndjson`, ...
+    """
+    directory = pathlib.Path(directory)
+    whole = directory / part_name(resource_type)
+    if whole.exists():
+        return [whole]
+    return _numbered_parts(directory, resource_type)
+
+
+def remove_outputs(directory, resource_type: str):
+    """Remove the output files for resource_type, whole or split."""
+    directory = pathlib.Path(directory)
+    (directory / part_name(resource_type)).unlink(missing_ok=True)
+    for path in _numbered_parts(directory, resource_type):
+        path.unlink()
+
+
+def output_size(directory, resource_type: str) -> int:
+    """The bytes of output for resource_type, over all its parts."""
+    return sum(path.stat().st_size for path in output_parts(directory, resource_type))
+
+
+def read_range(paths: list[pathlib.Path], offset: int, length: int) -> Iterator[bytes]:
+    """Read `length` bytes from `offset` of the concatenation of paths, in chunks."""
+    for path in paths:
+        size = path.stat().st_size
+        if offset >= size:
+            offset -= size
+            continue
+        with open(path, "rb") as f:
+            f.seek(offset)
+            while length > 0:
+                chunk = f.read(min(length, COPY_CHUNK))
+                if not chunk:
+                    break
+                length -= len(chunk)
+                yield chunk
+        offset = 0
+        if length <= 0:
+            return
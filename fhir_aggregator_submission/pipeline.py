@@ -0,0 +1,228 @@
+import queue
+import threading
+import time
+
+import orjson
+
+# Bytes of input lines handed from the reader thread at a time.
+READ_BATCH_BYTES = 1024 * 1024
+# Bytes of serialized resources, per resourceType, handed to the writer thread at a time.
+WRITE_BATCH_BYTES = 1024 * 1024
+# Batches a queue holds before the producer blocks.
+QUEUE_DEPTH = 16
+STAGES = ["read", "transform", "write"]
+
+_DONE = object()
+
+
+class PipelineStats:
+    """How long each stage of the pipeline was busy, as opposed to waiting on a queue."""
+
+    def __init__(self):
+        """Start the clock."""
+        self.started = time.perf_counter()
+        self.running = {stage: 0.0 for stage in STAGES}
+        self.waiting = {stage: 0.0 for stage in STAGES}
+
+    def utilisation(self) -> dict[str, float]:
+        """The fraction of the wall time each stage was busy."""
+        wall = time.perf_counter() - self.started
+        # the transform stage is the main thread, it runs for the whole run
+        running = {**self.running, "transform": wall}
+        return {
+            stage: (
+                max(0.0, running[stage] - self.waiting[stage]) / wall if wall else 0.0
+            )
+            for stage in STAGES
+        }
+
+    def report(self) -> str:
+        """A one line summary of the stage utilisation."""
+        utilisation = self.utilisation()
+        busiest = max(utilisation, key=lambda stage: utilisation[stage])
+        bound = "CPU" if busiest == "transform" else "I/O"
+        stages = ", ".join(f"{k} {v:.0%}" for k, v in utilisation.items())
+        return f"Pipeline utilisation: {stages} ({bound} bound)"
+
+
+def _put(q: queue.Queue, item, stop: threading.Event) -> bool:
+    """Put an item on a bounded queue, giving up if the consumer has stopped."""
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+class ThreadedReader:
+    """Read the lines of a LineReader in a background thread.
+
+    Lines are passed to the consumer in batches through a bounded queue.  `position` is the
+    offset after the last line the consumer has taken, not the one the thread has read.
+    """
+
+    def __init__(self, reader, stats: PipelineStats):
+        """Wrap reader, nothing is read until this is iterated."""
+        self.reader = reader
+        self.stats = stats
+        self.position = reader.position
+
+    def _produce(self, q: queue.Queue, stop: threading.Event):
+        """Thread: read batches of lines into the queue."""
+        started = time.perf_counter()
+        try:
+            batch: list[bytes] = []
+            batch_bytes = 0
+            for line in self.reader:
+                batch.append(line)
+                batch_bytes += len(line)
+                if batch_bytes >= READ_BATCH_BYTES:
+                    waited = time.perf_counter()
+                    if not _put(q, batch, stop):
+                        return
+                    self.stats.waiting["read"] += time.perf_counter() - waited
+                    batch, batch_bytes = [], 0
+            if batch:
+                _put(q, batch, stop)
+            _put(q, _DONE, stop)
+        except BaseException as e:
+            _put(q, e, stop)
+        finally:
+            self.stats.running["read"] += time.perf_counter() - started
+
+    def __iter__(self):
+        q: queue.Queue = queue.Queue(maxsize=QUEUE_DEPTH)
+        stop = threading.Event()
+        thread = threading.Thread(target=self._produce, args=(q, stop), daemon=True)
+        thread.start()
+        try:
+            while True:
+                waited = time.perf_counter()
+                batch = q.get()
+                self.stats.waiting["transform"] += time.perf_counter() - waited
+                if batch is _DONE:
+                    break
+                if isinstance(batch, BaseException):
+                    raise batch
+                for line in batch:
+                    self.position += len(line)
+                    yield line
+        finally:
+            stop.set()
+            thread.join()
+
+
+class PipelinedEmitters:
+    """Emitters that batch serialized resources per resourceType and write them in a background thread.
+
+    `sizes` counts the bytes handed to the emitter, `flush` waits until they are written.
+    """
+
+    def __init__(self, emitters, stats: PipelineStats):
+        """Wrap an Emitters, it is only used from the writer thread."""
+        self._emitters = emitters
+        self.stats = stats
+        self.sizes: dict[str, int] = {}
+        self._batches: dict[str, list[bytes]] = {}
+        self._batch_bytes: dict[str, int] = {}
+        self._queue: queue.Queue = queue.Queue(maxsize=QUEUE_DEPTH)
+        self._error: BaseException | None = None
+        self._thread: threading.Thread | None = threading.Thread(
+            target=self._consume, daemon=True
+        )
+        self._thread.start()
+
+    def _consume(self):
+        """Thread: write the batches."""
+        started = time.perf_counter()
+        while True:
+            waited = time.perf_counter()
+            item = self._queue.get()
+            self.stats.waiting["write"] += time.perf_counter() - waited
+            if item is _DONE:
+                self._queue.task_done()
+                break
+            resource_type, data = item
+            try:
+                if self._error is None:
+                    self._emitters.write(resource_type, data)
+            except BaseException as e:
+                self._error = e
+            self._queue.task_done()
+        self.stats.running["write"] += time.perf_counter() - started
+
+    def _check(self):
+        """Raise the writer thread's error, if any."""
+        if self._error is not None:
+            raise self._error
+
+    def _send(self, resource_type):
+        """Hand the batch for resource_type to the writer thread."""
+        batch = self._batches[resource_type]
+        if not batch:
+            return
+        self._check()
+        data = b"".join(batch)
+        self._batches[resource_type] = []
+        self._batch_bytes[resource_type] = 0
+        waited = time.perf_counter()
+        self._queue.put((resource_type, data))
+        self.stats.waiting["transform"] += time.perf_counter() - waited
+
+    def _drain(self):
+        """Wait until everything handed to the emitter is written."""
+        for resource_type in self._batches:
+            self._send(resource_type)
+        waited = time.perf_counter()
+        self._queue.join()
+        self.stats.waiting["transform"] += time.perf_counter() - waited
+        self._check()
+
+    def emit(self, resource):
+        """Write the resource to the output path."""
+        if resource:
+            self.write(
+                resource["resourceType"],
+                orjson.dumps(resource, option=orjson.OPT_APPEND_NEWLINE),
+            )
+
+    def write(self, resource_type, data):
+        """Write already serialized NDJSON lines for resource_type."""
+        if resource_type not in self.sizes:
+            self.sizes[resource_type] = 0
+            self._batches[resource_type] = []
+            self._batch_bytes[resource_type] = 0
+        self._batches[resource_type].append(data)
+        self.sizes[resource_type] += len(data)
+        self._batch_bytes[resource_type] += len(data)
+        if self._batch_bytes[resource_type] >= WRITE_BATCH_BYTES:
+            self._send(resource_type)
+
+    def is_open(self, resource_type) -> bool:
+        """True if output for resource_type has been started."""
+        return resource_type in self.sizes
+
+    def adopt(self, resource_type, paths, length):
+        """Start the output for resource_type with the first `length` bytes of existing files."""
+        self._drain()
+        self._emitters.adopt(resource_type, paths, length)
+        self.sizes[resource_type] = length
+        self._batches[resource_type] = []
+        self._batch_bytes[resource_type] = 0
+
+    def flush(self):
+        """Write the buffered output to disk."""
+        self._drain()
+        self._emitters.flush()
+
+    def close(self):
+        """Write the remaining batches, stop the writer thread and close the files."""
+        if self._thread is None:
+            return
+        self._drain()
+        self._queue.put(_DONE)
+        self._thread.join()
+        self._thread = None
+        self._emitters.close()
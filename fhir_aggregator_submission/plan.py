@@ -0,0 +1,149 @@
+import functools
+from typing import Callable
+
+from fhir_aggregator_submission.transform import (
+    R4_TRANSFORMERS,
+    dispatch_transformation,
+)
+
+# The keyword arguments each transformer reads, the others are not bound.
+TRANSFORMER_ARGUMENTS = {
+    "part-of": ["research_study_id"],
+    "r4": [],
+    "validate": [
+        "fhir_version",
+        "validation_cache",
+        "shape_sampler",
+        "validation_pool",
+        "on_error",
+    ],
+    "reseed": ["seed"],
+    "vocabulary": ["fhir_version"],
+}
+
+
+def has_part_of(resource: dict) -> bool:
+    """True if the resource already has the part-of-study extension, so part-of leaves it as is."""
+    for extension in resource.get("extension", ()):
+        if "part-of-study" in extension["url"]:
+            return True
+    return False
+
+
+def compile_tests(tests: list[Callable[[dict], bool]]) -> Callable[[dict], bool]:
+    """Combine tests into a single callable, true if they all are."""
+    if not tests:
+        return lambda resource: True
+    if len(tests) == 1:
+        return tests[0]
+    return lambda resource: all(test(resource) for test in tests)
+
+
+# Whether a transformer leaves a resource unchanged: True for those that only read it, or a
+# test of the resource.  The others, r4 and reseed, may change any resource they act on.
+UNCHANGED: dict[str, bool | Callable[[dict], bool]] = {
+    "part-of": has_part_of,
+    "validate": True,
+    "vocabulary": True,
+}
+
+
+def compile_stages(stages: list[Callable]) -> Callable[[dict], dict | None]:
+    """Chain the stages into a single callable, stopping when a stage drops the resource."""
+    if not stages:
+        return lambda resource: resource
+
+    def pipeline(resource):
+        for stage in stages:
+            resource = stage(resource)
+            if not resource:
+                return None
+        return resource
+
+    return pipeline
+
+
+class TransformerPlan(dict):
+    """The selected transformers, compiled into one pipeline per resourceType.
+
+    `plan[resource_type]` is a callable `resource -> resource | None` that runs only the
+    stages that act on that resourceType, with their arguments already bound.  Pipelines
+    are compiled the first time a resourceType is seen and reused after that.  With metrics,
+    see `metrics.RunMetrics`, each stage records its calls.
+    """
+
+    def __init__(self, transformer_map: dict[str, Callable], metrics=None, **kwargs):
+        """Initialize the plan from an ordered {name: transformer} map and the prep arguments."""
+        super().__init__()
+        self.transformer_map = transformer_map
+        self.metrics = metrics
+        self.kwargs = kwargs
+        # per resourceType, a test that the stages leave a resource unchanged, None if a stage may change it
+        self._unchanged: dict[str, Callable[[dict], bool] | None] = {}
+
+    def stages(self, resource_type: str) -> list[tuple[str, Callable]]:
+        """Return the (name, callable) stages that apply to resource_type."""
+        stages = []
+        for name, transformer in self.transformer_map.items():
+            if name == "part-of" and resource_type == "ResearchStudy":
+                # a study is not part of itself
+                continue
+            if transformer is dispatch_transformation:
+                if resource_type not in R4_TRANSFORMERS:
+                    continue
+                stages.append((name, R4_TRANSFORMERS[resource_type]))
+                continue
+            arguments = TRANSFORMER_ARGUMENTS.get(name, list(self.kwargs))
+            bound = {k: v for k, v in self.kwargs.items() if k in arguments}
+            stages.append(
+                (
+                    name,
+                    functools.partial(transformer, **bound) if bound else transformer,
+                )
+            )
+        return stages
+
+    def __missing__(self, resource_type: str) -> Callable[[dict], dict | None]:
+        stages = self.stages(resource_type)
+        if self.metrics is not None:
+            stages = [
+                (name, self.metrics.timed(resource_type, name, stage))
+                for name, stage in stages
+            ]
+        pipeline = compile_stages([stage for _, stage in stages])
+        self[resource_type] = pipeline
+        return pipeline
+
+    def __call__(self, resource: dict) -> dict | None:
+        """Run the resource through the pipeline for its resourceType."""
+        return self[resource["resourceType"]](resource)
+
+    def unchanged(self, resource: dict) -> bool:
+        """True if no stage will change the resource, so its input line can be written as is.
+
+        Call before running the resource through the pipeline.
+        """
+        resource_type = resource["resourceType"]
+        if resource_type not in self._unchanged:
+            stages = [
+                UNCHANGED.get(name, False) for name, _ in self.stages(resource_type)
+            ]
+            self._unchanged[resource_type] = (
+                None
+                if False in stages
+                else compile_tests([test for test in stages if callable(test)])
+            )
+        test = self._unchanged[resource_type]
+        return test is not None and test(resource)
+
+    def explain(self, resource_types: list[str]) -> str:
+        """Describe the pipeline for each resourceType."""
+        lines = []
+        for resource_type in resource_types:
+            names = []
+            for name, stage in self.stages(resource_type):
+                if name == "r4":
+                    name = f"r4 ({stage.__name__})"
+                names.append(name)
+            lines.append(f"{resource_type}: {' -> '.join(names) or '(passthrough)'}")
+        return "\n".join(lines)
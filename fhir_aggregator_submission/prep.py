@@ -1,4 +1,4 @@
-import importlib
+import os
 import pathlib
 import sys
 from urllib.parse import urlparse
@@ -6,23 +6,67 @@ import uuid
 import mimetypes
 from typing import Generator, Any
 from click_default_group import DefaultGroup
+import numpy as np
 import orjson
 
 import click
 from halo import Halo
-from nested_lookup import nested_lookup, nested_alter
-from pydantic import ValidationError
 
+from fhir_aggregator_submission import models
+from fhir_aggregator_submission.assay_index import DEFAULT_MEMORY_BUDGET, SpillingIndex
+from fhir_aggregator_submission.checkpoint import (
+    DEFAULT_INTERVAL,
+    Checkpoint,
+    CheckpointError,
+    input_stats,
+)
+from fhir_aggregator_submission.errors import ERRORS_NAME, ErrorReport
+from fhir_aggregator_submission.fingerprint import DEFAULT_SAMPLE_RATE, ShapeSampler
+from fhir_aggregator_submission.incremental import (
+    ASSAY,
+    RunManifest,
+    Unit,
+    UnitSummary,
+    plan_units,
+)
+from fhir_aggregator_submission.metrics import (
+    MeteredEmitters,
+    RunMetrics,
+    save_metrics,
+    span,
+)
+from fhir_aggregator_submission.pipeline import (
+    PipelinedEmitters,
+    PipelineStats,
+    ThreadedReader,
+)
+from fhir_aggregator_submission.ndjson import LineReader
+from fhir_aggregator_submission.outputs import (
+    COPY_CHUNK,
+    output_parts,
+    part_name,
+    remove_outputs,
+)
+from fhir_aggregator_submission.plan import TransformerPlan
+from fhir_aggregator_submission.structural import StructuralSampler
+from fhir_aggregator_submission.trace import Tracer, traced
+from fhir_aggregator_submission.references import (
+    INDEX_NAME,
+    ReferenceIndex,
+    load_indexes,
+    replace_references,
+    save_index,
+)
 from fhir_aggregator_submission.transform import dispatch_transformation
+from fhir_aggregator_submission.validation_cache import (
+    CACHE_ENV,
+    ValidationCache,
+    resource_key,
+)
 from fhir_aggregator_submission.vocabulary import VocabularyCollector
 
 DEFAULT_TRANSFORMERS = "assay,r4,part-of,vocabulary,validate"
 
-# Import the R4 classes
-FHIR_R4_CLASSES = importlib.import_module("fhir.resources.R4B")
-FHIR_R5_CLASSES = importlib.import_module("fhir.resources")
-
-
 # Add additional mimetypes
 mimetypes.add_type("text/x-r", ".R", strict=True)
 mimetypes.add_type("text/x-r", ".r", strict=True)
@@ -75,10 +119,27 @@ def cli():
 
 
 class Emitters:
-    """Write the resource to the output path."""
+    """Write the resource to the output path.
 
-    def __init__(self, output_path):
-        self._files = {}
+    With max_bytes or max_lines, the output for a resourceType rolls over to a new file
+    before a line that would exceed either limit (a single line larger than max_bytes gets
+    a file of its own).  Once it rolls over, `Type.ndjson` is renamed `Type.0001.ndjson` and
+    the following lines go to `Type.0002.ndjson`, ...  Files are only split between lines,
+    however the data is chunked in calls to `write`.
+    """
+
+    def __init__(
+        self, output_path, max_bytes: int | None = None, max_lines: int | None = None
+    ):
+        self._files: dict[str, Any] = {}
+        # bytes written so far, per resourceType, over all its parts
+        self.sizes: dict[str, int] = {}
+        # per resourceType: [part number, bytes, lines] of the file being written
+        self._parts: dict[str, list[int]] = {}
+        # the start of a line not yet seen in full, per resourceType, held until the rest is written
+        self._tails: dict[str, bytes] = {}
+        self._max_bytes = max_bytes
+        self._max_lines = max_lines
         if not isinstance(output_path, pathlib.Path):
             output_path = pathlib.Path(output_path)
         self._output_path = output_path
@@ -86,18 +147,133 @@ class Emitters:
     def emit(self, resource):
         """Write the resource to the output path."""
         if resource:
-            if resource["resourceType"] not in self._files:
-                self._files[resource["resourceType"]] = open(
-                    self._output_path / f"{resource['resourceType']}.ndjson", "wb"
-                )
-                # print("Opening file", self._files[resource["resourceType"]].name, file=sys.stderr)
+            self.write(
+                resource["resourceType"],
+                orjson.dumps(resource, option=orjson.OPT_APPEND_NEWLINE),
+            )
+
+    def write(self, resource_type, data):
+        """Write already serialized NDJSON lines for resource_type."""
+        if resource_type not in self._files:
+            # including parts left by a previous run that was split differently
+            remove_outputs(self._output_path, resource_type)
+            self._files[resource_type] = open(
+                self._output_path / part_name(resource_type), "wb"
+            )
+            self.sizes[resource_type] = 0
+            self._parts[resource_type] = [0, 0, 0]
+        self.sizes[resource_type] += len(data)
+        if not (self._max_bytes or self._max_lines):
+            self._files[resource_type].write(data)
+            return
+        self._write_parts(resource_type, data)
+
+    def _write_parts(self, resource_type, data):
+        """Write whole lines, rolling over to a new part before a line that does not fit."""
+        tail = self._tails.pop(resource_type, b"")
+        if not isinstance(data, bytes):
+            data = bytes(data)
+        if tail:
+            data = tail + data
+        end = data.rfind(b"\n") + 1
+        if end < len(data):
+            self._tails[resource_type] = data[end:]
+        view = memoryview(data)
+        position = 0
+        while position < end:
+            part = self._parts[resource_type]
+            stop = end
+            if self._max_bytes and part[1] + stop - position > self._max_bytes:
+                room = max(self._max_bytes - part[1], 0)
+                stop = data.rfind(b"\n", position, position + room) + 1
+                if stop <= position:
+                    if part[1]:
+                        self._roll_over(resource_type)
+                        continue
+                    # a line larger than max_bytes, on its own
+                    stop = data.find(b"\n", position) + 1
+            lines = data.count(b"\n", position, stop)
+            if self._max_lines and part[2] + lines > self._max_lines:
+                room = self._max_lines - part[2]
+                if not room:
+                    self._roll_over(resource_type)
+                    continue
+                stop = position
+                for _ in range(room):
+                    stop = data.find(b"\n", stop) + 1
+                lines = room
+            self._files[resource_type].write(view[position:stop])
+            part[1] += stop - position
+            part[2] += lines
+            position = stop
+
+    def _roll_over(self, resource_type):
+        """Close the file being written for resource_type and start the next part."""
+        part = self._parts[resource_type]
+        self._files[resource_type].close()
+        if part[0] == 0:
+            os.replace(
+                self._output_path / part_name(resource_type),
+                self._output_path / part_name(resource_type, 1),
+            )
+            part[0] = 1
+        part[0] += 1
+        part[1] = part[2] = 0
+        self._files[resource_type] = open(
+            self._output_path / part_name(resource_type, part[0]), "wb"
+        )
 
-            self._files[resource["resourceType"]].write(
-                orjson.dumps(resource, option=orjson.OPT_APPEND_NEWLINE)
+    def is_open(self, resource_type) -> bool:
+        """True if output for resource_type has been started."""
+        return resource_type in self._files
+
+    def adopt(self, resource_type, paths, length):
+        """Start the output for resource_type with the first `length` bytes of existing files.
+
+        paths are the parts of an output, see `outputs.output_parts`, they are moved into the
+        output path and the ones past `length` are removed.
+        """
+        assert not self.is_open(resource_type), f"{resource_type} already started"
+        kept = []
+        remaining = length
+        for path in paths:
+            if kept and remaining <= 0:
+                path.unlink()
+                continue
+            kept.append(path)
+            remaining -= path.stat().st_size
+        last = 0 if len(kept) == 1 else len(kept)
+        for number, path in enumerate(kept, start=1):
+            os.replace(
+                path, self._output_path / part_name(resource_type, last and number)
             )
+        target = self._output_path / part_name(resource_type, last)
+        file = open(target, "r+b")
+        # remaining is <= 0, the bytes of the last part past length
+        part_bytes = file.seek(0, os.SEEK_END) + min(remaining, 0)
+        file.truncate(part_bytes)
+        file.seek(part_bytes)
+        part_lines = 0
+        if self._max_lines:
+            with open(target, "rb") as f:
+                part_lines = sum(
+                    _.count(b"\n") for _ in iter(lambda: f.read(COPY_CHUNK), b"")
+                )
+        self._files[resource_type] = file
+        self.sizes[resource_type] = length
+        self._parts[resource_type] = [last, part_bytes, part_lines]
+
+    def flush(self):
+        """Write the buffered output to disk."""
+        for file in self._files.values():
+            file.flush()
+            os.fsync(file.fileno())
 
     def close(self):
         """Close the open files."""
+        for resource_type, tail in self._tails.items():
+            self._files[resource_type].write(tail)
+        self._tails = {}
         for file in self._files.values():
             # print("Closing file", file.name, file=sys.stderr)
             file.close()
@@ -108,42 +284,83 @@ class Emitters:
         self.close()
 
 
-REFERENCES = []
-IDS = []
+# the ids and references seen by validate, checked by validate_references
+REFERENCE_INDEX = ReferenceIndex()
 
 
-def validate(resource, fhir_version, *args, **kwargs):
-    """Validate the resource."""
-    klasses = FHIR_R5_CLASSES if fhir_version == "R5" else FHIR_R4_CLASSES
-    klass = klasses.get_fhir_model_class(resource["resourceType"])
-    try:
-        klass.model_validate(resource)
-        if "id" not in resource:
-            raise AttributeError(f"Resource {resource['resourceType']} has no id")
-    except (ValidationError, AttributeError) as e:
-        ignore = False
-        # # ignore the error about attachment.size, R4 has it as an unsignedInt, R5 has it as an integer64
-        # if e.errors():
-        #     errors = e.errors()
-        #     if len(errors) == 1 and 'loc' in e.errors()[0] and e.errors()[0]['loc'] == ('content', 0, 'attachment', 'size'):
-        #         ignore = True
-        if not ignore:
-            click.echo(
-                f"Validation error: {fhir_version} {klass} {e}\n{orjson.dumps(resource, option=orjson.OPT_INDENT_2).decode('utf-8')}"
-            )
+def validation_error(
+    resource, fhir_version, validation_cache=None, shape_sampler=None
+) -> Exception | None:
+    """Validate the resource, unless it passed validation before and is in the validation_cache.
+
+    With a shape_sampler, only the resources it picks are validated in full.  Returns the
+    error of a resource that fails validation, None if it passes.
+    """
+    key = resource_key(resource) if validation_cache is not None else None
+    skip = key is not None and key in validation_cache
+    if not skip and shape_sampler is not None:
+        # a resource checked by its shape is not cached, it was not validated in full
+        skip = shape_sampler.check(resource)
+    if not skip:
+        klass = models.model_class(
+            "R5" if fhir_version == "R5" else "R4", resource["resourceType"]
+        )
+        try:
+            klass.model_validate(resource)
+            if "id" not in resource:
+                raise AttributeError(f"Resource {resource['resourceType']} has no id")
+        except (models.ValidationError, AttributeError) as e:
+            ignore = False
+            # # ignore the error about attachment.size, R4 has it as an unsignedInt, R5 has it as an integer64
+            # if e.errors():
+            #     errors = e.errors()
+            #     if len(errors) == 1 and 'loc' in e.errors()[0] and e.errors()[0]['loc'] == ('content', 0, 'attachment', 'size'):
+            #         ignore = True
+            if not ignore:
+                return e
+        if key is not None:
+            validation_cache.add(key)
+        if shape_sampler is not None:
+            # only the shape of a resource that passed is trusted, see ShapeSampler.learn
+            shape_sampler.learn(resource)
+    return None
+
+
+def error_message(resource, fhir_version, error: Exception) -> str:
+    """The message of a resource that failed validation, with the resource."""
+    klass = models.model_class(
+        "R5" if fhir_version == "R5" else "R4", resource["resourceType"]
+    )
+    return f"Validation error: {fhir_version} {klass} {error}\n{orjson.dumps(resource, option=orjson.OPT_INDENT_2).decode('utf-8')}"
+
+
+def validate(
+    resource,
+    fhir_version,
+    *args,
+    validation_cache=None,
+    shape_sampler=None,
+    validation_pool=None,
+    on_error="exit",
+    **kwargs,
+):
+    """Validate the resource and collect its id and references, exit if it fails validation.
+
+    With on_error="collect", a resource that fails validation is added to the ERROR_REPORT
+    instead, and processing continues.  With a validation_pool, the resource is validated by
+    a worker process in the background.
+    """
+    if validation_pool is not None:
+        validation_pool.submit(resource)
+        return resource
+    error = validation_error(resource, fhir_version, validation_cache, shape_sampler)
+    if error:
+        if on_error != "collect":
+            click.echo(error_message(resource, fhir_version, error))
             exit(1)
+        ERROR_REPORT.add(resource, error)
 
-    IDS.append(f"{resource['resourceType']}/{resource['id']}")
-    for _ in nested_lookup("reference", resource):
-        if isinstance(_, str):
-            REFERENCES.append(_)
-        elif isinstance(_, dict):
-            # https://www.hl7.org/fhir/medicationrequest-definitions.html#MedicationRequest.medication
-            # is a reference to a Medication resource https://www.hl7.org/fhir/references.html#CodeableReference
-            # so it has a reference.reference form, strip it out
-            REFERENCES.append(_["reference"])
-        else:
-            raise ValueError(f"Invalid reference type: {type(_)}")
+    REFERENCE_INDEX.add_resource(resource)
     return resource
 
 
@@ -152,34 +369,183 @@ def reseed(resource, seed, *args, **kwargs):
     resource["id"] = str(uuid.uuid5(uuid.NAMESPACE_DNS, resource["id"] + seed))
 
     def callback(reference):
-        if isinstance(reference, dict):
-            return reference
         resource_type, resource_id = reference.split("/")
         return (
             f"{resource_type}/{str(uuid.uuid5(uuid.NAMESPACE_DNS, resource_id + seed))}"
         )
 
-    resource = nested_alter(resource, "reference", callback)
+    return replace_references(resource, callback)
 
-    return resource
 
+def validate_references(
+    output_path=None, reference_indexes=(), *args, on_error="exit", **kwargs
+):
+    """Validate the references, the dangling ones are reported by resourceType and path.
 
-def validate_references(*args, **kwargs):
-    """Validate the references."""
-    references = set(REFERENCES)
-    ids = set(IDS)
-    if not references.issubset(ids):
-        _ = Exception(f"references not found {references - ids}")
-        click.echo(f"references not found {references - ids}")
+    References may also resolve to the ids of previously prepped studies, found in the
+    index files or directories of reference_indexes.  Examples of the dangling references
+    are read back from the output files in output_path.  With on_error="collect", they are
+    added to the ERROR_REPORT rather than exiting.
+    """
+    indexes = load_indexes(reference_indexes, exclude=output_path)
+    dangling = REFERENCE_INDEX.dangling(indexes.values())
+    if len(dangling) and on_error == "collect":
+        for group in REFERENCE_INDEX.groups(dangling, output_path):
+            ERROR_REPORT.add_references(*group)
+    elif len(dangling):
+        click.echo(REFERENCE_INDEX.report(dangling, output_path))
         exit(1)
 
 
 VOCABULARY_COLLECTOR = VocabularyCollector()
+# the resources that failed validation, with --on-error collect
+ERROR_REPORT = ErrorReport()
 
 
-def vocabulary(resource, *args, **kwargs):
+def reset_collectors():
+    """Clear the state collected by validate and vocabulary."""
+    global VOCABULARY_COLLECTOR, ERROR_REPORT
+    REFERENCE_INDEX.close()
+    VOCABULARY_COLLECTOR = VocabularyCollector()
+    ERROR_REPORT = ErrorReport()
+
+
+def vocabulary(resource, *args, fhir_version=None, **kwargs):
     """Collect the vocabulary."""
-    return VOCABULARY_COLLECTOR.collect(resource)
+    return VOCABULARY_COLLECTOR.collect(resource, fhir_version)
+
+
+TRANSFORMERS = {
+    "part-of": apply_part_of,
+    "r4": dispatch_transformation,
+    "validate": validate,
+    "reseed": reseed,
+    "vocabulary": vocabulary,
+}
+
+
+def get_transformer_map(transformers: list[str]) -> dict:
+    """Select the requested transformers, in pipeline order."""
+    return {k: v for k, v in TRANSFORMERS.items() if k in transformers}
+
+
+def collect_unit(
+    resources,
+    plan,
+    emitters,
+    on_emit=None,
+    on_progress=None,
+    on_failure=None,
+    partial: UnitSummary | None = None,
+    validation_pool=None,
+) -> UnitSummary:
+    """Transform and emit the resources of a unit, returning what they added to the collectors.
+
+    resources are (resource, input line or None) pairs.  A resource that no stage changes is
+    written as its input line, rather than serialized again.  on_progress is called after each
+    resource and on_failure if processing raises.  Pass the `partial` summary of an interrupted
+    unit to continue it.  The resources submitted to a `validation_pool` are validated before
+    the summary is collected.
+    """
+    global VOCABULARY_COLLECTOR, ERROR_REPORT
+    ids_start = len(REFERENCE_INDEX.ids)
+    references_start = len(REFERENCE_INDEX.references)
+    # collect the unit's vocabulary and errors on their own, then fold them into the run's
+    run_collector, VOCABULARY_COLLECTOR = VOCABULARY_COLLECTOR, VocabularyCollector()
+    run_errors, ERROR_REPORT = ERROR_REPORT, ErrorReport()
+    emitted: dict[str, None] = {}
+    if partial:
+        emitted.update(dict.fromkeys(partial.emitted))
+        REFERENCE_INDEX.extend(partial.ids, partial.references, partial.sources)
+        VOCABULARY_COLLECTOR = partial.vocabulary
+        ERROR_REPORT = partial.errors or ErrorReport()
+    try:
+        for resource, line in resources:
+            unchanged = line is not None and plan.unchanged(resource)
+            resource = plan(resource)
+            if resource:
+                if unchanged:
+                    emitters.write(resource["resourceType"], passthrough(line))
+                else:
+                    emitters.emit(resource)
+                emitted[resource["resourceType"]] = None
+                if on_emit:
+                    on_emit(resource)
+            if on_progress:
+                on_progress()
+        if validation_pool is not None:
+            validation_pool.drain()
+        unit_collector, unit_errors = VOCABULARY_COLLECTOR, ERROR_REPORT
+    except BaseException:
+        if on_failure:
+            on_failure()
+        raise
+    finally:
+        VOCABULARY_COLLECTOR = run_collector.merge(VOCABULARY_COLLECTOR)
+        ERROR_REPORT = run_errors.merge(ERROR_REPORT)
+    ids = REFERENCE_INDEX.ids.to_array(ids_start)
+    references = REFERENCE_INDEX.references.to_array(references_start)
+    sources = {
+        key: REFERENCE_INDEX.sources[key]
+        for key in np.unique(references["source"]).tolist()
+    }
+    if partial:
+        sources.update(partial.sources)
+    return UnitSummary(
+        list(emitted), ids, references, sources, unit_collector, unit_errors
+    )
+
+
+def passthrough(line: bytes | memoryview) -> bytes | memoryview:
+    """An input line as an output line: without surrounding whitespace, ending with a newline."""
+    if line[-2:] == b"}\n" and line[:1] == b"{":
+        return line
+    return bytes(line).strip() + b"\n"
+
+
+def merge_summary(summary: UnitSummary):
+    """Add a unit processed elsewhere (a worker or a previous run) to the collectors."""
+    REFERENCE_INDEX.extend(summary.ids, summary.references, summary.sources)
+    VOCABULARY_COLLECTOR.merge(summary.vocabulary)
+    if summary.errors:
+        ERROR_REPORT.merge(summary.errors)
+
+
+def unit_resources(
+    unit: Unit, input_path, transformers, fhir_version, reader=None
+) -> Generator[tuple[dict, bytes | None], None, None]:
+    """Yield the input resources of a unit and their lines, a file unit is read with `reader` if given.
+
+    Assays are created, they have no input line.
+    """
+    if unit.name == ASSAY:
+        for resource in create_assays(fhir_version, input_path):
+            yield resource, None
+        return
+    for path in unit.inputs:
+        yield from load_resources(reader or LineReader(path), transformers)
+
+
+def load_resources(lines, transformers) -> Generator[tuple[dict, bytes], None, None]:
+    """Parse NDJSON lines, skipping _existing_ vocabulary Observations if they will be recreated.
+
+    Yields each resource with the line it was parsed from.
+    """
+    for line in lines:
+        resource = orjson.loads(line)
+        if "vocabulary" in transformers:
+            # skip _existing_ vocabulary  Observations
+            if is_vocabulary_observation(resource):
+                continue
+        yield resource, line
+
+
+def is_vocabulary_observation(resource) -> bool:
+    """True if the resource is an Observation created by the vocabulary collector."""
+    return (
+        resource["resourceType"] == "Observation"
+        and resource["code"]["coding"][0]["code"] == "vocabulary"
+    )
 
 
 @cli.command(name="prep")
@@ -203,13 +569,148 @@ def vocabulary(resource, *args, **kwargs):
     default="R5",
     help="Validate this version of FHIR resources",
 )
-def prep(input_path, output_path, transformers, seed, fhir_version):
+@click.option(
+    "--workers",
+    required=False,
+    default=1,
+    show_default=True,
+    type=click.IntRange(min=1),
+    help="Number of worker processes.  With more than one worker the input files are split into shards and processed in parallel",
+)
+@click.option(
+    "--explain",
+    is_flag=True,
+    default=False,
+    help="Show the transformers that will run for each resourceType and exit",
+)
+@click.option(
+    "--incremental",
+    is_flag=True,
+    default=False,
+    help="Keep a manifest in OUTPUT_PATH and skip input files that are unchanged since the last run",
+)
+@click.option(
+    "--resume",
+    is_flag=True,
+    default=False,
+    help="Continue an interrupted run from its last checkpoint in OUTPUT_PATH",
+)
+@click.option(
+    "--checkpoint-interval",
+    required=False,
+    default=None,
+    type=click.FloatRange(min=0),
+    help=f"Seconds between checkpoints, so an interrupted run can be resumed.  Off by default, a --resume run checkpoints every {DEFAULT_INTERVAL} seconds unless set",
+)
+@click.option(
+    "--max-file-bytes",
+    required=False,
+    default=None,
+    type=click.IntRange(min=1),
+    help="Split the output for a resourceType into Type.0001.ndjson, Type.0002.ndjson, ... of at most this many bytes, so they can be imported in parallel",
+)
+@click.option(
+    "--max-file-lines",
+    required=False,
+    default=None,
+    type=click.IntRange(min=1),
+    help="Split the output for a resourceType into files of at most this many resources",
+)
+@click.option(
+    "--reference-index",
+    "reference_indexes",
+    multiple=True,
+    type=click.Path(exists=True),
+    help=f"An index file, or a directory of prepped outputs containing {INDEX_NAME} files, whose ids references may resolve to.  Repeatable",
+)
+@click.option(
+    "--pipeline",
+    is_flag=True,
+    default=False,
+    help="Read, transform and write in separate threads connected by bounded queues, and report how busy each stage was",
+)
+@click.option(
+    "--validation-cache/--no-validation-cache",
+    default=False,
+    show_default=True,
+    help=f"Skip validating the resources that passed validation in an earlier --validation-cache run, they are remembered in ${CACHE_ENV} (default: ~/.cache/fhir-aggregator-submission)",
+)
+@click.option(
+    "--validate-mode",
+    type=click.Choice(["full", "fingerprint", "structural"]),
+    default="full",
+    show_default=True,
+    help="full: validate every resource.  fingerprint: validate the first resource of each shape (key paths and value types) and a sample of the rest in full, check the ids, references and dates of the others.  structural: check each resource with a validator generated from its fhir.resources model (required elements, cardinality, primitive formats, choice types and references), validate the ones it doesn't pass and a sample of the rest in full",
+)
+@click.option(
+    "--validate-sample",
+    default=DEFAULT_SAMPLE_RATE,
+    show_default=True,
+    type=click.FloatRange(min=0, max=1),
+    help="With --validate-mode fingerprint, the fraction of resources of an already validated shape that are still validated in full; with structural, of the resources that passed their structural check",
+)
+@click.option(
+    "--validate-workers",
+    default=0,
+    show_default=True,
+    type=click.IntRange(min=0),
+    help="Validate in this many worker processes, in batches, while prep reads and transforms.  0 validates in prep's process.  Not with --workers",
+)
+@click.option(
+    "--on-error",
+    type=click.Choice(["exit", "collect"]),
+    default="exit",
+    show_default=True,
+    help=f"exit: stop at the first resource that fails validation, or dangling references.  collect: continue, write the failing resources and their error locations, and the dangling references, to OUTPUT_PATH/{ERRORS_NAME} (JSON lines, not a FHIR .ndjson file) and exit non-zero at the end",
+)
+@click.option(
+    "--metrics",
+    "metrics_path",
+    type=click.Path(dir_okay=False),
+    help="Write the wall and CPU time, resources in and out per resourceType and stage, bytes read and written and peak RSS of the run to this JSON file",
+)
+@click.option(
+    "--metrics-textfile",
+    type=click.Path(dir_okay=False),
+    help="Write the run metrics to this file in the Prometheus text format, for the node exporter's textfile collector",
+)
+@click.option(
+    "--trace",
+    "trace_path",
+    type=click.Path(dir_okay=False),
+    help="Write spans of the run, per input file, assay build, batch of transformer calls, vocabulary and reference validation, to this file as Chrome trace events, see https://ui.perfetto.dev",
+)
+def prep(
+    input_path,
+    output_path,
+    transformers,
+    seed,
+    fhir_version,
+    workers,
+    explain,
+    incremental,
+    resume,
+    checkpoint_interval,
+    max_file_bytes,
+    max_file_lines,
+    reference_indexes,
+    pipeline,
+    validation_cache,
+    validate_mode,
+    validate_sample,
+    validate_workers,
+    on_error,
+    metrics_path,
+    metrics_textfile,
+    trace_path,
+):
     """Run a set of transformations on the input META directory.
 
     \b
     INPUT_PATH META directory containing the input NDJSON files
     OUTPUT_PATH the output META directory
     """
+    global VOCABULARY_COLLECTOR, ERROR_REPORT
     if not pathlib.Path(output_path).exists():
         pathlib.Path(output_path).mkdir(parents=True, exist_ok=True)
 
@@ -223,24 +724,18 @@ def prep(input_path, output_path, transformers, seed, fhir_version):
     #     transformers = 'assay,part-of,reseed,validate,validate_references'
 
     transformers = transformers.split(",")
-    emitters = Emitters(output_path)
+    metrics = RunMetrics() if metrics_path or metrics_textfile else None
+    tracer = Tracer() if trace_path else None
+    reset_collectors()
+    emitters = Emitters(output_path, max_bytes=max_file_bytes, max_lines=max_file_lines)
 
     research_study = pathlib.Path(input_path) / "ResearchStudy.ndjson"
     with open(research_study, "r") as research_study_file:
         research_study = orjson.loads(research_study_file.readline().strip())
         research_study_id = research_study["id"]
 
-    transformer_map = {
-        "part-of": apply_part_of,
-        "r4": dispatch_transformation,
-        "validate": validate,
-        "reseed": reseed,
-        "vocabulary": vocabulary,
-    }
-    known_transformers = set(transformer_map.keys())
-    for k in known_transformers:
-        if k not in transformers:
-            del transformer_map[k]
+    transformer_map = get_transformer_map(transformers)
+    known_transformers = set(TRANSFORMERS.keys())
 
     if not set(list(transformer_map.keys())) == set(transformers):
         unknown_transformers = set(transformers) - known_transformers
@@ -256,8 +751,151 @@ def prep(input_path, output_path, transformers, seed, fhir_version):
             f"reseed specified, please specify --seed", file=sys.stderr, fg="red"
         )
         exit(1)
+    if validate_workers and workers > 1:
+        click.secho(
+            "--validate-workers validates in a single process run, not with --workers",
+            file=sys.stderr,
+            fg="red",
+        )
+        exit(1)
+
+    validation_cache = (
+        ValidationCache(fhir_version)
+        if validation_cache and "validate" in transformers
+        else None
+    )
+    shape_sampler: ShapeSampler | StructuralSampler | None = None
+    if "validate" in transformers and validate_mode == "fingerprint":
+        shape_sampler = ShapeSampler(validate_sample)
+    elif "validate" in transformers and validate_mode == "structural":
+        shape_sampler = StructuralSampler(fhir_version, validate_sample)
+    validation_pool = None
+    if validate_workers and "validate" in transformers and not explain:
+        from fhir_aggregator_submission.validation_pool import ValidationPool
+
+        validation_pool = ValidationPool(
+            fhir_version, validate_workers, validation_cache, shape_sampler, on_error
+        )
+    plan = TransformerPlan(
+        transformer_map,
+        research_study_id=research_study_id,
+        fhir_version=fhir_version,
+        seed=seed,
+        validation_cache=validation_cache,
+        shape_sampler=shape_sampler,
+        validation_pool=validation_pool,
+        on_error=on_error,
+        metrics=metrics,
+    )
+    if explain:
+        resource_types = []
+        if "assay" in transformers:
+            resource_types.extend(["ServiceRequest", "DocumentReference", "Group"])
+        for path in pathlib.Path(input_path).glob("*.ndjson"):
+            if path.stem not in resource_types:
+                resource_types.append(path.stem)
+        click.echo(plan.explain(resource_types))
+        return
+
+    stats = None
+    if pipeline:
+        stats = PipelineStats()
+        emitters = PipelinedEmitters(emitters, stats)
+    if metrics:
+        emitters = MeteredEmitters(emitters, metrics)
+
+    units = plan_units(input_path, transformers)
+    settings = dict(
+        transformers=transformers,
+        seed=seed,
+        fhir_version=fhir_version,
+        research_study_id=research_study_id,
+    )
+    # how the output is split changes the files reused by --incremental and --resume,
+    # recorded only when set so manifests of unsplit runs stay valid
+    for name, value in [
+        ("max_file_bytes", max_file_bytes),
+        ("max_file_lines", max_file_lines),
+    ]:
+        if value:
+            settings[name] = value
+    # output validated by sampling, or skipped as cached, is not reused by a run that validates
+    # every resource, recorded only when set so manifests of fully validated runs stay valid
+    if "validate" in transformers:
+        if validate_mode != "full":
+            settings["validate_mode"] = validate_mode
+            settings["validate_sample"] = validate_sample
+        if validation_cache is not None:
+            settings["validation_cache"] = True
+    # the settings include the validation ones, the checkpointed output is not validated again
+    checkpoint = Checkpoint(
+        output_path,
+        settings=dict(
+            settings,
+            input_path=str(pathlib.Path(input_path).resolve()),
+            workers=workers,
+            incremental=incremental,
+            # a run that collects errors resumes with the errors collected so far
+            **({"on_error": on_error} if on_error != "exit" else {}),
+        ),
+        inputs=input_stats(input_path),
+        index=REFERENCE_INDEX,
+        # only runs that may be resumed pay for checkpoints
+        interval=(
+            checkpoint_interval
+            if checkpoint_interval is not None
+            else DEFAULT_INTERVAL if resume else 0
+        ),
+    )
+    if resume:
+        try:
+            state = checkpoint.resume(emitters)
+        except CheckpointError as e:
+            click.secho(str(e), file=sys.stderr, fg="red")
+            exit(1)
+        VOCABULARY_COLLECTOR = checkpoint.vocabulary
+        ERROR_REPORT = checkpoint.errors
+        manifest = RunManifest(
+            output_path, settings, enabled=incremental, state=state["manifest"]
+        )
+        checkpoint.manifest = manifest
+        if not all(
+            manifest.restorable(_)
+            for _ in units
+            if manifest.reusable(_) and _.name not in checkpoint.completed
+        ):
+            click.secho(
+                "Output reused from the previous run is gone, run without --resume",
+                file=sys.stderr,
+                fg="red",
+            )
+            exit(1)
+    else:
+        manifest = RunManifest(output_path, settings, enabled=incremental)
+        manifest.prepare(units)
+        checkpoint.start(emitters, manifest)
+    # the index is rewritten once the new output is validated
+    (pathlib.Path(output_path) / INDEX_NAME).unlink(missing_ok=True)
+    (pathlib.Path(output_path) / ERRORS_NAME).unlink(missing_ok=True)
+
+    def write_reports():
+        """Write the --metrics and --trace of the run."""
+        if metrics:
+            save_metrics(
+                metrics.report(
+                    dict(emitters.sizes),
+                    study=research_study_id,
+                    transformers=transformers,
+                    fhir_version=fhir_version,
+                    workers=workers,
+                ),
+                metrics_path,
+                metrics_textfile,
+                labels={"study": research_study_id},
+            )
+        if tracer:
+            tracer.save(trace_path)
 
-    emitted = set()
     click.echo(f"Transformers: {transformers}", file=sys.stderr)
     with Halo(
         text="Processing",
@@ -266,81 +904,280 @@ def prep(input_path, output_path, transformers, seed, fhir_version):
         color="white",
         stream=sys.stderr,
     ) as spinner:
-        # assay is a special case, it requires a set of resources to work ['DocumentReference', 'Group', 'Specimen']
-        last_resource_type = None
-        if "assay" in transformers:
-            spinner.text = "Processing Assay"
-            for resource in create_assays(fhir_version, input_path):
-                # load the transformer function from the map
-                for transformer in transformer_map.values():
-                    # run it with variable args
-                    resource = transformer(
-                        resource=resource,
-                        research_study_id=research_study_id,
-                        fhir_version=fhir_version,
-                        seed=seed,
-                    )
-                if not resource:
-                    continue
-                emitters.emit(resource)
-                if (
-                    last_resource_type
-                    and last_resource_type != resource["resourceType"]
-                ):
+        if workers > 1:
+            from fhir_aggregator_submission.shard import prep_sharded
+
+            prep_sharded(
+                units=units,
+                output_path=output_path,
+                emitters=emitters,
+                manifest=manifest,
+                transformers=transformers,
+                research_study_id=research_study_id,
+                fhir_version=fhir_version,
+                seed=seed,
+                workers=workers,
+                spinner=spinner,
+                validation_cache=validation_cache,
+                shape_sampler=shape_sampler,
+                on_error=on_error,
+                metrics=metrics,
+                tracer=tracer,
+                checkpoint=checkpoint,
+            )
+        else:
+            last_resource_type = None
+
+            def on_emit(resource):
+                nonlocal last_resource_type
+                if last_resource_type == resource["resourceType"]:
+                    # setting the spinner text measures the terminal, only do it on a change
+                    return
+                if last_resource_type:
                     spinner.succeed(last_resource_type)
                     spinner.start()
                 last_resource_type = resource["resourceType"]
                 spinner.text = f"Processing {last_resource_type}"
-            emitted.add("DocumentReference")
-            emitted.add("Group")
-        for resource in pathlib.Path(input_path).glob("*.ndjson"):
-            if resource.stem in emitted:
-                continue
-            with open(resource, "r") as infile:
-                spinner.text = f"Processing {resource}"
-                for line in infile:
-                    resource = orjson.loads(line.strip())
-
-                    if "vocabulary" in transformers:
-                        # skip _existing_ vocabulary  Observations
-                        if resource["resourceType"] == "Observation":
-                            if resource["code"]["coding"][0]["code"] == "vocabulary":
-                                continue
-
-                    for transformer in transformer_map.values():
-                        resource = transformer(
-                            resource=resource,
-                            research_study_id=research_study_id,
-                            fhir_version=fhir_version,
-                            seed=seed,
+
+            def on_progress():
+                if validation_pool is not None and checkpoint.due():
+                    # the checkpoint records the ids and references of the resources read so far
+                    validation_pool.drain()
+                checkpoint.tick(VOCABULARY_COLLECTOR, ERROR_REPORT)
+
+            def on_failure():
+                if validation_pool is not None:
+                    # resources in flight may not be validated, resume from the last checkpoint saved
+                    validation_pool.close()
+                    return
+                checkpoint.failed(VOCABULARY_COLLECTOR, ERROR_REPORT)
+
+            emitted = set(checkpoint.emitted)
+            for unit in units:
+                # as files are read in directory order, skip a file whose type was already emitted
+                if unit.name in emitted or unit.name in checkpoint.completed:
+                    continue
+                if manifest.reusable(unit):
+                    with traced(tracer, f"restore {unit.name}", "input"):
+                        summary = manifest.restore(unit, emitters)
+                    merge_summary(summary)
+                    spinner.succeed(f"{unit.name} unchanged")
+                    spinner.start()
+                else:
+                    # assay is a special case, it requires a set of resources to work ['DocumentReference', 'Group', 'Specimen']
+                    spinner.text = f"Processing {unit.name}"
+                    offset, partial = checkpoint.partial(unit)
+                    reader = None
+                    if unit.name != ASSAY:
+                        reader = LineReader(unit.inputs[0], offset)
+                        if stats:
+                            reader = ThreadedReader(reader, stats)
+                    if not partial:
+                        manifest.begin(unit, emitters)
+                    checkpoint.begin(unit, reader, VOCABULARY_COLLECTOR, ERROR_REPORT)
+                    resources = unit_resources(
+                        unit, input_path, transformers, fhir_version, reader
+                    )
+                    if metrics:
+                        resources = metrics.timed_iter(
+                            "assay" if unit.name == ASSAY else "read", resources
                         )
-                    if not resource:
-                        continue
-                    emitters.emit(resource)
-                    if (
-                        last_resource_type
-                        and last_resource_type != resource["resourceType"]
+                        metrics.read(
+                            unit.name,
+                            sum(os.path.getsize(_) for _ in unit.inputs) - offset,
+                        )
+                    if tracer:
+                        resources = tracer.batches(f"transform {unit.name}", resources)
+                    with traced(
+                        tracer,
+                        unit.name,
+                        "assay" if unit.name == ASSAY else "input",
+                        inputs=unit.inputs,
+                        offset=offset,
                     ):
-                        spinner.succeed(last_resource_type)
-                        spinner.start(f"Processing {resource['resourceType']}")
-                    last_resource_type = resource["resourceType"]
-
-                    emitted.add(resource["resourceType"])
+                        summary = collect_unit(
+                            resources,
+                            plan,
+                            emitters,
+                            on_emit,
+                            on_progress=on_progress if checkpoint.enabled else None,
+                            on_failure=(
+                                on_failure
+                                if checkpoint.enabled or validation_pool
+                                else None
+                            ),
+                            partial=partial,
+                            validation_pool=validation_pool,
+                        )
+                    manifest.end(unit, emitters, summary)
+                if unit.name != ASSAY:
+                    emitted.update(summary.emitted)
+                checkpoint.end(
+                    unit,
+                    summary.emitted if unit.name != ASSAY else [],
+                    VOCABULARY_COLLECTOR,
+                    ERROR_REPORT,
+                )
+            if validation_pool is not None:
+                validation_pool.close()
 
         if "vocabulary" in transformers:
-            for vocabulary_observation in VOCABULARY_COLLECTOR.to_observations():
-                validate(vocabulary_observation, fhir_version)
-                emitters.emit(vocabulary_observation)
+            with span(metrics, "Observation", "vocabulary_observations"), traced(
+                tracer, "vocabulary observations", "vocabulary"
+            ):
+                for vocabulary_observation in VOCABULARY_COLLECTOR.to_observations():
+                    validate(
+                        vocabulary_observation,
+                        fhir_version,
+                        validation_cache=validation_cache,
+                        shape_sampler=shape_sampler,
+                        on_error=on_error,
+                    )
+                    emitters.emit(vocabulary_observation)
             spinner.succeed("Vocabulary Observation")
 
+        if validation_cache is not None:
+            # resources are valid whatever the references they have
+            validation_cache.compact()
+        if shape_sampler is not None:
+            spinner.info(shape_sampler.report())
+            spinner.start()
+
         if "validate" in transformers:
             spinner.text = "Validating references"
-            validate_references()
+            # the output is read back to report dangling references
+            emitters.flush()
+            try:
+                with span(metrics, "", "validate_references"), traced(
+                    tracer, "validate_references", "validate"
+                ):
+                    validate_references(
+                        output_path, reference_indexes, on_error=on_error
+                    )
+            except SystemExit:
+                # the output is complete, record the run that has dangling references
+                write_reports()
+                raise
+            if ERROR_REPORT:
+                errors_path = pathlib.Path(output_path) / ERRORS_NAME
+                ERROR_REPORT.write(errors_path)
+                spinner.fail(f"Validation failed, see {errors_path}")
+                click.echo(ERROR_REPORT.report())
+                write_reports()
+                exit(1)
+            save_index(
+                pathlib.Path(output_path) / INDEX_NAME, REFERENCE_INDEX.sorted_ids()
+            )
             spinner.succeed("Validation complete")
     spinner.succeed(
         f"👍 Processing complete. All resources emitted. See output directory {output_path}"
     )
     emitters.close()
+    manifest.save(emitters)
+    checkpoint.remove()
+    write_reports()
+    if stats:
+        click.echo(stats.report(), file=sys.stderr)
+
+
+# the defaults are those of synth.Cardinalities
+@cli.command(name="synth")
+@click.argument("output_path", required=True, type=click.Path(file_okay=False))
+@click.option(
+    "--resources",
+    default=10_000,
+    show_default=True,
+    type=click.IntRange(min=1),
+    help="Generate about this many resources, in as many Patients as it takes",
+)
+@click.option(
+    "--patients",
+    type=click.IntRange(min=1),
+    help="Generate this many Patients, rather than a number of resources",
+)
+@click.option(
+    "--specimens-per-patient",
+    default=2,
+    show_default=True,
+    type=click.IntRange(min=0),
+)
+@click.option(
+    "--documents-per-specimen",
+    default=2,
+    show_default=True,
+    type=click.IntRange(min=0),
+)
+@click.option(
+    "--observations-per-patient",
+    default=10,
+    show_default=True,
+    type=click.IntRange(min=0),
+)
+@click.option(
+    "--codes",
+    default=100,
+    show_default=True,
+    type=click.IntRange(min=1),
+    help="Distinct Observation codes, the size of the vocabulary",
+)
+@click.option(
+    "--document-subject",
+    type=click.Choice(["group", "specimen"]),
+    default="group",
+    show_default=True,
+    help="group: a Group per Specimen, that the assay transformer turns into an assay, is the subject of its DocumentReferences.  specimen: the Specimen is",
+)
+@click.option("--study-id", default="SYNTHETIC", show_default=True)
+@click.option(
+    "--seed",
+    default=0,
+    show_default=True,
+    help="The same seed and options generate the same files",
+)
+def synth(
+    output_path,
+    resources,
+    patients,
+    specimens_per_patient,
+    documents_per_specimen,
+    observations_per_patient,
+    codes,
+    document_subject,
+    study_id,
+    seed,
+):
+    """Generate a synthetic, referentially consistent META directory.
+
+    \b
+    OUTPUT_PATH the META directory to write, e.g. for `fa_submit prep OUTPUT_PATH ...`
+    """
+    # only the synth command needs the generator, prep doesn't import it
+    from fhir_aggregator_submission.synth import Cardinalities, Study
+
+    cardinalities = Cardinalities(
+        specimens_per_patient=specimens_per_patient,
+        documents_per_specimen=documents_per_specimen,
+        observations_per_patient=observations_per_patient,
+        codes=codes,
+        document_subject=document_subject,
+    )
+    study = Study(
+        study_id, patients or cardinalities.patients(resources), cardinalities, seed
+    )
+    with Halo(
+        text="Generating",
+        spinner="line",
+        placement="right",
+        color="white",
+        stream=sys.stderr,
+    ) as spinner:
+
+        def on_written(resource_type, count):
+            spinner.succeed(f"{resource_type}: {count:,}")
+            spinner.start()
+
+        counts = study.write(output_path, on_written)
+        spinner.succeed(f"{sum(counts.values()):,} resources in {output_path}")
 
 
 def extract_researchstudy_id(entity: dict) -> str:
@@ -367,30 +1204,38 @@ def extract_researchstudy_id(entity: dict) -> str:
     return ""
 
 
-def create_assays(fhir_version, input_path) -> Generator[dict, None, None]:
-    """Create assays from the input files [DocumentReference, Group, Specimen]."""
+def read_ndjson(path) -> Generator[dict, None, None]:
+    """Yield the resources in an NDJSON file."""
+    for line in LineReader(path):
+        yield orjson.loads(line)
+
+
+def subject_id(doc: dict) -> str:
+    """The id part of the document's subject reference."""
+    return doc["subject"]["reference"].split("/")[1]
+
+
+def create_assays(
+    fhir_version, input_path, memory_budget=DEFAULT_MEMORY_BUDGET
+) -> Generator[dict, None, None]:
+    """Create assays from the input files [DocumentReference, Group, Specimen].
+
+    Yields the assays, then the adjusted DocumentReferences, then the Groups that did not become assays.
+    Resources are streamed: Specimen and Group are first reduced to an index of
+    specimen -> patient and group -> (patient, specimens) references that spills to sqlite when it
+    outgrows memory_budget, then DocumentReferences are read and adjusted one at a time.
+    """
     document_reference_path = pathlib.Path(input_path) / "DocumentReference.ndjson"
-    with open(document_reference_path, "r") as doc_file:
-        document_references = [orjson.loads(line.strip()) for line in doc_file]
+    group_file_path = pathlib.Path(input_path) / "Group.ndjson"
+    specimen_path = pathlib.Path(input_path) / "Specimen.ndjson"
 
     # only load and process groups if the file exists.
-    group_file_path = pathlib.Path(input_path) / "Group.ndjson"
-    if group_file_path.exists():
-        with open(group_file_path, "r") as group_file:
-            groups: list[dict] = [orjson.loads(line.strip()) for line in group_file]
-    else:
+    if not group_file_path.exists():
         print("Group file not found. Skipping group processing.")
-        groups = []
 
-    specimen_path = pathlib.Path(input_path) / "Specimen.ndjson"
-    with open(specimen_path, "r") as specimen_file:
-        specimens = {
-            spec["id"]: spec
-            for spec in (orjson.loads(line.strip()) for line in specimen_file)
-        }
-
-    if document_references:
-        first_doc = document_references[0]
+    first_line = next(iter(LineReader(document_reference_path)), None)
+    if first_line is not None:
+        first_doc = orjson.loads(first_line)
         research_study_id = extract_researchstudy_id(first_doc)
         print(
             f"First DocumentReference ID: {first_doc.get('id')} references ResearchStudy ID: {research_study_id}"
@@ -398,108 +1243,139 @@ def create_assays(fhir_version, input_path) -> Generator[dict, None, None]:
     else:
         print("No DocumentReference found.")
 
-    document_references_by_group: dict[str, list[dict]] = {}
-    for doc in document_references:
-        group_id = doc["subject"]["reference"].split("/")[1]
-        if group_id not in document_references_by_group:
-            document_references_by_group[group_id] = []
-        document_references_by_group[group_id].append(doc)
-
-    assays = []
-
-    # process groups only if they exist
-    if groups:
-        groups_with_specimen = set()
-        for group in groups:
-            patient_reference = None
-            specimen_references = []
-            # find the specimen references in the group
-            for member in group.get("member", []):
-                if "reference" in member["entity"]:
-                    if member["entity"]["reference"].startswith("Specimen/"):
-                        specimen_id = member["entity"]["reference"].split("/")[1]
-                        specimen_references.append(member["entity"]["reference"])
-                        if specimen_id in specimens:
-                            patient_reference = specimens[specimen_id]["subject"][
-                                "reference"
-                            ]
-
-            # skip if no patient or specimen references
-            if not patient_reference or not specimen_references:
-                continue
-
-            groups_with_specimen.add(group["id"])
-
-            # get all the docs for the group
-            assay_documents = document_references_by_group.get(group["id"], [])
-
-            assay_id = group["id"]  # for now, use the group id as the assay id
-            research_study_id = extract_researchstudy_id(group)
-            assert (
-                research_study_id
-            ), f"Group ID: {assay_id} does not reference a ResearchStudy"
-
-            assay_dict = create_assay_refactor_docs(
-                assay_id,
-                patient_reference,
-                specimen_references,
-                assay_documents,
-                research_study_id,
-                fhir_version,
-            )
-            assay_dict["extension"] = group.get("extension", [])
-            assays.append(assay_dict)
-
-        groups = [group for group in groups if group["id"] not in groups_with_specimen]
-
-        docs_with_non_patient_subject = [
-            (doc["id"], doc["subject"]["reference"])
-            for doc in document_references
-            if not doc["subject"]["reference"].startswith("Patient/")
-        ]
-        assert len(docs_with_non_patient_subject) == len(
-            groups
-        ), f"Documents have groups with non-patient subject: {docs_with_non_patient_subject}"
-
-    for doc in document_references:
-        resource = doc
-        research_study_id = extract_researchstudy_id(resource)
-        if not research_study_id:
-            print(
-                f"Warning: Resource with ID {resource.get('id')} does not reference a ResearchStudy. Skipping assay creation."
-            )
-            continue
+    with SpillingIndex(memory_budget) as specimens, SpillingIndex(
+        memory_budget
+    ) as groups_with_specimen:
+        for specimen in read_ndjson(specimen_path):
+            specimens[specimen["id"]] = specimen.get("subject", {}).get("reference")
+
+        # find the groups with specimen references, these become assays
+        group_count = 0
+        if group_file_path.exists():
+            for group in read_ndjson(group_file_path):
+                group_count += 1
+                patient_reference = None
+                specimen_references = []
+                # find the specimen references in the group
+                for member in group.get("member", []):
+                    if "reference" in member["entity"]:
+                        if member["entity"]["reference"].startswith("Specimen/"):
+                            specimen_id = member["entity"]["reference"].split("/")[1]
+                            specimen_references.append(member["entity"]["reference"])
+                            if specimen_id in specimens:
+                                patient_reference = specimens[specimen_id]
+
+                # skip if no patient or specimen references
+                if not patient_reference or not specimen_references:
+                    continue
 
-        if doc["subject"]["reference"].startswith("Specimen/"):
-            specimen_references = [doc["subject"]["reference"]]
-            specimen_id = doc["subject"]["reference"].split("/")[1]
-            patient_reference = specimens[specimen_id]["subject"]["reference"]
+                assert extract_researchstudy_id(
+                    group
+                ), f"Group ID: {group['id']} does not reference a ResearchStudy"
+                # as a str: the bytes orjson returns keep a ~4KB allocation each
+                groups_with_specimen[group["id"]] = orjson.dumps(
+                    [patient_reference, specimen_references]
+                ).decode()
+
+        # documents whose subject is not one of the assay groups must be attached to a specimen
+        documents_with_specimen = 0
+        if group_count:
+            docs_with_non_patient_subject = []
+            for doc in read_ndjson(document_reference_path):
+                if subject_id(doc) in groups_with_specimen:
+                    continue
+                if not doc["subject"]["reference"].startswith("Patient/"):
+                    docs_with_non_patient_subject.append(
+                        (doc["id"], doc["subject"]["reference"])
+                    )
+                if doc["subject"]["reference"].startswith("Specimen/"):
+                    documents_with_specimen += 1
+            assert len(docs_with_non_patient_subject) == group_count - len(
+                groups_with_specimen
+            ), f"Documents have groups with non-patient subject: {docs_with_non_patient_subject}"
+
+        # assays for the groups, for now, use the group id as the assay id
+        if groups_with_specimen:
+            for group in read_ndjson(group_file_path):
+                if group["id"] not in groups_with_specimen:
+                    continue
+                patient_reference, specimen_references = orjson.loads(
+                    groups_with_specimen[group["id"]]
+                )
+                assay_dict = create_assay(
+                    group["id"],
+                    patient_reference,
+                    specimen_references,
+                    extract_researchstudy_id(group),
+                    fhir_version,
+                )
+                assay_dict["extension"] = group.get("extension", [])
+                yield assay_dict
+
+        def specimen_assay(doc):
+            """Return the assay for a document whose subject is a specimen."""
+            if subject_id(doc) in groups_with_specimen:
+                return None
+            if not doc["subject"]["reference"].startswith("Specimen/"):
+                return None
+            specimen_id = subject_id(doc)
+            patient_reference = specimens[specimen_id]
             assert (
                 patient_reference
             ), f"Patient reference not found for specimen {specimen_id}"
-            assay_documents = [doc]
-            assay_id = str(uuid.uuid5(uuid.NAMESPACE_DNS, doc["id"] + "-assay"))
-            assay_dict = create_assay_refactor_docs(
-                assay_id,
+            return create_assay(
+                str(uuid.uuid5(uuid.NAMESPACE_DNS, doc["id"] + "-assay")),
                 patient_reference,
-                specimen_references,
-                assay_documents,
-                research_study_id,
+                [doc["subject"]["reference"]],
+                extract_researchstudy_id(doc),
                 fhir_version,
             )
-            assert doc["subject"]["reference"].startswith(
-                "Patient/"
-            ), f"Document subject is not a patient: {doc['subject']['reference']}"
-            assays.append(assay_dict)
 
-    for resource in assays:
-        yield resource
-
-    for resource in document_references:
-        yield resource
+        # assays for the documents attached directly to a specimen
+        if documents_with_specimen or not group_count:
+            for doc in read_ndjson(document_reference_path):
+                if not extract_researchstudy_id(doc):
+                    print(
+                        f"Warning: Resource with ID {doc.get('id')} does not reference a ResearchStudy. Skipping assay creation."
+                    )
+                    continue
+                assay_dict = specimen_assay(doc)
+                if assay_dict:
+                    yield assay_dict
+
+        # the documents, adjusted to have the patient as the subject and the assay as a related context
+        for doc in read_ndjson(document_reference_path):
+            if subject_id(doc) in groups_with_specimen:
+                patient_reference, specimen_references = orjson.loads(
+                    groups_with_specimen[subject_id(doc)]
+                )
+                refactor_document(
+                    doc,
+                    f"ServiceRequest/{subject_id(doc)}",
+                    patient_reference,
+                    specimen_references,
+                    fhir_version,
+                )
+            elif extract_researchstudy_id(doc):
+                assay_dict = specimen_assay(doc)
+                if assay_dict:
+                    refactor_document(
+                        doc,
+                        f"{assay_dict['resourceType']}/{assay_dict['id']}",
+                        assay_dict["subject"]["reference"],
+                        [doc["subject"]["reference"]],
+                        fhir_version,
+                    )
+                    assert doc["subject"]["reference"].startswith(
+                        "Patient/"
+                    ), f"Document subject is not a patient: {doc['subject']['reference']}"
+            yield doc
 
-    for resource in groups:
-        yield resource
+        # the groups that did not become assays
+        if group_count:
+            for group in read_ndjson(group_file_path):
+                if group["id"] not in groups_with_specimen:
+                    yield group
 
 
 def update_mime_type(doc: dict) -> dict:
@@ -539,6 +1415,43 @@ def create_assay_refactor_docs(
     specimen_references (list[str]): A list of references to the specimens associated with the assay.
     assay_documents (list[dict]): A list of document references to be included in the assay.
 
+    Returns:
+    dict: The created assay dictionary.
+    """
+    assay_dict = create_assay(
+        assay_id,
+        patient_reference,
+        specimen_references,
+        research_study_id,
+        fhir_version,
+    )
+    for doc in assay_documents:
+        refactor_document(
+            doc,
+            f"{assay_dict['resourceType']}/{assay_dict['id']}",
+            patient_reference,
+            specimen_references,
+            fhir_version,
+        )
+    return assay_dict
+
+
+def create_assay(
+    assay_id: str,
+    patient_reference: str,
+    specimen_references: list[str],
+    research_study_id: str,
+    fhir_version="R4",
+) -> dict:
+    """
+    Create an R4B `Assay` (ServiceRequest) for a patient and its specimens.
+
+    Parameters:
+    assay_id (str): The unique identifier for the assay.
+    patient_reference (str): The reference to the patient associated with the assay.
+    specimen_references (list[str]): A list of references to the specimens associated with the assay.
+    research_study_id (str): The ResearchStudy the assay is part of.
+
     Returns:
     dict: The created assay dictionary.
     """
@@ -603,49 +1516,68 @@ def create_assay_refactor_docs(
     if not any(ext.get("url") == part_of_study_url for ext in assay_dict["extension"]):
         assay_dict["extension"].append(part_of_study_extension)
 
-    # TODO - move this to its own function
-    # now modify the document.subject to the patient and add the assay to the context.related
-    for doc in assay_documents:
-        doc["subject"] = {"reference": patient_reference}
-
-        if fhir_version != "R4":
-            if "basedOn" not in doc:
-                doc["basedOn"] = []
-            # set reference to the Assay in basedOn
-            based_on = doc["basedOn"]
-            based_on.append(
-                {"reference": f"{assay_dict['resourceType']}/{assay_dict['id']}"}
-            )
+    return assay_dict
 
-            # set size to a string
-            attachment = doc["content"][0]["attachment"]
-            if "size" in attachment.keys() and not isinstance(attachment["size"], str):
-                attachment["size"] = str(attachment["size"])
-        else:
-            # make it a R4B document
-            # these fields don't exist in R4B
-            if "version" in doc.keys():
-                del doc["version"]
-            if "profile" in doc["content"][0].keys():
-                del doc["content"][0]["profile"]
-
-            # set reference to Assay in context.related
-            if "context" not in doc:
-                doc["context"] = {}
-            context = doc["context"]
-            if "related" not in context:
-                context["related"] = []
-            # TODO R5 does not use related as a list of References(Any) remove it from here
-            context["related"].append(
-                {"reference": f"{assay_dict['resourceType']}/{assay_dict['id']}"}
-            )
-            context["related"].extend([{"reference": _} for _ in specimen_references])
 
-        # ensure mime type is set correctly
-        update_mime_type(doc)
+def refactor_document(
+    doc: dict,
+    assay_reference: str,
+    patient_reference: str,
+    specimen_references: list[str],
+    fhir_version="R4",
+) -> dict:
+    """
+    Adjust a `DocumentReference` to have the patient as the subject and the assay as a related context.
 
-    return assay_dict
+    Parameters:
+    doc (dict): The DocumentReference, modified in place.
+    assay_reference (str): The reference to the assay, e.g. ServiceRequest/<id>.
+    patient_reference (str): The reference to the patient associated with the assay.
+    specimen_references (list[str]): A list of references to the specimens associated with the assay.
+
+    Returns:
+    dict: The adjusted document.
+    """
+    doc["subject"] = {"reference": patient_reference}
+
+    if fhir_version != "R4":
+        if "basedOn" not in doc:
+            doc["basedOn"] = []
+        # set reference to the Assay in basedOn
+        based_on = doc["basedOn"]
+        based_on.append({"reference": assay_reference})
+
+        # set size to a string
+        attachment = doc["content"][0]["attachment"]
+        if "size" in attachment.keys() and not isinstance(attachment["size"], str):
+            attachment["size"] = str(attachment["size"])
+    else:
+        # make it a R4B document
+        # these fields don't exist in R4B
+        if "version" in doc.keys():
+            del doc["version"]
+        if "profile" in doc["content"][0].keys():
+            del doc["content"][0]["profile"]
+
+        # set reference to Assay in context.related
+        if "context" not in doc:
+            doc["context"] = {}
+        context = doc["context"]
+        if "related" not in context:
+            context["related"] = []
+        # TODO R5 does not use related as a list of References(Any) remove it from here
+        context["related"].append({"reference": assay_reference})
+        context["related"].extend([{"reference": _} for _ in specimen_references])
+
+    # ensure mime type is set correctly
+    update_mime_type(doc)
+
+    return doc
 
 
 if __name__ == "__main__":
-    cli()
+    # run the cli of the imported module, not of __main__: shard and validation_pool read and
+    # swap the collectors of `fhir_aggregator_submission.prep`
+    from fhir_aggregator_submission.prep import cli as prep_cli
+
+    prep_cli()
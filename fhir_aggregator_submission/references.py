@@ -0,0 +1,393 @@
+import array
+import hashlib
+import os
+import pathlib
+import tempfile
+from typing import Any, Callable, Iterable, Iterator
+
+import numpy as np
+import orjson
+
+from fhir_aggregator_submission.outputs import output_parts
+
+# Bytes of hashes kept in memory, per array, before they spill to disk.
+DEFAULT_MEMORY_BUDGET = 256 * 1024 * 1024
+# Entries read from disk at a time while validating.
+CHUNK_ENTRIES = 4 * 1024 * 1024
+# Strings hashed at a time.
+HASH_BATCH = 64 * 1024
+ID_DTYPE = np.dtype("<u8")
+# a reference's hash and the key of the resourceType and path it was found at
+REFERENCE_DTYPE = np.dtype([("hash", "<u8"), ("source", "<u4")])
+# The sorted, unique id hashes of a prepped output directory.
+INDEX_NAME = "reference-index.npy"
+
+
+FNV_OFFSET = 0xCBF29CE484222325
+FNV_PRIME = 0x100000001B3
+MASK64 = (1 << 64) - 1
+
+
+def reference_hash(value: str) -> int:
+    """The 64-bit FNV-1a hash of a `ResourceType/id` string, stable across processes."""
+    h = FNV_OFFSET
+    for byte in value.encode():
+        h = ((h ^ byte) * FNV_PRIME) & MASK64
+    return h
+
+
+def hash_strings(values: list[str]) -> np.ndarray:
+    """`reference_hash` of each string, vectorized with NumPy."""
+    hashes = np.full(len(values), FNV_OFFSET, dtype=np.uint64)
+    if not values:
+        return hashes
+    encoded = np.array([_.encode() for _ in values], dtype=bytes)
+    lengths = np.char.str_len(encoded)
+    columns = np.ascontiguousarray(
+        encoded.view(np.uint8).reshape(len(values), encoded.dtype.itemsize).T
+    )
+    prime = np.uint64(FNV_PRIME)
+    for position, column in enumerate(columns):
+        # strings shorter than the longest are padded, stop hashing them at their end
+        active = lengths > position
+        hashes[active] = (hashes[active] ^ column[active]) * prime
+    return hashes
+
+
+def source_key(resource_type: str, path: str) -> int:
+    """A 32-bit key for the resourceType and path a reference was found at."""
+    return int.from_bytes(
+        hashlib.blake2b(f"{resource_type} {path}".encode(), digest_size=4).digest(),
+        "little",
+    )
+
+
+def find_references(resource: dict) -> list[tuple[str, str]]:
+    """The (path, reference) of every `reference` string in a resource, list indices are not part of the path."""
+    found = []
+    stack: list[tuple[Any, str]] = [(resource, "")]
+    while stack:
+        value, path = stack.pop()
+        if isinstance(value, list):
+            for item in value:
+                if isinstance(item, (dict, list)):
+                    stack.append((item, path))
+            continue
+        for key, child in value.items():
+            if type(child) is str:
+                if key == "reference":
+                    found.append((f"{path}.{key}" if path else key, child))
+            elif isinstance(child, (dict, list)):
+                if key == "reference" and isinstance(child, list):
+                    raise ValueError(f"Invalid reference type: {type(child)}")
+                # a dict reference is a CodeableReference, https://www.hl7.org/fhir/references.html#CodeableReference
+                stack.append((child, f"{path}.{key}" if path else key))
+            elif key == "reference":
+                raise ValueError(f"Invalid reference type: {type(child)}")
+    return found
+
+
+def replace_references(resource: dict, replace: Callable[[str], str]) -> dict:
+    """Replace every `reference` string in a resource, in place, with `replace(reference)`."""
+    stack: list[Any] = [resource]
+    while stack:
+        value = stack.pop()
+        if isinstance(value, list):
+            stack.extend(_ for _ in value if isinstance(_, (dict, list)))
+            continue
+        for key, child in value.items():
+            if type(child) is str:
+                if key == "reference":
+                    value[key] = replace(child)
+            elif isinstance(child, (dict, list)):
+                stack.append(child)
+    return resource
+
+
+def contains(ids: np.ndarray, hashes: np.ndarray) -> np.ndarray:
+    """A mask of the hashes found in the sorted array ids."""
+    if not len(ids):
+        return np.zeros(len(hashes), dtype=bool)
+    positions = np.searchsorted(ids, hashes)
+    positions[positions == len(ids)] = 0
+    return ids[positions] == hashes
+
+
+def save_index(path, ids: np.ndarray):
+    """Write sorted id hashes to an index file, replacing it atomically."""
+    path = pathlib.Path(path)
+    tmp = path.with_suffix(".tmp")
+    with open(tmp, "wb") as f:
+        np.save(f, np.ascontiguousarray(ids, dtype=ID_DTYPE))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def load_indexes(paths, exclude=None) -> dict[str, np.ndarray]:
+    """Memory map the index files in paths, a directory is searched for the index files of its prepped outputs.
+
+    The index of the output directory `exclude`, about to be rewritten, is skipped.
+    """
+    excluded = (pathlib.Path(exclude) / INDEX_NAME).resolve() if exclude else None
+    indexes = {}
+    for path in paths:
+        path = pathlib.Path(path)
+        files = sorted(path.rglob(INDEX_NAME)) if path.is_dir() else [path]
+        for file in files:
+            if file.resolve() == excluded:
+                continue
+            indexes[str(file)] = np.load(file, mmap_mode="r")
+    return indexes
+
+
+class HashLog:
+    """An append-only array of string hashes (and source keys), moved to a file once it exceeds its memory budget.
+
+    Strings are added to a pending list and hashed a batch at a time.
+    """
+
+    def __init__(self, dtype: np.dtype, memory_budget: int, directory=None):
+        """Initialize an empty log."""
+        self.dtype = dtype
+        self._memory_budget = memory_budget
+        self._directory = directory
+        self._pending: list[str] = []
+        self._pending_sources: list[int] = []
+        self._columns = [array.array("Q")]
+        if dtype.names:
+            self._columns.append(array.array("I"))
+        self._spilled = 0
+        self._path: str | None = None
+
+    def __len__(self) -> int:
+        return self._spilled + len(self._columns[0]) + len(self._pending)
+
+    @property
+    def spilled(self) -> bool:
+        """True if part of the log is on disk."""
+        return self._spilled > 0
+
+    def add(self, value: str, source: int = 0):
+        """Add the hash of a string, and the source key for references."""
+        self._pending.append(value)
+        if self.dtype.names:
+            self._pending_sources.append(source)
+        if len(self._pending) >= HASH_BATCH:
+            self._hash_pending()
+
+    def _hash_pending(self):
+        """Hash the pending strings into the in memory columns."""
+        if not self._pending:
+            return
+        self._columns[0].frombytes(hash_strings(self._pending).tobytes())
+        if self.dtype.names:
+            self._columns[1].extend(self._pending_sources)
+        self._pending = []
+        self._pending_sources = []
+        if len(self._columns[0]) * self.dtype.itemsize > self._memory_budget:
+            self._spill()
+
+    def extend(self, records: np.ndarray):
+        """Append an array of records."""
+        self._hash_pending()
+        if self.dtype.names:
+            self._columns[0].frombytes(np.ascontiguousarray(records["hash"]).tobytes())
+            self._columns[1].frombytes(
+                np.ascontiguousarray(records["source"]).tobytes()
+            )
+        else:
+            self._columns[0].frombytes(records.astype(self.dtype).tobytes())
+        if len(self._columns[0]) * self.dtype.itemsize > self._memory_budget:
+            self._spill()
+
+    def _memory(self) -> np.ndarray:
+        """The records held in memory."""
+        hashes = np.frombuffer(self._columns[0], dtype="<u8")
+        if not self.dtype.names:
+            return hashes
+        records = np.empty(len(hashes), dtype=self.dtype)
+        records["hash"] = hashes
+        records["source"] = np.frombuffer(self._columns[1], dtype="<u4")
+        return records
+
+    def _spill(self):
+        """Append the records held in memory to the spill file."""
+        if self._path is None:
+            fd, self._path = tempfile.mkstemp(
+                prefix="references-", suffix=".bin", dir=self._directory
+            )
+            os.close(fd)
+        records = self._memory()
+        with open(self._path, "ab") as f:
+            f.write(records.tobytes())
+        self._spilled += len(records)
+        self._columns = [array.array(_.typecode) for _ in self._columns]
+
+    def chunks(
+        self, start: int = 0, stop: int | None = None, size: int = CHUNK_ENTRIES
+    ) -> Iterator[np.ndarray]:
+        """Iterate over records [start, stop) in arrays of at most `size` records."""
+        self._hash_pending()
+        stop = len(self) if stop is None else stop
+        position = start
+        while position < min(stop, self._spilled):
+            count = min(position + size, self._spilled, stop) - position
+            assert self._path is not None
+            yield np.fromfile(
+                self._path,
+                dtype=self.dtype,
+                count=count,
+                offset=position * self.dtype.itemsize,
+            )
+            position += count
+        if position < stop:
+            memory = self._memory()
+            for offset in range(position - self._spilled, stop - self._spilled, size):
+                yield memory[offset : min(offset + size, stop - self._spilled)]
+
+    def to_array(self, start: int = 0, stop: int | None = None) -> np.ndarray:
+        """The records [start, stop) as one array."""
+        chunks = list(self.chunks(start, stop))
+        if not chunks:
+            return np.empty(0, dtype=self.dtype)
+        return np.concatenate(chunks)
+
+    def close(self):
+        """Release the memory and remove any spill file."""
+        self._pending = []
+        self._pending_sources = []
+        self._columns = [array.array(_.typecode) for _ in self._columns]
+        self._spilled = 0
+        if self._path:
+            os.remove(self._path)
+            self._path = None
+
+
+class ReferenceIndex:
+    """The ids and references seen by validate, kept as 64-bit hashes.
+
+    Ids (`ResourceType/id`) and references are hashed, a batch at a time, into arrays of 8 bytes per id
+    and 12 per reference (hash and the key of the resourceType and path it was found at), that
+    spill to a file past the memory budget.  The arrays pickle compactly, so workers hand them
+    back to the parent in their summaries.  `dangling` sorts the ids and checks the references
+    with `searchsorted`, a chunk at a time.
+    """
+
+    def __init__(self, memory_budget: int = DEFAULT_MEMORY_BUDGET, directory=None):
+        """Initialize an empty index, spill files are created in `directory` (default: system temp)."""
+        self.ids = HashLog(ID_DTYPE, memory_budget, directory)
+        self.references = HashLog(REFERENCE_DTYPE, memory_budget, directory)
+        # source key -> [resourceType, path]
+        self.sources: dict[int, list[str]] = {}
+        self._keys: dict[tuple[str, str], int] = {}
+        self._sorted: tuple[int, np.ndarray] | None = None
+
+    def add_resource(self, resource: dict):
+        """Add the id and the references of a resource."""
+        resource_type = resource["resourceType"]
+        self.ids.add(f"{resource_type}/{resource['id']}")
+        for path, reference in find_references(resource):
+            key = self._keys.get((resource_type, path))
+            if key is None:
+                key = source_key(resource_type, path)
+                self._keys[(resource_type, path)] = key
+                self.sources[key] = [resource_type, path]
+            self.references.add(reference, key)
+
+    def extend(
+        self, ids: np.ndarray, references: np.ndarray, sources: dict[int, list[str]]
+    ):
+        """Add the ids and references collected elsewhere."""
+        self.ids.extend(ids)
+        self.references.extend(references)
+        self.sources.update(sources)
+
+    def sorted_ids(self) -> np.ndarray:
+        """The unique id hashes, sorted."""
+        if self._sorted is None or self._sorted[0] != len(self.ids):
+            self._sorted = (len(self.ids), np.unique(self.ids.to_array()))
+        return self._sorted[1]
+
+    def dangling(self, indexes: Iterable[np.ndarray] = ()) -> np.ndarray:
+        """The references whose target id was not seen, nor is in one of the sorted id arrays of indexes."""
+        ids = self.sorted_ids()
+        indexes = list(indexes)
+        missing = []
+        for references in self.references.chunks():
+            references = references[~contains(ids, references["hash"])]
+            for index in indexes:
+                if not len(references):
+                    break
+                references = references[~contains(index, references["hash"])]
+            missing.append(references)
+        if not missing:
+            return np.empty(0, dtype=REFERENCE_DTYPE)
+        return np.concatenate(missing)
+
+    def groups(
+        self, dangling: np.ndarray, output_path=None, examples: int = 3
+    ) -> list[tuple[str, str, int, list[str]]]:
+        """The resourceType, path, count and example references of the dangling references, per resourceType and path.
+
+        The hashes are resolved to reference strings by re-reading the output files in
+        output_path, only for the resourceTypes that have dangling references.
+        """
+        groups: dict[int, dict] = {}
+        keys, counts = np.unique(dangling["source"], return_counts=True)
+        for key, count in zip(keys.tolist(), counts.tolist()):
+            groups[key] = {
+                "count": count,
+                "hashes": set(dangling["hash"][dangling["source"] == key].tolist()),
+                "examples": [],
+            }
+        if output_path:
+            for resource_type in sorted({self.sources[_][0] for _ in groups}):
+                for path in output_parts(output_path, resource_type):
+                    self._find_examples(path, groups, examples)
+        return [
+            (*self.sources[key], group["count"], group["examples"])
+            for key, group in sorted(
+                groups.items(),
+                key=lambda item: (self.sources[item[0]], item[1]["count"]),
+            )
+        ]
+
+    def report(self, dangling: np.ndarray, output_path=None, examples: int = 3) -> str:
+        """Describe the dangling references, grouped by resourceType and path, see `groups`."""
+        lines = [f"references not found: {len(dangling)}"]
+        for resource_type, reference_path, count, found in self.groups(
+            dangling, output_path, examples
+        ):
+            line = f"  {resource_type} {reference_path}: {count}"
+            if found:
+                line += f" e.g. {', '.join(found)}"
+            lines.append(line)
+        return "\n".join(lines)
+
+    @staticmethod
+    def _find_examples(path: pathlib.Path, groups: dict[int, dict], examples: int):
+        """Collect example reference strings for the dangling hashes from an output file."""
+        with open(path, "rb") as f:
+            for line in f:
+                resource = orjson.loads(line)
+                resource_type = resource["resourceType"]
+                for reference_path, reference in find_references(resource):
+                    group = groups.get(source_key(resource_type, reference_path))
+                    if (
+                        group
+                        and len(group["examples"]) < examples
+                        and reference not in group["examples"]
+                        and reference_hash(reference) in group["hashes"]
+                    ):
+                        group["examples"].append(reference)
+                if all(len(_["examples"]) >= examples for _ in groups.values()):
+                    return
+
+    def close(self):
+        """Release the memory and remove any spill files."""
+        self.ids.close()
+        self.references.close()
+        self.sources = {}
+        self._keys = {}
+        self._sorted = None
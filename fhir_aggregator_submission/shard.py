@@ -0,0 +1,415 @@
+import multiprocessing
+import os
+import pathlib
+import shutil
+import tempfile
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from typing import Any, NamedTuple
+
+import numpy as np
+
+from fhir_aggregator_submission import prep as prep_module
+from fhir_aggregator_submission.checkpoint import Checkpoint
+from fhir_aggregator_submission.errors import ErrorReport
+from fhir_aggregator_submission.fingerprint import ShapeSampler
+from fhir_aggregator_submission.incremental import (
+    ASSAY,
+    ASSAY_INPUTS,
+    RunManifest,
+    Unit,
+    UnitSummary,
+)
+from fhir_aggregator_submission.metrics import MeteredEmitters, RunMetrics
+from fhir_aggregator_submission.ndjson import LineReader, line_offsets
+from fhir_aggregator_submission.plan import TransformerPlan
+from fhir_aggregator_submission.references import ID_DTYPE, REFERENCE_DTYPE
+from fhir_aggregator_submission.structural import StructuralSampler
+from fhir_aggregator_submission.trace import Tracer, traced
+from fhir_aggregator_submission.validation_cache import ValidationCache
+from fhir_aggregator_submission.vocabulary import VocabularyCollector
+
+# Don't split files into shards smaller than this, the per-shard overhead dominates.
+MIN_SHARD_BYTES = 8 * 1024 * 1024
+# Aim for this many shards per worker so the pool stays busy at the tail of the run.
+SHARDS_PER_WORKER = 4
+
+
+class Shard(NamedTuple):
+    """A line-aligned byte range [start, end) of an input NDJSON file."""
+
+    number: int
+    path: str
+    start: int
+    end: int
+
+    @property
+    def size(self) -> int:
+        return self.end - self.start
+
+
+class ShardResult(NamedTuple):
+    """What a worker hands back to the parent after processing a unit of work."""
+
+    number: int
+    work_dir: str
+    summary: UnitSummary
+    # resources validated in full and by their shape or structure, with --validate-mode fingerprint or structural
+    validated: tuple[int, int] = (0, 0)
+    # the worker's RunMetrics, see `RunMetrics.to_dict`, with --metrics
+    metrics: dict | None = None
+    # the worker's trace events, with --trace
+    trace: list[dict] | None = None
+
+
+def line_aligned_offsets(path: str | pathlib.Path, shard_bytes: int) -> list[int]:
+    """Return offsets [0, ..., file size] that split the file on line boundaries."""
+    lines = line_offsets(path)
+    file_size = int(lines[-1])
+    offsets = [0]
+    while offsets[-1] + shard_bytes < file_size:
+        # the start of the line after the one at offsets[-1] + shard_bytes
+        next_line = np.searchsorted(lines, offsets[-1] + shard_bytes, side="right")
+        position = int(lines[next_line])
+        if position >= file_size:
+            break
+        offsets.append(position)
+    offsets.append(file_size)
+    return offsets
+
+
+def plan_shards(
+    paths: list[pathlib.Path], workers: int, first_number: int = 0, shard_bytes=None
+) -> list[Shard]:
+    """Split the input files into line-aligned shards, numbered in input order."""
+    if shard_bytes is None:
+        total_bytes = sum(os.path.getsize(path) for path in paths)
+        shard_bytes = max(MIN_SHARD_BYTES, total_bytes // (workers * SHARDS_PER_WORKER))
+    shards = []
+    number = first_number
+    for path in paths:
+        offsets = line_aligned_offsets(path, shard_bytes)
+        for start, end in zip(offsets, offsets[1:]):
+            shards.append(Shard(number, str(path), start, end))
+            number += 1
+    return shards
+
+
+def read_lines(shard: Shard) -> LineReader:
+    """The raw lines of a shard."""
+    return LineReader(shard.path, shard.start, shard.end)
+
+
+def _run(number, resources, transformers, work_dir, sync, **kwargs) -> ShardResult:
+    """Transform resources, emitting them into this unit's private directory."""
+    # a pool process runs many shards, start each one with empty collectors
+    prep_module.reset_collectors()
+    plan = TransformerPlan(prep_module.get_transformer_map(transformers), **kwargs)
+    unit_dir = pathlib.Path(work_dir) / f"{number:08d}"
+    # may exist if a checkpointed run was interrupted
+    unit_dir.mkdir(exist_ok=True)
+    emitters: prep_module.Emitters | MeteredEmitters = prep_module.Emitters(unit_dir)
+    metrics = kwargs.get("metrics")
+    if metrics is not None:
+        emitters = MeteredEmitters(emitters, metrics)
+    summary = prep_module.collect_unit(resources, plan, emitters)
+    if kwargs.get("validation_cache") is not None:
+        kwargs["validation_cache"].flush()
+    validated = (0, 0)
+    if kwargs.get("shape_sampler") is not None:
+        validated = (kwargs["shape_sampler"].full, kwargs["shape_sampler"].structural)
+    if sync:
+        emitters.flush()
+    emitters.close()
+    return ShardResult(
+        number,
+        str(unit_dir),
+        summary,
+        validated,
+        metrics.to_dict() if metrics is not None else None,
+    )
+
+
+def run_assay(
+    number, input_path, transformers, work_dir, sync=False, tracer=None, **kwargs
+) -> ShardResult:
+    """Worker: create the assays, they need DocumentReference, Group and Specimen together."""
+    resources = (
+        (resource, None)
+        for resource in prep_module.create_assays(kwargs["fhir_version"], input_path)
+    )
+    metrics = kwargs.get("metrics")
+    if metrics is not None:
+        resources = metrics.timed_iter("assay", resources)
+        for resource_type in ASSAY_INPUTS:
+            path = pathlib.Path(input_path) / f"{resource_type}.ndjson"
+            if path.exists():
+                metrics.read(ASSAY, path.stat().st_size)
+    if tracer is not None:
+        resources = tracer.batches(f"transform {ASSAY}", resources)
+    with traced(tracer, ASSAY, "assay"):
+        result = _run(number, resources, transformers, work_dir, sync, **kwargs)
+    if tracer is not None:
+        result = result._replace(trace=tracer.events)
+    return result
+
+
+def run_shard(
+    shard: Shard, transformers, work_dir, sync=False, tracer=None, **kwargs
+) -> ShardResult:
+    """Worker: transform one shard of an input file."""
+    resources = prep_module.load_resources(read_lines(shard), transformers)
+    name = pathlib.Path(shard.path).stem
+    metrics = kwargs.get("metrics")
+    if metrics is not None:
+        resources = metrics.timed_iter("read", resources)
+        metrics.read(name, shard.size)
+    if tracer is not None:
+        resources = tracer.batches(f"transform {name}", resources)
+    with traced(
+        tracer,
+        f"{name} shard {shard.number}",
+        "shard",
+        start=shard.start,
+        end=shard.end,
+    ):
+        result = _run(shard.number, resources, transformers, work_dir, sync, **kwargs)
+    if tracer is not None:
+        result = result._replace(trace=tracer.events)
+    return result
+
+
+def copy_output(result: ShardResult, emitters):
+    """Append a worker's per-resourceType output to the parent's."""
+    for resource_type in result.summary.emitted:
+        with open(pathlib.Path(result.work_dir) / f"{resource_type}.ndjson", "rb") as f:
+            while chunk := f.read(1024 * 1024):
+                emitters.write(resource_type, chunk)
+
+
+def combine(results: list[ShardResult]) -> UnitSummary:
+    """Combine the summaries of a unit's shards, in input order."""
+    emitted: dict[str, None] = {}
+    sources: dict[int, list[str]] = {}
+    vocabulary = VocabularyCollector()
+    errors = ErrorReport()
+    for result in results:
+        emitted.update(dict.fromkeys(result.summary.emitted))
+        sources.update(result.summary.sources)
+        vocabulary.merge(result.summary.vocabulary)
+        if result.summary.errors:
+            errors.merge(result.summary.errors)
+    return UnitSummary(
+        list(emitted),
+        np.concatenate([_.summary.ids for _ in results] or [np.empty(0, ID_DTYPE)]),
+        np.concatenate(
+            [_.summary.references for _ in results] or [np.empty(0, REFERENCE_DTYPE)]
+        ),
+        sources,
+        vocabulary,
+        errors,
+    )
+
+
+class Skipped:
+    """Which units are skipped because an earlier unit emitted their type, as results come in.
+
+    Follows the merge in input order as far as the units' results are known, so a unit it
+    reports as skipped is skipped by the merge too.
+    """
+
+    def __init__(self, units: list[Unit], manifest: RunManifest):
+        """Initialize with nothing emitted."""
+        self.units = units
+        self.manifest = manifest
+        self.emitted: set[str] = set()
+        # the units before this position are known to be merged or skipped
+        self.position = 0
+        self.merged: set[str] = set()
+
+    def advance(
+        self,
+        results: dict[int, "ShardResult"],
+        shards_by_unit: dict[str, list[Shard]] | None,
+    ):
+        """Follow the merge through the units whose results are all in."""
+        while self.position < len(self.units):
+            unit = self.units[self.position]
+            if unit.name in self.emitted:
+                self.position += 1
+                continue
+            if unit.name == ASSAY:
+                # what the assay emits doesn't skip a unit, see plan_units
+                pass
+            elif self.manifest.reusable(unit):
+                self.emitted.update(self.manifest.outputs(unit))
+            elif shards_by_unit is None:
+                # the shards are not planned yet
+                return
+            else:
+                numbers = [_.number for _ in shards_by_unit.get(unit.name, [])]
+                if not all(_ in results for _ in numbers):
+                    return
+                for number in numbers:
+                    self.emitted.update(results[number].summary.emitted)
+            self.merged.add(unit.name)
+            self.position += 1
+
+    def skipped(self, name: str) -> bool:
+        """True if the unit is skipped, False if it is merged or not known yet.
+
+        A unit not reached yet whose type was emitted is skipped when it is, as emitted only grows.
+        """
+        return name in self.emitted and name not in self.merged
+
+
+def prep_sharded(
+    units: list[Unit],
+    output_path,
+    emitters,
+    manifest: RunManifest,
+    transformers: list[str],
+    research_study_id: str,
+    fhir_version: str,
+    seed: str | None,
+    workers: int,
+    spinner=None,
+    shard_bytes=None,
+    checkpoint: Checkpoint | None = None,
+    validation_cache: ValidationCache | None = None,
+    shape_sampler: ShapeSampler | StructuralSampler | None = None,
+    on_error: str = "exit",
+    metrics: RunMetrics | None = None,
+    tracer: Tracer | None = None,
+):
+    """Run the prep transformers over the units with a pool of worker processes.
+
+    Input files are split into line-aligned shards, the largest shards are scheduled first
+    and each worker writes its own per-resourceType files.  Outputs, ids, references and
+    vocabulary counts are then merged in input order, so the result is byte-identical to a
+    single process run.  With a checkpoint, completed shards are kept so a resumed run only
+    processes the rest.
+    """
+    kwargs: dict[str, Any] = dict(
+        research_study_id=research_study_id,
+        fhir_version=fhir_version,
+        seed=seed,
+        validation_cache=validation_cache,
+        shape_sampler=shape_sampler,
+        on_error=on_error,
+        metrics=metrics,
+        tracer=tracer,
+    )
+    # as in a single process run, a unit whose type an earlier unit emitted is skipped: known
+    # for the units reused from the last run before any is sent to the workers
+    skipped = Skipped(units, manifest)
+    skipped.advance({}, None)
+    pending = [
+        _ for _ in units if not (manifest.reusable(_) or skipped.skipped(_.name))
+    ]
+    first_number = 1
+    shards = plan_shards(
+        [pathlib.Path(_.inputs[0]) for _ in pending if _.name != ASSAY],
+        workers,
+        first_number,
+        shard_bytes,
+    )
+    shards_by_unit: dict[str, list[Shard]] = {}
+    for shard in shards:
+        shards_by_unit.setdefault(pathlib.Path(shard.path).stem, []).append(shard)
+
+    keep = checkpoint is not None and checkpoint.enabled
+    if keep:
+        assert checkpoint is not None
+        work_dir = str(checkpoint.shard_directory([_.name for _ in pending], shards))
+    else:
+        work_dir = tempfile.mkdtemp(prefix=".prep-shards-", dir=output_path)
+    kwargs["sync"] = keep
+    results: dict[int, ShardResult] = {}
+
+    def completed_before(number) -> bool:
+        """Add the result of a shard completed before the checkpoint."""
+        summary = checkpoint.shard_summary(number) if keep and checkpoint else None
+        if summary is None:
+            return False
+        results[number] = ShardResult(
+            number, str(pathlib.Path(work_dir) / f"{number:08d}"), summary
+        )
+        return True
+
+    context = multiprocessing.get_context("spawn")
+    executor = ProcessPoolExecutor(max_workers=workers, mp_context=context)
+    try:
+        futures: dict[Future, str] = {}
+        for unit in pending:
+            if unit.name == ASSAY and not completed_before(0):
+                input_path = pathlib.Path(unit.inputs[0]).parent
+                future = executor.submit(
+                    run_assay, 0, input_path, transformers, work_dir, **kwargs
+                )
+                futures[future] = ASSAY
+        for shard in sorted(shards, key=lambda _: _.size, reverse=True):
+            if completed_before(shard.number):
+                continue
+            future = executor.submit(run_shard, shard, transformers, work_dir, **kwargs)
+            futures[future] = pathlib.Path(shard.path).stem
+
+        total = len(results) + len(futures)
+        not_done = set(futures)
+        while not_done:
+            done, not_done = wait(not_done, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.cancelled():
+                    continue
+                result = future.result()
+                results[result.number] = result
+                if shape_sampler:
+                    shape_sampler.merge(*result.validated)
+                if metrics is not None and result.metrics:
+                    metrics.merge(result.metrics)
+                if tracer is not None and result.trace:
+                    tracer.merge(result.trace)
+                if keep and checkpoint:
+                    checkpoint.shard_done(result.number, result.summary)
+                if spinner:
+                    spinner.text = f"Processed shard {len(results)}/{total}"
+            # cancel the shards, not started yet, of the units now known to be skipped
+            skipped.advance(results, shards_by_unit)
+            for future in not_done:
+                if skipped.skipped(futures[future]):
+                    future.cancel()
+        executor.shutdown()
+
+        emitted = set()
+        for unit in units:
+            # as in a single process run, skip files whose type was already emitted
+            if unit.name in emitted:
+                continue
+            if manifest.reusable(unit):
+                summary = manifest.restore(unit, emitters)
+                label = f"{unit.name} unchanged"
+            else:
+                label = unit.name
+                if unit.name == ASSAY:
+                    unit_results = [results[0]]
+                else:
+                    unit_results = [
+                        results[_.number] for _ in shards_by_unit.get(unit.name, [])
+                    ]
+                manifest.begin(unit, emitters)
+                with traced(tracer, f"merge {unit.name}", "merge"):
+                    for result in unit_results:
+                        copy_output(result, emitters)
+                summary = combine(unit_results)
+                manifest.end(unit, emitters, summary)
+            prep_module.merge_summary(summary)
+            if unit.name != ASSAY:
+                emitted.update(summary.emitted)
+            if spinner:
+                spinner.succeed(label)
+                spinner.start()
+    except BaseException:
+        executor.shutdown(wait=False, cancel_futures=True)
+        raise
+    finally:
+        if not keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
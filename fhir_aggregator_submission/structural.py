@@ -0,0 +1,355 @@
+import datetime
+import functools
+import importlib.metadata
+import random
+import re
+import types
+import typing
+from typing import Any, Callable
+
+from fhir_aggregator_submission import models
+from fhir_aggregator_submission.fingerprint import DEFAULT_SAMPLE_RATE, REFERENCE
+
+# Formats of the primitives the models check with a pattern search, matched in full here and
+# as strict or stricter: a value that doesn't match is validated in full.
+STRING = re.compile(r"[^\s]")
+CODE = re.compile(r"[!-~]+( [!-~]+)*")
+URI = re.compile(r"\S+")
+BASE64 = re.compile(
+    r"([A-Za-z0-9+/]{4})*([A-Za-z0-9+/]{4}|[A-Za-z0-9+/]{2}==|[A-Za-z0-9+/]{3}=)"
+)
+# the models parse a url, this is the common http(s) and ftp ones they accept
+LABEL = r"[A-Za-z0-9]+(-+[A-Za-z0-9]+)*"
+URL = re.compile(
+    rf"(https?|ftp)://{LABEL}(\.{LABEL})*(:[0-9]{{1,4}})?([/?#][A-Za-z0-9\-._~!$&'()*+,;=:@/?#]*)?"
+)
+
+
+def is_string(value) -> bool:
+    return type(value) is str and STRING.search(value) is not None
+
+
+def is_date(value: str, pattern: re.Pattern) -> bool:
+    """A date, dateTime or instant that matches its pattern, with a day that exists and no leap second."""
+    if not pattern.fullmatch(value):
+        return False
+    if len(value) >= 10:
+        try:
+            datetime.date.fromisoformat(value[:10])
+        except ValueError:
+            return False
+    return value[17:19] != "60"
+
+
+def is_decimal(value, pattern: re.Pattern) -> bool:
+    return (type(value) is int or type(value) is float) and bool(
+        pattern.fullmatch(str(value))
+    )
+
+
+def is_resource(klass: Any) -> bool:
+    return any(_.__name__ == "Resource" for _ in klass.__mro__)
+
+
+def is_required(field) -> bool:
+    """A field required by the model, or a primitive element required by FHIR."""
+    extra = field.json_schema_extra or {}
+    return field.is_required() or extra.get("element_required", False)
+
+
+def chosen(resource: dict, keys: frozenset) -> int:
+    """The number of values of a choice type."""
+    return sum(resource[_] is not None for _ in keys.intersection(resource))
+
+
+def reject(value) -> bool:
+    """The check of a key that is not a field."""
+    return False
+
+
+class Generator:
+    """Generates the Python source of the validator of a resourceType from its model.
+
+    There is a function per model class reachable from the resource's, it returns True when a
+    dict has no keys but the model's fields, has its required elements, a list or a single
+    value as the field's cardinality, each primitive of its type and format, at most one value
+    of a choice type and well formed references.  Anything it doesn't check, contained
+    resources, primitive extensions (`_field`), nulls in lists and the less common primitive
+    types, make it return False, so the resource is validated in full.
+    """
+
+    def __init__(self, fhir_version: str, resource_type: str):
+        self.fhir_version = fhir_version
+        self.resource_type = resource_type
+        self.constants: dict[str, str] = {}
+        self.functions: dict[Any, str] = {}
+        self.sources: list[str] = []
+
+    def constant(self, name: str, value: str) -> str:
+        self.constants.setdefault(name, value)
+        return name
+
+    def pattern(self, name: str, pattern: str | re.Pattern) -> str:
+        if isinstance(pattern, re.Pattern):
+            pattern = pattern.pattern
+        return self.constant(name, f"re.compile({pattern!r})")
+
+    def primitive(self, annotation, value: str) -> str | None:
+        """The expression that checks a primitive value, None if it isn't checked here."""
+        if annotation is bool:
+            return f"type({value}) is bool"
+        if annotation is str:
+            return f"type({value}) is str"
+        if typing.get_origin(annotation) is not typing.Annotated:
+            return None
+        # the FHIR type is the last metadata, base64Binary has pydantic's EncodedBytes first
+        meta = annotation.__metadata__[-1]
+        kind = getattr(meta, "__visit_name__", None)
+        if kind == "string":
+            return f"is_string({value})"
+        if kind == "code":
+            return f"type({value}) is str and CODE.fullmatch({value})"
+        if kind in ("uri", "canonical"):
+            return f"type({value}) is str and URI.fullmatch({value})"
+        if kind == "url":
+            return f"type({value}) is str and URL.fullmatch({value})"
+        if kind == "base64Binary":
+            return f"type({value}) is str and BASE64.fullmatch({value})"
+        if kind == "markdown":
+            return f"is_string({value})"
+        if kind == "id":
+            pattern = f"[A-Za-z0-9\\-.]{{{meta.min_length},{meta.max_length}}}"
+            return f"type({value}) is str and {self.pattern('ID', pattern)}.fullmatch({value})"
+        if kind == "oid":
+            return f"type({value}) is str and {self.pattern('OID', meta.pattern)}.fullmatch({value})"
+        if kind in ("integer", "integer64", "unsignedInt", "positiveInt"):
+            return f"type({value}) is int and {meta.min_length} <= {value} <= {meta.max_length}"
+        if kind == "decimal":
+            return f"is_decimal({value}, {self.pattern('DECIMAL', meta.pattern)})"
+        if kind in ("date", "dateTime", "instant"):
+            name = self.pattern(kind.upper(), meta.pattern)
+            return f"type({value}) is str and is_date({value}, {name})"
+        if kind == "time":
+            name = self.pattern("TIME", meta.pattern)
+            return f'type({value}) is str and {name}.fullmatch({value}) and {value}[6:8] != "60"'
+        return None
+
+    def check(self, annotation, value: str, klass: Any, name: str) -> str | None:
+        """The expression that checks a single value of an annotation, None if it isn't checked here."""
+        if typing.get_origin(annotation) in (typing.Union, types.UnionType):
+            checks = [
+                self.check(_, value, klass, name)
+                for _ in typing.get_args(annotation)
+                if _ is not type(None)
+            ]
+            if None in checks:
+                return None
+            return " or ".join(f"({_})" for _ in checks)
+        if klass.get_resource_type() == "Reference" and name == "reference":
+            return f"type({value}) is str and REFERENCE.fullmatch({value})"
+        if hasattr(annotation, "get_model_klass"):
+            model = annotation.get_model_klass()
+            if is_resource(model) or model.__name__ == "FHIRPrimitiveExtension":
+                # contained resources and primitive extensions
+                return None
+            return f"{self.function(model)}({value})"
+        return self.primitive(annotation, value)
+
+    def field(self, klass: Any, name: str, field, function: str) -> str | None:
+        """The source of the function that checks a value of a field, None if it isn't checked here."""
+        annotation = field.annotation
+        args = typing.get_args(annotation)
+        if type(None) in args:
+            args = tuple(_ for _ in args if _ is not type(None))
+            annotation = args[0] if len(args) == 1 else typing.Union[args]
+        lines = [f"def {function}(v):"]
+        if name == "fhir_comments":
+            lines.append(
+                "    return type(v) is str or type(v) is list and all(type(_) is str for _ in v)"
+            )
+        elif typing.get_origin(annotation) in (list, typing.List):
+            item = self.check(typing.get_args(annotation)[0], "_", klass, name)
+            if item is None:
+                return None
+            # a required list has an item
+            empty = " or not v" if is_required(field) else ""
+            lines += [
+                f"    if type(v) is not list{empty}:",
+                "        return False",
+                "    for _ in v:",
+                f"        if not ({item}):",
+                "            return False",
+                "    return True",
+            ]
+        else:
+            check = self.check(annotation, "v", klass, name)
+            if check is None:
+                return None
+            lines.append(f"    return bool({check})")
+        return "\n".join(lines)
+
+    def function(self, klass: Any) -> str:
+        """The name of the function that checks a dict of the model class, generated the first time.
+
+        It looks up the function of each key of the dict, a key without one is not a field, or a
+        field not checked here.
+        """
+        if klass in self.functions:
+            return self.functions[klass]
+        name = f"{klass.__name__}_"
+        while name in self.functions.values():
+            name += "_"
+        self.functions[klass] = name
+        fields: dict[str, str] = {}
+        required: list[str] = []
+        choices: dict[str, list[str]] = {}
+        choices_required: dict[str, bool] = {}
+        sources = []
+        if is_resource(klass):
+            resource_type = klass.get_resource_type()
+            fields["resourceType"] = f"{name}resourceType"
+            required.append("resourceType")
+            sources.append(
+                f"def {name}resourceType(v):\n    return v == {resource_type!r}"
+            )
+        for field_name, field in klass.model_fields.items():
+            if field.alias.startswith("_"):
+                continue
+            extra = field.json_schema_extra or {}
+            if extra.get("one_of_many"):
+                choices.setdefault(extra["one_of_many"], []).append(field.alias)
+                choices_required[extra["one_of_many"]] = extra.get(
+                    "one_of_many_required", False
+                )
+            if is_required(field):
+                required.append(field.alias)
+            source = self.field(klass, field_name, field, f"{name}{field.alias}")
+            if source is not None:
+                fields[field.alias] = f"{name}{field.alias}"
+                sources.append(source)
+        sources.append(
+            f"{name}FIELDS = {{"
+            + "".join(f"\n    {k!r}: {v}," for k, v in fields.items())
+            + "\n}"
+        )
+        lines = [
+            f"def {name}(d):",
+            "    if type(d) is not dict:",
+            "        return False",
+            "    for k, v in d.items():",
+            f"        if v is not None and not {name}FIELDS.get(k, reject)(v):",
+            "            return False",
+        ]
+        if required:
+            condition = " or ".join(f"d.get({_!r}) is None" for _ in required)
+            lines += [f"    if {condition}:", "        return False"]
+        for prefix, aliases in choices.items():
+            keys = self.constant(
+                f"{name}{prefix.upper()}", f"frozenset({sorted(aliases)!r})"
+            )
+            condition = "!= 1" if choices_required[prefix] else "> 1"
+            lines += [f"    if chosen(d, {keys}) {condition}:", "        return False"]
+        lines.append("    return True")
+        sources.append("\n".join(lines))
+        self.sources.append("\n\n\n".join(sources))
+        return name
+
+    def generate(self) -> str:
+        """The source of a module whose `validate` function checks a resource of the resourceType."""
+        klass = models.model_class(self.fhir_version, self.resource_type)
+        name = self.function(klass)
+        version = importlib.metadata.version("fhir.resources")
+        header = [
+            f"# Generated by fhir_aggregator_submission.structural from the fhir.resources {version}"
+            f" {self.fhir_version} {self.resource_type} model, don't edit.",
+            "import re",
+            "",
+            "from fhir_aggregator_submission.structural import BASE64, CODE, REFERENCE, URI, URL, chosen, is_date, is_decimal, is_string, reject",
+            "",
+            *[f"{k} = {v}" for k, v in self.constants.items()],
+        ]
+        footer = [
+            "def validate(resource):",
+            f"    return {name}(resource) and resource.get('id') is not None",
+        ]
+        return (
+            "\n\n\n".join(["\n".join(header), *self.sources, "\n".join(footer)]) + "\n"
+        )
+
+
+@functools.cache
+def load(fhir_version: str, resource_type: str) -> Callable[[dict], bool]:
+    """The validator of a resourceType, generated the first time in each process.
+
+    Validators are only generated in memory, never read back from a cache a user could edit.  A
+    resourceType without a model gets a validator that always returns False, full validation
+    reports it.
+    """
+    if not resource_type.isalnum():
+        return reject
+    try:
+        source = Generator(fhir_version, resource_type).generate()
+    except ValueError:
+        return reject
+    namespace: dict[str, Any] = {}
+    exec(
+        compile(source, f"<structural {fhir_version} {resource_type}>", "exec"),
+        namespace,
+    )
+    return namespace["validate"]
+
+
+class StructuralSampler:
+    """Decides which resources are validated in full with `--validate-mode structural`.
+
+    A resource is checked by the validator generated for its resourceType, see `Generator`; the
+    resources it doesn't pass and a random sample of the others are validated in full.
+    """
+
+    def __init__(self, fhir_version: str, sample_rate: float = DEFAULT_SAMPLE_RATE):
+        """Initialize the sampler, validators are generated for the resourceTypes seen."""
+        self._clear(fhir_version, sample_rate)
+
+    def _clear(self, fhir_version: str, sample_rate: float):
+        self.fhir_version = fhir_version
+        self.sample_rate = sample_rate
+        self._validators: dict[str, Callable[[dict], bool]] = {}
+        self._random = random.Random()
+        self.full = 0
+        self.structural = 0
+
+    def __getstate__(self):
+        # a worker process generates the validators itself
+        return {"fhir_version": self.fhir_version, "sample_rate": self.sample_rate}
+
+    def __setstate__(self, state):
+        self._clear(state["fhir_version"], state["sample_rate"])
+
+    def check(self, resource: dict) -> bool:
+        """True if the resource passed its structural validator and was not sampled.
+
+        False if it needs validating in full.
+        """
+        resource_type = resource["resourceType"]
+        validator = self._validators.get(resource_type)
+        if validator is None:
+            validator = self._validators[resource_type] = load(
+                self.fhir_version, resource_type
+            )
+        if self._random.random() >= self.sample_rate and validator(resource):
+            self.structural += 1
+            return True
+        self.full += 1
+        return False
+
+    def learn(self, resource: dict):
+        """The validators are generated from the models, nothing is learned from a resource."""
+
+    def merge(self, full: int, structural: int):
+        """Add the counts of a worker."""
+        self.full += full
+        self.structural += structural
+
+    def report(self) -> str:
+        """A one line summary of how the resources were validated."""
+        return f"Validated {self.full:,} resources in full, {self.structural:,} structurally"
@@ -0,0 +1,280 @@
+import hashlib
+import pathlib
+import random
+import uuid
+from typing import Callable, Iterator, NamedTuple
+
+import orjson
+
+PART_OF_STUDY = "http://fhir-aggregator.org/fhir/StructureDefinition/part-of-study"
+US_CORE = "http://hl7.org/fhir/us/core/StructureDefinition"
+CODE_SYSTEM = "https://fhir-aggregator.org/fhir/CodeSystem/synthetic"
+GDC = "https://gdc.cancer.gov"
+
+RACES = ["white", "black or african american", "asian", "not reported"]
+ETHNICITIES = ["not hispanic or latino", "hispanic or latino", "not reported"]
+SPECIMEN_TYPES = ["Primary Tumor", "Solid Tissue Normal", "Blood Derived Normal"]
+# (data format, content type, experimental strategy)
+DATA_FORMATS = [
+    ("VCF", "application/gzip", "WXS"),
+    ("BAM", "application/octet-stream", "RNA-Seq"),
+    ("TSV", "text/tab-separated-values", "Genotyping Array"),
+    ("SVS", "image/tiff", "Tissue Slide"),
+]
+
+
+class Cardinalities(NamedTuple):
+    """How many resources of each type a synthetic Patient has."""
+
+    specimens_per_patient: int = 2
+    documents_per_specimen: int = 2
+    observations_per_patient: int = 10
+    # distinct Observation codes, the size of the vocabulary
+    codes: int = 100
+    # documents are about a Group of one Specimen, that becomes an assay, or the Specimen itself
+    document_subject: str = "group"
+
+    def per_patient(self) -> int:
+        """Resources per Patient, including itself."""
+        specimens = self.specimens_per_patient
+        groups = specimens if self.document_subject == "group" else 0
+        documents = specimens * self.documents_per_specimen
+        return 1 + specimens + groups + documents + self.observations_per_patient
+
+    def patients(self, resources: int) -> int:
+        """The number of Patients for a study of about `resources` resources."""
+        return max(1, (resources - 1) // self.per_patient())
+
+
+def resource_id(study_id: str, resource_type: str, number: int) -> str:
+    """The id of the number'th resource of a type, the same for every run.
+
+    The same as uuid.uuid5(uuid.NAMESPACE_URL, f"{study_id}/{resource_type}/{number}"),
+    without building a UUID object, that was most of the generation time.
+    """
+    name = f"{study_id}/{resource_type}/{number}".encode()
+    digest = bytearray(hashlib.sha1(uuid.NAMESPACE_URL.bytes + name).digest()[:16])
+    digest[6] = digest[6] & 0x0F | 0x50
+    digest[8] = digest[8] & 0x3F | 0x80
+    h = digest.hex()
+    return f"{h[:8]}-{h[8:12]}-{h[12:16]}-{h[16:20]}-{h[20:]}"
+
+
+def coding(system: str, code: str, display: str | None = None) -> dict:
+    return {"system": system, "code": code, "display": display or code}
+
+
+class Study:
+    """A synthetic study: its resources are numbered, each derived from its number and the seed.
+
+    Specimen s belongs to Patient s // specimens_per_patient, its Group (with
+    document_subject "group") has the same number, DocumentReference d is about Specimen
+    d // documents_per_specimen and Observation o about Patient o // observations_per_patient,
+    so references are consistent without keeping the resources in memory.
+    """
+
+    def __init__(
+        self, study_id: str, patients: int, cardinalities: Cardinalities, seed=0
+    ):
+        self.study_id = study_id
+        self.patients = patients
+        self.cardinalities = cardinalities
+        self.seed = seed
+        self.part_of = [
+            {
+                "url": PART_OF_STUDY,
+                "valueReference": {"reference": f"ResearchStudy/{study_id}"},
+            }
+        ]
+
+    def counts(self) -> dict[str, int]:
+        """The number of resources of each type."""
+        c = self.cardinalities
+        specimens = self.patients * c.specimens_per_patient
+        counts = {
+            "ResearchStudy": 1,
+            "Patient": self.patients,
+            "Specimen": specimens,
+            "Group": specimens if c.document_subject == "group" else 0,
+            "DocumentReference": specimens * c.documents_per_specimen,
+            "Observation": self.patients * c.observations_per_patient,
+        }
+        return {k: v for k, v in counts.items() if v}
+
+    def reference(self, resource_type: str, number: int) -> dict:
+        return {
+            "reference": f"{resource_type}/{resource_id(self.study_id, resource_type, number)}"
+        }
+
+    def research_study(self, number: int, rng: random.Random) -> dict:
+        return {
+            "resourceType": "ResearchStudy",
+            "id": self.study_id,
+            "extension": self.part_of,
+            "status": "active",
+            "title": f"Synthetic study {self.study_id}",
+            "identifier": [{"system": f"{GDC}/study_id", "value": self.study_id}],
+        }
+
+    def patient(self, number: int, rng: random.Random) -> dict:
+        gender = rng.choice(["male", "female"])
+        return {
+            "resourceType": "Patient",
+            "id": resource_id(self.study_id, "Patient", number),
+            "identifier": [
+                {"system": f"{GDC}/case_id", "value": f"{self.study_id}-{number:07d}"}
+            ],
+            "extension": [
+                *self.part_of,
+                {"url": f"{US_CORE}/us-core-birthsex", "valueCode": gender[0].upper()},
+                {"url": f"{US_CORE}/us-core-race", "valueString": rng.choice(RACES)},
+                {
+                    "url": f"{US_CORE}/us-core-ethnicity",
+                    "valueString": rng.choice(ETHNICITIES),
+                },
+                {
+                    "url": "http://hl7.org/fhir/SearchParameter/patient-extensions-Patient-age",
+                    "valueQuantity": {"value": rng.randint(18, 90)},
+                },
+            ],
+            "gender": gender,
+        }
+
+    def specimen(self, number: int, rng: random.Random) -> dict:
+        specimen_type = rng.choice(SPECIMEN_TYPES)
+        return {
+            "resourceType": "Specimen",
+            "id": resource_id(self.study_id, "Specimen", number),
+            "extension": self.part_of,
+            "subject": self.reference(
+                "Patient", number // self.cardinalities.specimens_per_patient
+            ),
+            "type": {"coding": [coding(f"{GDC}/sample_type", specimen_type)]},
+            "processing": [
+                {
+                    "method": {
+                        "coding": [
+                            coding(
+                                f"{GDC}/preservation_method",
+                                rng.choice(["FFPE", "OCT", "Frozen"]),
+                            )
+                        ]
+                    }
+                }
+            ],
+        }
+
+    def group(self, number: int, rng: random.Random) -> dict:
+        return {
+            "resourceType": "Group",
+            "id": resource_id(self.study_id, "Group", number),
+            "extension": self.part_of,
+            "type": "specimen",
+            "membership": "definitional",
+            "member": [{"entity": self.reference("Specimen", number)}],
+        }
+
+    def document_reference(self, number: int, rng: random.Random) -> dict:
+        specimen = number // self.cardinalities.documents_per_specimen
+        subject_type = (
+            "Group" if self.cardinalities.document_subject == "group" else "Specimen"
+        )
+        data_format, content_type, strategy = rng.choice(DATA_FORMATS)
+        file_id = resource_id(self.study_id, "file", number)
+        return {
+            "resourceType": "DocumentReference",
+            "id": resource_id(self.study_id, "DocumentReference", number),
+            "extension": self.part_of,
+            "identifier": [
+                {"use": "official", "system": f"{GDC}/file_id", "value": file_id}
+            ],
+            "version": "1",
+            "status": "current",
+            "type": {"coding": [coding(f"{GDC}/data_format", data_format)]},
+            "category": [
+                {"coding": [coding(f"{GDC}/experimental_strategy", strategy)]},
+                {"coding": [coding(f"{GDC}/platform", "Illumina")]},
+            ],
+            "subject": self.reference(subject_type, specimen),
+            "date": f"2022-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}T12:00:00Z",
+            "content": [
+                {
+                    "attachment": {
+                        "contentType": content_type,
+                        "url": f"https://api.gdc.cancer.gov/data/{file_id}",
+                        "size": rng.randint(1_000, 50_000_000_000),
+                        "hash": hashlib.md5(file_id.encode()).hexdigest(),
+                        "title": f"{file_id}.{data_format.lower()}",
+                    },
+                    "profile": [
+                        {"valueCoding": coding(f"{GDC}/data_format", data_format)}
+                    ],
+                }
+            ],
+        }
+
+    def observation(self, number: int, rng: random.Random) -> dict:
+        c = self.cardinalities
+        patient = number // c.observations_per_patient
+        # a few codes are common and most are rare, as in real studies
+        code = int(c.codes * rng.random() ** 2)
+        observation = {
+            "resourceType": "Observation",
+            "id": resource_id(self.study_id, "Observation", number),
+            "extension": self.part_of,
+            "status": "final",
+            "category": [
+                {
+                    "coding": [
+                        coding(
+                            "http://terminology.hl7.org/CodeSystem/observation-category",
+                            "laboratory",
+                            "Laboratory",
+                        )
+                    ]
+                }
+            ],
+            "code": {
+                "coding": [
+                    coding(CODE_SYSTEM, f"C{code:05d}", f"Synthetic code {code}")
+                ]
+            },
+            "subject": self.reference("Patient", patient),
+            "valueQuantity": {"value": round(rng.gauss(100, 15), 2), "unit": "mg/dL"},
+        }
+        if c.specimens_per_patient:
+            specimen = patient * c.specimens_per_patient + rng.randrange(
+                c.specimens_per_patient
+            )
+            observation["focus"] = [self.reference("Specimen", specimen)]
+        return observation
+
+    def resources(self, resource_type: str) -> Iterator[dict]:
+        """Yield the resources of a type, in order."""
+        make: Callable[[int, random.Random], dict] = {
+            "ResearchStudy": self.research_study,
+            "Patient": self.patient,
+            "Specimen": self.specimen,
+            "Group": self.group,
+            "DocumentReference": self.document_reference,
+            "Observation": self.observation,
+        }[resource_type]
+        # a generator per type, so the resources of a type don't depend on the other types' counts
+        rng = random.Random(f"{self.seed}/{resource_type}")
+        for number in range(self.counts()[resource_type]):
+            yield make(number, rng)
+
+    def write(
+        self, output_path, on_written: Callable[[str, int], None] | None = None
+    ) -> dict[str, int]:
+        """Write the study as a META directory, an NDJSON file per resourceType, and return the counts."""
+        output_path = pathlib.Path(output_path)
+        output_path.mkdir(parents=True, exist_ok=True)
+        counts = self.counts()
+        for resource_type in counts:
+            with open(output_path / f"{resource_type}.ndjson", "wb") as f:
+                for resource in self.resources(resource_type):
+                    f.write(orjson.dumps(resource, option=orjson.OPT_APPEND_NEWLINE))
+            if on_written:
+                on_written(resource_type, counts[resource_type])
+        return counts
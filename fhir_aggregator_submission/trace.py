@@ -0,0 +1,109 @@
+import contextlib
+import os
+import threading
+import time
+from typing import Iterable, Iterator
+
+import orjson
+
+from fhir_aggregator_submission.metrics import write_atomically
+
+# A batch span covers the resources transformed in at least this many seconds, so a long
+# run records a few spans a second rather than one per resource.
+BATCH_SECONDS = 0.05
+
+
+def _now() -> float:
+    """Microseconds on the monotonic clock, which is shared by the worker processes."""
+    return time.monotonic_ns() / 1000
+
+
+class Tracer:
+    """Spans of a prep run, written as Chrome trace events that Perfetto or chrome://tracing can show.
+
+    Input files, shards, the assay build, batches of transformer calls, the vocabulary
+    Observations and validate_references are spans.  A pool worker starts its own tracer,
+    its events are added to the parent's with `merge`.
+    """
+
+    def __init__(self):
+        self._clear()
+
+    def _clear(self):
+        self.started = _now()
+        self.pid = os.getpid()
+        self.events: list[dict] = []
+
+    def __getstate__(self):
+        return {}
+
+    def __setstate__(self, state):
+        self._clear()
+
+    def complete(self, name: str, category: str, start: float, end: float, args: dict):
+        """Add a span from start to end, in microseconds, see `_now`."""
+        self.events.append(
+            {
+                "name": name,
+                "cat": category,
+                "ph": "X",
+                "ts": start,
+                "dur": end - start,
+                "pid": self.pid,
+                "tid": threading.get_native_id(),
+                "args": args,
+            }
+        )
+
+    @contextlib.contextmanager
+    def span(self, name: str, category: str, **args):
+        """Record the enclosed block as a span."""
+        start = _now()
+        try:
+            yield
+        finally:
+            self.complete(name, category, start, _now(), args)
+
+    def batches(self, name: str, items: Iterable, seconds=BATCH_SECONDS) -> Iterator:
+        """Yield the items, recording a span for each batch of them processed in `seconds` or more."""
+        start = None
+        count = 0
+        for item in items:
+            now = _now()
+            if start is None:
+                start = now
+            elif now - start >= seconds * 1_000_000:
+                self.complete(name, "transform", start, now, {"resources": count})
+                start, count = now, 0
+            count += 1
+            yield item
+        if start is not None:
+            self.complete(name, "transform", start, _now(), {"resources": count})
+
+    def merge(self, events: list[dict]):
+        """Add the events of a worker."""
+        self.events.extend(events)
+
+    def save(self, path):
+        """Write the trace, its times relative to the start of the run."""
+        names = {}
+        for event in self.events:
+            names.setdefault(
+                event["pid"], "prep" if event["pid"] == self.pid else "prep worker"
+            )
+        metadata = [
+            {"name": "process_name", "ph": "M", "pid": pid, "args": {"name": name}}
+            for pid, name in names.items()
+        ]
+        events = [{**_, "ts": _["ts"] - self.started} for _ in self.events]
+        write_atomically(
+            path,
+            orjson.dumps({"traceEvents": metadata + events, "displayTimeUnit": "ms"}),
+        )
+
+
+def traced(tracer: Tracer | None, name: str, category: str, **args):
+    """tracer.span, or nothing when the run is not traced."""
+    if tracer is None:
+        return contextlib.nullcontext()
+    return tracer.span(name, category, **args)
@@ -1,10 +1,9 @@
-import importlib
 import click
 import json
-from pydantic import ValidationError
+import orjson
 
-# Import the R4 classes
-FHIR_CLASSES = importlib.import_module("fhir.resources.R4B")
+from fhir_aggregator_submission import models
+from fhir_aggregator_submission.ndjson import LineReader
 
 
 def transform_documentreference(resource):
@@ -234,6 +233,20 @@ def transform_medication(resource):
     return resource
 
 
+R4_TRANSFORMERS = {
+    "DocumentReference": transform_documentreference,
+    "BodyStructure": transform_bodystructure,
+    "Encounter": transform_encounter,
+    "Group": transform_group,
+    "ImagingStudy": transform_imagingstudy,
+    "MedicationAdministration": transform_medicationadministration,
+    "Medication": transform_medication,
+    "ResearchStudy": transform_researchstudy,
+    "ResearchSubject": transform_researchsubject,
+    "Specimen": transform_specimen,
+}
+
+
 def dispatch_transformation(resource: dict, *args, **kwargs) -> dict | None:
     """
     Dispatch the transformation of a resource based on its resourceType.
@@ -244,22 +257,9 @@ def dispatch_transformation(resource: dict, *args, **kwargs) -> dict | None:
     Returns:
     dict | None: The transformed resource or None if the resource should be skipped.
     """
-    transformers = {
-        "DocumentReference": transform_documentreference,
-        "BodyStructure": transform_bodystructure,
-        "Encounter": transform_encounter,
-        "Group": transform_group,
-        "ImagingStudy": transform_imagingstudy,
-        "MedicationAdministration": transform_medicationadministration,
-        "Medication": transform_medication,
-        "ResearchStudy": transform_researchstudy,
-        "ResearchSubject": transform_researchsubject,
-        "Specimen": transform_specimen,
-    }
-
     resource_type = resource.get("resourceType")
-    if resource_type in transformers:
-        return transformers[resource_type](resource)
+    if resource_type in R4_TRANSFORMERS:
+        return R4_TRANSFORMERS[resource_type](resource)
     else:
         return resource
 
@@ -275,10 +275,10 @@ def validate_r4_resource(resource):
     bool: True if the resource is valid, False otherwise.
     """
     try:
-        klass = FHIR_CLASSES.get_fhir_model_class(resource["resourceType"])
+        klass = models.model_class("R4", resource["resourceType"])
         _ = klass.model_validate(resource)
         return True  # If no exceptions, it's valid
-    except ValidationError as e:
+    except models.ValidationError as e:
         for error in e.errors():
             # Ignore the error about attachment.size, R4 has it as an unsignedInt, R5 has it as an integer64
             if ".".join([str(_) for _ in error["loc"]]) == "content.0.attachment.size":
@@ -322,9 +322,9 @@ def process_ndjson(input_ndjson, output_ndjson, validate, stop_on_first_error):
     validate (bool): Flag to validate transformed resources for R4 compliance.
     stop_on_first_error (bool): Flag to stop processing on the first error.
     """
-    with open(input_ndjson, "r") as infile, open(output_ndjson, "w") as outfile:
-        for line in infile:
-            resource = json.loads(line.strip())
+    with open(output_ndjson, "w") as outfile:
+        for line in LineReader(input_ndjson):
+            resource = orjson.loads(line)
             try:
                 transformed_resource = dispatch_transformation(resource)
                 if not transformed_resource:
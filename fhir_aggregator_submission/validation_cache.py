@@ -0,0 +1,183 @@
+import hashlib
+import importlib.metadata
+import os
+import pathlib
+import tempfile
+import time
+import uuid
+
+import numpy as np
+import orjson
+
+# The directory validated resources are remembered in, shared by all runs of prep.
+CACHE_ENV = "FHIR_AGGREGATOR_CACHE"
+# Entries not used for this many seconds are evicted when the cache is compacted.
+MAX_AGE = 30 * 24 * 60 * 60
+# Bytes the compacted cache may take, the least recently used entries are evicted past it.
+MAX_BYTES = 256 * 1024 * 1024
+# A hit refreshes the last use of an entry at most this often.
+TOUCH_INTERVAL = 24 * 60 * 60
+# Entries are (2, n) arrays, the resource hashes and the time they were last used.
+ENTRY_DTYPE = np.dtype("<u8")
+ENTRY_BYTES = 2 * ENTRY_DTYPE.itemsize
+INDEX_NAME = "validated.npy"
+SEGMENT_GLOB = "segment-*.npy"
+
+
+def default_directory() -> pathlib.Path:
+    """$FHIR_AGGREGATOR_CACHE, or fhir-aggregator-submission in the user's cache directory."""
+    if os.environ.get(CACHE_ENV):
+        return pathlib.Path(os.environ[CACHE_ENV])
+    base = os.environ.get("XDG_CACHE_HOME") or pathlib.Path.home() / ".cache"
+    return pathlib.Path(base) / "fhir-aggregator-submission"
+
+
+def resource_key(resource: dict) -> int:
+    """A 64-bit hash of the canonical serialization of a resource, its keys sorted."""
+    data = orjson.dumps(resource, option=orjson.OPT_SORT_KEYS)
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), "little")
+
+
+def _load(path) -> np.ndarray | None:
+    """Memory map a file of entries, None if it is missing or unreadable."""
+    try:
+        entries = np.load(path, mmap_mode="r")
+    except (OSError, ValueError):
+        return None
+    if entries.ndim != 2 or entries.shape[0] != 2 or entries.dtype != ENTRY_DTYPE:
+        return None
+    return entries
+
+
+def _save(path: pathlib.Path, entries: np.ndarray):
+    """Write entries to path, replacing it atomically."""
+    fd, tmp = tempfile.mkstemp(suffix=".tmp", dir=path.parent)
+    with os.fdopen(fd, "wb") as f:
+        np.save(f, np.ascontiguousarray(entries, dtype=ENTRY_DTYPE))
+    os.replace(tmp, path)
+
+
+def merge(
+    entries: list[np.ndarray], now: int, max_age: int = MAX_AGE, max_entries=None
+) -> np.ndarray:
+    """Merge entries into one per hash with its last use, sorted by hash.
+
+    Entries older than max_age are evicted, then the least recently used past max_entries.
+    """
+    if max_entries is None:
+        max_entries = MAX_BYTES // ENTRY_BYTES
+    if not entries:
+        return np.empty((2, 0), dtype=ENTRY_DTYPE)
+    merged = np.concatenate(entries, axis=1)
+    merged = merged[:, np.lexsort((merged[1], merged[0]))]
+    # the last, most recent, entry of each hash
+    last = np.ones(merged.shape[1], dtype=bool)
+    last[:-1] = merged[0, 1:] != merged[0, :-1]
+    merged = merged[:, last]
+    merged = merged[:, merged[1] >= max(now - max_age, 0)]
+    if merged.shape[1] > max_entries:
+        newest = np.argpartition(merged[1], -max_entries)[-max_entries:]
+        merged = merged[:, np.sort(newest)]
+    return merged
+
+
+class ValidationCache:
+    """The hashes of resources that passed validation, so later runs don't validate them again.
+
+    There is a cache per FHIR version and `fhir.resources` version, a resource is looked up
+    by the hash of its canonical serialization after the other transformers ran.  The cache is
+    a sorted, memory-mapped array of hashes and when they were last used; each process appends
+    what it validated to a segment file of its own, so worker processes and concurrent runs
+    don't write the same file.  `compact` merges the segments and evicts old entries.
+    """
+
+    def __init__(self, fhir_version: str, directory=None):
+        """Initialize the cache, nothing is read until a resource is looked up."""
+        directory = pathlib.Path(directory) if directory else default_directory()
+        version = importlib.metadata.version("fhir.resources")
+        self._clear(directory / f"{fhir_version}-fhir.resources-{version}")
+
+    def _clear(self, directory: pathlib.Path):
+        self.directory = directory
+        self._entries: np.ndarray | None = None
+        # hashes in segments and validated by this process
+        self._recent: set[int] = set()
+        # hashes validated or used by this process, not written yet
+        self._records: list[int] = []
+        self._now = int(time.time())
+
+    def __getstate__(self):
+        # a worker process reads the cache itself
+        return {"directory": self.directory}
+
+    def __setstate__(self, state):
+        self._clear(state["directory"])
+
+    def _load(self) -> np.ndarray:
+        entries = _load(self.directory / INDEX_NAME)
+        self._entries = (
+            entries if entries is not None else np.empty((2, 0), dtype=ENTRY_DTYPE)
+        )
+        for path in self.directory.glob(SEGMENT_GLOB):
+            segment = _load(path)
+            if segment is not None:
+                self._recent.update(segment[0].tolist())
+        return self._entries
+
+    def __contains__(self, key: int) -> bool:
+        entries = self._entries if self._entries is not None else self._load()
+        if key in self._recent:
+            return True
+        hashes = entries[0]
+        position = int(hashes.searchsorted(np.uint64(key)))
+        if position == len(hashes) or hashes[position] != key:
+            return False
+        if entries[1, position] < self._now - TOUCH_INTERVAL:
+            # refresh its last use, once
+            self._recent.add(key)
+            self._records.append(key)
+        return True
+
+    def add(self, key: int):
+        """Remember a resource that passed validation."""
+        self._recent.add(key)
+        self._records.append(key)
+
+    def take(self) -> list[int]:
+        """The hashes this process validated or used since the last flush, for another process to `add` instead."""
+        records, self._records = self._records, []
+        return records
+
+    def flush(self):
+        """Write what this process validated to a new segment, skipped if the directory is not writable."""
+        if not self._records:
+            return
+        records = np.array(self._records, dtype=ENTRY_DTYPE)
+        self._records = []
+        try:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            path = self.directory / f"segment-{uuid.uuid4().hex}.npy"
+            _save(path, np.stack([records, np.full_like(records, self._now)]))
+        except OSError:
+            pass
+
+    def compact(self, max_age: int = MAX_AGE, max_bytes: int = MAX_BYTES):
+        """Flush, then merge the segments into the cache and evict old entries."""
+        self.flush()
+        segments = sorted(self.directory.glob(SEGMENT_GLOB))
+        if not segments:
+            return
+        entries = [_load(_) for _ in [self.directory / INDEX_NAME, *segments]]
+        merged = merge(
+            [_ for _ in entries if _ is not None],
+            int(time.time()),
+            max_age,
+            max_bytes // ENTRY_BYTES,
+        )
+        try:
+            _save(self.directory / INDEX_NAME, merged)
+            for path in segments:
+                path.unlink(missing_ok=True)
+        except OSError:
+            return
+        self._clear(self.directory)
@@ -0,0 +1,174 @@
+import collections
+import importlib
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Any, NamedTuple
+
+import click
+import numpy as np
+import orjson
+
+from fhir_aggregator_submission import models
+from fhir_aggregator_submission import prep as prep_module
+from fhir_aggregator_submission.errors import ErrorReport
+from fhir_aggregator_submission.fingerprint import ShapeSampler
+from fhir_aggregator_submission.references import ReferenceIndex
+from fhir_aggregator_submission.structural import StructuralSampler
+from fhir_aggregator_submission.validation_cache import ValidationCache
+
+# Resources sent to a worker at a time.
+BATCH_SIZE = 1000
+# Batches in flight per worker, before submitting waits for the oldest.
+BATCHES_PER_WORKER = 2
+
+
+class BatchResult(NamedTuple):
+    """What a worker hands back for a batch: the ids and references of its resources, as hashes."""
+
+    ids: np.ndarray
+    references: np.ndarray
+    sources: dict[int, list[str]]
+    # the hashes of the resources validated, for the parent's validation cache
+    validated: list[int]
+    # resources validated in full and by their shape or structure, with --validate-mode
+    sampled: tuple[int, int]
+    # the message of the first resource that failed validation
+    error: str | None
+    # the resources that failed validation, with on_error="collect"
+    errors: ErrorReport | None
+
+
+# the worker's arguments, set once by `_start`
+_worker: dict[str, Any] = {}
+
+
+def _start(
+    fhir_version: str,
+    validation_cache: ValidationCache | None,
+    shape_sampler: ShapeSampler | StructuralSampler | None,
+    on_error: str,
+):
+    """Worker initializer: import the fhir.resources models once, for all the batches."""
+    importlib.import_module(models.FHIR_PACKAGES[fhir_version])
+    _worker.update(
+        fhir_version=fhir_version,
+        validation_cache=validation_cache,
+        shape_sampler=shape_sampler,
+        on_error=on_error,
+    )
+
+
+def validate_batch(batch: bytes) -> BatchResult:
+    """Worker: validate a batch of NDJSON resources, and collect their ids and references."""
+    shape_sampler = _worker["shape_sampler"]
+    validation_cache = _worker["validation_cache"]
+    fhir_version = _worker["fhir_version"]
+    collect = _worker["on_error"] == "collect"
+    index = ReferenceIndex()
+    errors = ErrorReport() if collect else None
+    message = None
+    try:
+        for line in batch.splitlines():
+            resource = orjson.loads(line)
+            error = prep_module.validation_error(
+                resource, fhir_version, validation_cache, shape_sampler
+            )
+            if error and errors is not None:
+                errors.add(resource, error)
+            elif error:
+                message = prep_module.error_message(resource, fhir_version, error)
+                break
+            index.add_resource(resource)
+        sampled = (0, 0)
+        if shape_sampler is not None:
+            sampled = (shape_sampler.full, shape_sampler.structural)
+            shape_sampler.full = shape_sampler.structural = 0
+        return BatchResult(
+            index.ids.to_array(),
+            index.references.to_array(),
+            index.sources,
+            validation_cache.take() if validation_cache is not None else [],
+            sampled,
+            message,
+            errors,
+        )
+    finally:
+        index.close()
+
+
+class ValidationPool:
+    """Validates resources in worker processes, while the main process reads and transforms.
+
+    Resources are serialized into batches of `batch_size` and validated by a pool of workers
+    that import the fhir.resources models once.  Workers send back the ids and references of
+    a batch as hashes, see `references.ReferenceIndex`, that are added to prep's index in the
+    order the resources were submitted.  Resources validated by a worker are added to the
+    validation_cache, and counted by the shape_sampler, of the main process.  With
+    on_error="collect", the resources that fail validation are added to prep's ERROR_REPORT.
+    """
+
+    def __init__(
+        self,
+        fhir_version: str,
+        workers: int,
+        validation_cache: ValidationCache | None = None,
+        shape_sampler: ShapeSampler | StructuralSampler | None = None,
+        on_error: str = "exit",
+        batch_size: int = BATCH_SIZE,
+    ):
+        """Start the pool, its workers import the models while the run starts."""
+        self.validation_cache = validation_cache
+        self.shape_sampler = shape_sampler
+        self.batch_size = batch_size
+        self.max_pending = workers * BATCHES_PER_WORKER
+        self._batch: list[bytes] = []
+        self._pending: collections.deque[Future] = collections.deque()
+        self._executor = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_start,
+            initargs=(fhir_version, validation_cache, shape_sampler, on_error),
+        )
+
+    def submit(self, resource: dict):
+        """Queue a resource for validation, waits for the oldest batch if too many are in flight."""
+        self._batch.append(orjson.dumps(resource))
+        if len(self._batch) >= self.batch_size:
+            self._send()
+
+    def _send(self):
+        if not self._batch:
+            return
+        batch, self._batch = b"\n".join(self._batch), []
+        self._pending.append(self._executor.submit(validate_batch, batch))
+        while len(self._pending) > self.max_pending:
+            self._merge(self._pending.popleft())
+
+    def _merge(self, future: Future):
+        result: BatchResult = future.result()
+        prep_module.REFERENCE_INDEX.extend(
+            result.ids, result.references, result.sources
+        )
+        if self.validation_cache is not None:
+            for key in result.validated:
+                self.validation_cache.add(key)
+        if self.shape_sampler is not None:
+            self.shape_sampler.merge(*result.sampled)
+        if result.errors:
+            prep_module.ERROR_REPORT.merge(result.errors)
+        if result.error:
+            self.close()
+            click.echo(result.error)
+            exit(1)
+
+    def drain(self):
+        """Wait until the resources submitted so far are validated and their ids and references collected."""
+        self._send()
+        while self._pending:
+            self._merge(self._pending.popleft())
+
+    def close(self):
+        """Stop the workers, without waiting for the batches in flight."""
+        self._batch = []
+        self._pending.clear()
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -4,6 +4,7 @@ from collections import defaultdict
 from typing import Any
 
 from fhir_aggregator_submission import find_key_with_path
+from fhir_aggregator_submission.codings import find_codings
 
 
 def tree() -> defaultdict:
@@ -12,7 +13,9 @@ def tree() -> defaultdict:
 
 
 def extract_coding_values(
-    resource: dict[str, Any], code_dict: dict[str, Any] | None
+    resource: dict[str, Any],
+    code_dict: dict[str, Any] | None,
+    fhir_version: str | None = None,
 ) -> dict[str, Any]:
     """
     Extracts coding values from `coding` and maintains a count dictionary.
@@ -20,6 +23,7 @@ def extract_coding_values(
     Args:
         resource (dict): A FHIR resource dictionary.
         code_dict (Dict[str, int], optional): A dictionary to store code display values and their counts. Defaults to defaultdict(int).
+        fhir_version (str, optional): With the FHIR version, only the elements of the resource that may hold a `coding` are visited, see `codings.find_codings`.
 
     Returns:
         Dict[str, int]: A recursive dictionary with code display values as keys and their counts as values.  Primary key is the resourceType + the first part of the path
@@ -28,12 +32,16 @@ def extract_coding_values(
     if not code_dict:
         code_dict = tree()
 
-    coding_matches = find_key_with_path(resource, "coding", ignored_keys=["extension"])
-    for coding_match in coding_matches:
-        path = coding_match["path"]
+    if fhir_version:
+        coding_matches = find_codings(resource, fhir_version)
+    else:
+        coding_matches = [
+            (_["path"][0], _["value"])
+            for _ in find_key_with_path(resource, "coding", ignored_keys=["extension"])
+        ]
+    for first, coding_list in coding_matches:
         # key is the resourceType + the first part of the path
-        key = f"{resource['resourceType']}.{path[0]}"
-        coding_list = coding_match["value"]
+        key = f"{resource['resourceType']}.{first}"
         for coding in coding_list:
             if "display" in coding:
                 if coding["display"] not in code_dict[key]:
@@ -293,14 +301,16 @@ class VocabularyCollector:
         """Initialize the VocabularyCollector."""
         self.research_study_vocabularies = defaultdict(make_dicts)
 
-    def collect(self, resource: dict[str, Any]) -> dict[str, Any]:
-        """Collect display values from a resource."""
+    def collect(
+        self, resource: dict[str, Any], fhir_version: str | None = None
+    ) -> dict[str, Any]:
+        """Collect display values from a resource, see `extract_coding_values` for fhir_version."""
 
         research_study_id = get_research_study_id(resource)
         coding_dict, extension_dict = self.research_study_vocabularies[
             research_study_id
         ]
-        coding_dict = extract_coding_values(resource, coding_dict)
+        coding_dict = extract_coding_values(resource, coding_dict, fhir_version)
         extension_dict = extract_extension_values(resource, extension_dict)
         self.research_study_vocabularies[research_study_id] = (
             coding_dict,
@@ -308,6 +318,52 @@ class VocabularyCollector:
         )
         return resource
 
+    def merge(self, other: "VocabularyCollector") -> "VocabularyCollector":
+        """Fold the counts of another collector into this one.
+
+        Merging collectors in input order yields the same histograms (and the same
+        first-seen ordering) as collecting every resource with a single collector.
+        """
+        for research_study_id, (
+            other_coding_dict,
+            other_extension_dict,
+        ) in other.research_study_vocabularies.items():
+            coding_dict, extension_dict = self.research_study_vocabularies[
+                research_study_id
+            ]
+            if other_coding_dict:
+                if not coding_dict:
+                    coding_dict = tree()
+                for key, values in other_coding_dict.items():
+                    for display, value in values.items():
+                        if display not in coding_dict[key]:
+                            coding_dict[key][display] = {**value, "count": 0}
+                        coding_dict[key][display]["count"] += value["count"]
+            if other_extension_dict:
+                if not extension_dict:
+                    extension_dict = tree()
+                for key, values in other_extension_dict.items():
+                    if "range" in values:
+                        if "range" not in extension_dict[key]:
+                            extension_dict[key] = {
+                                "range": {"min": sys.maxsize, "max": -sys.maxsize - 1}
+                            }
+                        _range = extension_dict[key]["range"]
+                        if values["range"]["min"] < _range["min"]:
+                            _range["min"] = values["range"]["min"]
+                        if values["range"]["max"] > _range["max"]:
+                            _range["max"] = values["range"]["max"]
+                        continue
+                    for code, value in values.items():
+                        if code not in extension_dict[key]:
+                            extension_dict[key][code] = {**value, "count": 0}
+                        extension_dict[key][code]["count"] += value["count"]
+            self.research_study_vocabularies[research_study_id] = (
+                coding_dict,
+                extension_dict,
+            )
+        return self
+
     def to_observations(self) -> list[dict[str, Any]]:
         """Convert the collected data into a FHIR Observation resource.
 
@@ -1,5 +1,18 @@
+import pathlib
+
+from click.testing import CliRunner
 from pytest import fixture
 
+from fhir_aggregator_submission import prep
+
+
+@fixture(autouse=True)
+def validation_cache_directory(tmp_path_factory, monkeypatch):
+    """Keep the validation cache of the runs under test out of the user's cache."""
+    directory = tmp_path_factory.mktemp("validation-cache")
+    monkeypatch.setenv("FHIR_AGGREGATOR_CACHE", str(directory))
+    return directory
+
 
 @fixture
 def research_study_id():
@@ -840,3 +853,116 @@ def document_references(research_study_id):
             ],
         },
     ]
+
+
+@fixture
+def meta_path(tmp_path, research_study, patients, document_references, research_study_id):
+    """A small, referentially consistent META directory."""
+    import copy
+    import orjson
+
+    part_of = [
+        {
+            "url": "http://fhir-aggregator.org/fhir/StructureDefinition/part-of-study",
+            "valueReference": {"reference": f"ResearchStudy/{research_study_id}"},
+        }
+    ]
+    research_study = {**research_study, "status": "active", "extension": part_of}
+    # drop the reference to a study that isn't part of this META directory
+    patients = [{**_, "extension": _["extension"][:-1]} for _ in patients]
+    patient_ids = [_["id"] for _ in patients]
+    specimens = [
+        {
+            "resourceType": "Specimen",
+            "id": specimen_id,
+            "subject": {"reference": f"Patient/{patient_id}"},
+            "extension": part_of,
+        }
+        for specimen_id, patient_id in zip(
+            ["62fd09c2-0615-5083-be89-5022807da126", "aaaa09c2-0615-5083-be89-5022807da126"],
+            patient_ids,
+        )
+    ]
+    groups = [
+        {
+            "resourceType": "Group",
+            "id": group_id,
+            "type": "specimen",
+            "membership": "definitional",
+            "extension": part_of,
+            "member": [{"entity": {"reference": member}}],
+        }
+        for group_id, member in [
+            ("0472b446-ffca-5fdc-9dd7-18e49ac9b1e2", f"Specimen/{specimens[1]['id']}"),
+            ("1111b446-ffca-5fdc-9dd7-18e49ac9b1e2", f"Specimen/{specimens[0]['id']}"),
+            ("2222b446-ffca-5fdc-9dd7-18e49ac9b1e2", f"Patient/{patient_ids[0]}"),
+        ]
+    ]
+    document_references = copy.deepcopy(document_references)
+    document_references[1]["subject"] = {"reference": f"Group/{groups[1]['id']}"}
+    document_reference = copy.deepcopy(document_references[0])
+    document_reference["id"] = "33333333-f3c2-52b2-ad65-37a035e00662"
+    document_reference["subject"] = {"reference": f"Group/{groups[2]['id']}"}
+    document_references.append(document_reference)
+    observations = [
+        {
+            "resourceType": "Observation",
+            "id": f"obs-{i}",
+            "status": "final",
+            "code": {
+                "coding": [
+                    {"system": "http://loinc.org", "code": f"c{i % 7}", "display": f"Code {i % 7}"}
+                ]
+            },
+            "subject": {"reference": f"Patient/{patient_ids[i % 2]}"},
+            "focus": [{"reference": f"Specimen/{specimens[i % 2]['id']}"}],
+            "valueString": "x" * (i % 13 + 1),
+        }
+        for i in range(300)
+    ]
+    path = tmp_path / "META"
+    path.mkdir()
+    for resource_type, resources in [
+        ("ResearchStudy", [research_study]),
+        ("Patient", patients),
+        ("Specimen", specimens),
+        ("Group", groups),
+        ("DocumentReference", document_references),
+        ("Observation", observations),
+    ]:
+        with open(path / f"{resource_type}.ndjson", "wb") as f:
+            for resource in resources:
+                f.write(orjson.dumps(resource, option=orjson.OPT_APPEND_NEWLINE))
+    return path
+
+
+class PrepRunner:
+    """Runs prep in process and returns what it wrote, the result of the last run is kept."""
+
+    def __init__(self, tmp_path):
+        self.tmp_path = tmp_path
+        self.result = None
+
+    @staticmethod
+    def outputs(output_path) -> dict[str, bytes]:
+        """The NDJSON files in output_path, by name."""
+        return {_.name: _.read_bytes() for _ in sorted(pathlib.Path(output_path).glob("*.ndjson"))}
+
+    def __call__(self, input_path, output_path, *args, exit_code=0) -> dict[str, bytes]:
+        """Run prep, check its exit code unless it is None, and return its outputs."""
+        self.result = CliRunner().invoke(prep.cli, ["prep", str(input_path), str(output_path), *args])
+        if exit_code is not None:
+            assert self.result.exit_code == exit_code, self.result.output
+        return self.outputs(output_path)
+
+    def compare(self, input_path, mode, *args, exit_code=0) -> dict[str, bytes]:
+        """Run prep with args, and with args and the options of a mode, check both wrote the same and return it."""
+        expected = self(input_path, self.tmp_path / "expected", *args, exit_code=exit_code)
+        assert self(input_path, self.tmp_path / "output", *args, *mode, exit_code=exit_code) == expected
+        return expected
+
+
+@fixture
+def run_prep(tmp_path):
+    """A PrepRunner, writing its comparisons to tmp_path."""
+    return PrepRunner(tmp_path)
@@ -0,0 +1,24 @@
+from fhir_aggregator_submission.assay_index import SpillingIndex
+
+
+def test_spilling_index():
+    with SpillingIndex(memory_budget=1000) as index:
+        for i in range(100):
+            index[f"Specimen/{i}"] = f"Patient/{i % 10}"
+        assert index.spilled
+        assert len(index) == 100
+        assert "Specimen/42" in index
+        assert "Specimen/100" not in index
+        assert index["Specimen/42"] == "Patient/2"
+        assert index.get("Specimen/100") is None
+        index["Specimen/42"] = b"bytes"
+        assert len(index) == 100
+        assert index["Specimen/42"] == b"bytes"
+
+
+def test_in_memory_index():
+    with SpillingIndex() as index:
+        index["a"] = "b"
+        assert not index.spilled
+        assert index["a"] == "b"
+        assert len(index) == 1
@@ -0,0 +1,55 @@
+import csv
+import json
+import pathlib
+import subprocess
+import sys
+
+from fhir_aggregator_submission.transform import R4_TRANSFORMERS
+
+MICRO = pathlib.Path(__file__).parents[2] / "benchmarks" / "micro.py"
+
+
+def micro(*args) -> subprocess.CompletedProcess:
+    return subprocess.run([sys.executable, str(MICRO), "--repeat", "1", *args], capture_output=True, text=True)
+
+
+def test_micro_benchmarks(tmp_path):
+    baseline = tmp_path / "baseline.json"
+    result = micro("--save", str(baseline), "transform_", "Emitters")
+    assert result.returncode == 0, result.stderr
+    timings = json.loads(baseline.read_text())
+    assert {_.__name__ for _ in R4_TRANSFORMERS.values()} | {"Emitters.emit"} == set(timings)
+    assert all(_ > 0 for _ in timings.values())
+
+    # a benchmark much slower than its baseline fails the comparison
+    baseline.write_text(json.dumps({name: seconds / 100 for name, seconds in timings.items()}))
+    result = micro("--compare", str(baseline), "Emitters")
+    assert result.returncode == 1
+    assert "Emitters.emit" in result.stdout and "REGRESSION" in result.stdout
+
+
+def test_scaling_benchmark(tmp_path):
+    scaling = MICRO.parent / "scaling.py"
+    args = [sys.executable, str(scaling), "--sizes", "200,400", "--transformers", "part-of,validate", "--transformers", "reseed", "--output", str(tmp_path)]
+    result = subprocess.run(args, capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
+    with open(tmp_path / "scaling.csv") as f:
+        rows = list(csv.DictReader(f))
+    assert [(row["transformers"], row["workers"], row["exit_code"]) for row in rows] == [("part-of,validate", "1", "0"), ("reseed", "1", "0")] * 2
+    assert all(int(row["resources_per_second"]) > 0 and float(row["peak_rss_mb"]) > 0 for row in rows)
+    assert (tmp_path / "scaling.md").read_text().count("\n") == 2 + len(rows)
+    assert (tmp_path / "scaling.svg").read_text().count("<polyline") == 2
+
+
+def test_memory_budgets(tmp_path):
+    memory = MICRO.parent / "memory.py"
+    result = subprocess.run([sys.executable, str(memory), "--resources", "3000"], capture_output=True, text=True)
+    assert result.returncode == 0, result.stdout + result.stderr
+    assert [_.split()[0] for _ in result.stdout.splitlines() if "MB of" in _] == ["read", "assay", "validate_references", "vocabulary", "prep"]
+
+    # a stage over its budget fails
+    budgets = tmp_path / "budgets.json"
+    budgets.write_text(json.dumps({"read": [0, 0]}))
+    result = subprocess.run([sys.executable, str(memory), "--resources", "3000", "--budgets", str(budgets), "read"], capture_output=True, text=True)
+    assert result.returncode == 1
+    assert "OVER BUDGET" in result.stdout
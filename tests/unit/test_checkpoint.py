@@ -0,0 +1,78 @@
+import pytest
+
+from fhir_aggregator_submission import prep
+from fhir_aggregator_submission.checkpoint import CHECKPOINT_DIR, CHECKPOINT_NAME
+
+TRANSFORMERS = "assay,r4,part-of,vocabulary,validate"
+
+
+def failing_plan(after):
+    """A TransformerPlan that raises after `after` resources, as if the run was interrupted."""
+
+    class FailingPlan(prep.TransformerPlan):
+        calls = 0
+
+        def __call__(self, resource):
+            FailingPlan.calls += 1
+            if FailingPlan.calls > after:
+                raise RuntimeError("interrupted")
+            return super().__call__(resource)
+
+    return FailingPlan
+
+
+@pytest.mark.parametrize("after", [3, 20, 150])
+@pytest.mark.parametrize("interval", ["0.000001", "300"])
+def test_resume(meta_path, tmp_path, monkeypatch, run_prep, after, interval):
+    expected = run_prep(meta_path, tmp_path / "expected", "--transformers", TRANSFORMERS)
+
+    output_path = tmp_path / "output"
+    with monkeypatch.context() as m:
+        m.setattr(prep, "TransformerPlan", failing_plan(after))
+        run_prep(meta_path, output_path, "--transformers", TRANSFORMERS, "--checkpoint-interval", interval, exit_code=None)
+    assert isinstance(run_prep.result.exception, RuntimeError)
+    assert (output_path / CHECKPOINT_NAME).exists()
+
+    assert run_prep(meta_path, output_path, "--transformers", TRANSFORMERS, "--checkpoint-interval", interval, "--resume") == expected
+    assert not (output_path / CHECKPOINT_NAME).exists()
+
+
+def test_resume_checks(meta_path, tmp_path, monkeypatch, run_prep):
+    output_path = tmp_path / "output"
+    run_prep(meta_path, output_path, "--transformers", TRANSFORMERS, "--resume", exit_code=1)
+    assert "No checkpoint" in run_prep.result.output
+
+    with monkeypatch.context() as m:
+        m.setattr(prep, "TransformerPlan", failing_plan(20))
+        run_prep(meta_path, output_path, "--transformers", TRANSFORMERS, "--checkpoint-interval", "300", exit_code=None)
+    run_prep(meta_path, output_path, "--transformers", TRANSFORMERS, "--resume", "--seed", "other", exit_code=1)
+    assert "different options" in run_prep.result.output
+
+    with open(meta_path / "Observation.ndjson", "ab") as f:
+        f.write((meta_path / "Observation.ndjson").read_bytes().splitlines(keepends=True)[0])
+    run_prep(meta_path, output_path, "--transformers", TRANSFORMERS, "--resume", exit_code=1)
+    assert "Input files changed" in run_prep.result.output
+
+
+def test_checkpoints_are_opt_in(meta_path, tmp_path, monkeypatch, run_prep):
+    output_path = tmp_path / "output"
+    with monkeypatch.context() as m:
+        m.setattr(prep, "TransformerPlan", failing_plan(20))
+        run_prep(meta_path, output_path, "--transformers", TRANSFORMERS, exit_code=None)
+    assert isinstance(run_prep.result.exception, RuntimeError)
+    assert not (output_path / CHECKPOINT_NAME).exists()
+    assert not (output_path / CHECKPOINT_DIR).exists()
+    run_prep(meta_path, output_path, "--transformers", TRANSFORMERS, "--resume", exit_code=1)
+    assert "No checkpoint" in run_prep.result.output
+
+
+def test_resume_checks_validation(meta_path, tmp_path, monkeypatch, run_prep):
+    """A run that validated by sampling is not resumed by one that validates every resource, or the other way."""
+    output_path = tmp_path / "output"
+    with monkeypatch.context() as m:
+        m.setattr(prep, "TransformerPlan", failing_plan(20))
+        run_prep(meta_path, output_path, "--transformers", TRANSFORMERS, "--checkpoint-interval", "300", "--validate-mode", "fingerprint", exit_code=None)
+    for args in [[], ["--validate-mode", "structural"], ["--validate-mode", "fingerprint", "--validate-sample", "0.5"], ["--validate-mode", "fingerprint", "--validation-cache"]]:
+        run_prep(meta_path, output_path, "--transformers", TRANSFORMERS, "--resume", *args, exit_code=1)
+        assert "different options" in run_prep.result.output
+    run_prep(meta_path, output_path, "--transformers", TRANSFORMERS, "--resume", "--validate-mode", "fingerprint")
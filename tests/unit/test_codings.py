@@ -0,0 +1,79 @@
+import copy
+
+from nested_lookup import nested_alter
+
+from fhir_aggregator_submission import codings, find_key_with_path
+from fhir_aggregator_submission.codings import find_codings, load_index
+from fhir_aggregator_submission.references import replace_references
+from fhir_aggregator_submission.synth import Cardinalities, Study
+from fhir_aggregator_submission.vocabulary import extract_coding_values, tree
+
+
+def walked(resource):
+    return [(_["path"][0], _["value"]) for _ in find_key_with_path(resource, "coding", ["extension"])]
+
+
+def mutated(resource):
+    """The resource with codings in extensions, a contained resource and keys that are not fields."""
+    resource = copy.deepcopy(resource)
+    coding = [{"system": "http://example.org", "code": "x"}]
+    resource["extension"] = [{"url": "http://example.org/e", "valueCodeableConcept": {"coding": coding}}]
+    resource["modifierExtension"] = [{"url": "http://example.org/m", "valueCodeableConcept": {"coding": coding}}]
+    resource["contained"] = [{"resourceType": "Observation", "code": {"coding": coding}, "extension": [{"valueCoding": {"coding": coding}}]}]
+    resource["unknown"] = {"nested": [{"coding": coding}]}
+    resource["meta"] = {"tag": coding, "security": coding}
+    return resource
+
+
+def test_find_codings(research_study, patients, document_references):
+    study = Study("S", 2, Cardinalities(specimens_per_patient=1, documents_per_specimen=1, observations_per_patient=2))
+    resources = [("R5", _) for resource_type in study.counts() for _ in study.resources(resource_type)]
+    resources += [("R4", _) for _ in [research_study, *patients, *document_references]]
+    for fhir_version, resource in resources:
+        for resource in [resource, mutated(resource)]:
+            assert find_codings(resource, fhir_version) == walked(resource)
+    # a resourceType without a model is walked
+    resource = {"resourceType": "NotAType", "code": {"coding": [{"code": "x"}]}}
+    assert find_codings(resource, "R5") == walked(resource) == [("code", [{"code": "x"}])]
+
+
+def test_index_is_cached(monkeypatch):
+    load_index.cache_clear()
+    assert load_index("R5", "Specimen") is not None
+    load_index.cache_clear()
+
+    def build_index(*args):
+        raise AssertionError("built again")
+
+    with monkeypatch.context() as m:
+        m.setattr(codings, "build_index", build_index)
+        index = load_index("R5", "Specimen")
+    assert index["root"] == "Specimen"
+    # only the fields that may hold a coding are walked
+    fields = index["types"]["Specimen"]
+    assert fields["type"] and not fields["extension"] and fields["receivedTime"] is None
+    load_index.cache_clear()
+
+
+def test_extract_coding_values(research_study, patients, document_references):
+    for resource in [research_study, *patients, *document_references]:
+        resource = mutated(resource)
+        walked_values, found_values = tree(), tree()
+        extract_coding_values(resource, walked_values)
+        extract_coding_values(resource, found_values, "R4")
+        assert walked_values == found_values
+
+
+def test_replace_references(document_references):
+    def callback(reference):
+        if isinstance(reference, dict):
+            return reference
+        return reference.upper()
+
+    for resource in document_references:
+        resource = copy.deepcopy(resource)
+        resource["contained"] = [{"resourceType": "Patient", "link": [{"other": {"reference": "Patient/a"}}]}]
+        resource["extension"] = [{"valueReference": {"reference": "Patient/b"}}]
+        expected = nested_alter(copy.deepcopy(resource), "reference", callback)
+        assert replace_references(resource, str.upper) is resource
+        assert resource == expected
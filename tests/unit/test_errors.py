@@ -0,0 +1,117 @@
+import orjson
+import pytest
+
+from fhir_aggregator_submission import models, prep
+from fhir_aggregator_submission.errors import ERRORS_NAME, ErrorReport, location
+
+
+def invalid(resource_type: str, **values):
+    resource = {"resourceType": resource_type, "id": f"{resource_type.lower()}-{len(values)}", **values}
+    try:
+        models.model_class("R4", resource_type).model_validate(resource)
+    except models.ValidationError as e:
+        return resource, e
+    raise AssertionError(resource)
+
+
+def test_error_report():
+    report = ErrorReport(max_examples=2)
+    assert not report
+    for _ in range(3):
+        report.add(*invalid("Patient", birthDate="2020-02-30"))
+    report.add(*invalid("Patient", birthDate="2020-02-30", gender=1))
+    report.add_references("Observation", "subject.reference", 3, ["Patient/missing"])
+    assert len(report) == 7
+    assert report.resource_types == {"Patient": 4}
+    assert report.locations == {"Patient": {"birthDate": 4, "gender": 1}}
+    # the fourth is kept as an example of its gender error
+    assert len(report.examples) == 3
+    assert report.examples[0]["errors"][0]["loc"] == "birthDate"
+    assert report.report().splitlines() == ["Validation errors: 4 resources, 3 references not found", "  Patient: 4", "    birthDate: 4", "    gender: 1", "  Observation subject.reference: 3 references not found"]
+    assert location("content.0.attachment.size") == "content.attachment.size"
+
+
+def test_merge_and_state():
+    examples = [invalid("Patient", birthDate="2020-02-30") for _ in range(15)]
+    single = ErrorReport()
+    for example in examples:
+        single.add(*example)
+    first, second = ErrorReport(), ErrorReport()
+    for example in examples[:7]:
+        first.add(*example)
+    for example in examples[7:]:
+        second.add(*example)
+    merged = ErrorReport.load(orjson.loads(orjson.dumps(first.state()))).merge(second)
+    assert merged.state() == single.state()
+    assert len(merged.examples) == 10
+
+
+@pytest.fixture
+def invalid_meta_path(meta_path):
+    """The META directory with two invalid Patients and a dangling reference."""
+    path = meta_path / "Patient.ndjson"
+    patients = [orjson.loads(_) for _ in path.read_bytes().splitlines()]
+    patients[0]["birthDate"] = "2020-02-30"
+    patients[-1]["birthDate"] = "2020-13-01"
+    patients[-1]["deceasedBoolean"] = "maybe"
+    path.write_bytes(b"".join(orjson.dumps(_) + b"\n" for _ in patients))
+    path = meta_path / "DocumentReference.ndjson"
+    documents = [orjson.loads(_) for _ in path.read_bytes().splitlines()]
+    documents[0]["subject"] = {"reference": "Patient/missing"}
+    path.write_bytes(b"".join(orjson.dumps(_) + b"\n" for _ in documents))
+    return meta_path
+
+
+def test_prep_collect(invalid_meta_path, tmp_path, run_prep):
+    run_prep(invalid_meta_path, tmp_path / "exit", exit_code=1)
+    assert not (tmp_path / "exit" / ERRORS_NAME).exists()
+
+    output_path = tmp_path / "collect"
+    outputs = run_prep(invalid_meta_path, output_path, "--on-error", "collect", exit_code=1)
+    assert "Validation errors: 2 resources, 1 references not found" in run_prep.result.output
+    # every resource was processed
+    assert "Observation.ndjson" in outputs
+
+    lines = [orjson.loads(_) for _ in (output_path / ERRORS_NAME).read_bytes().splitlines()]
+    assert lines[0] == {"kind": "summary", "resourceTypes": {"Patient": 2}, "locations": {"Patient": {"birthDate": 2, "deceasedBoolean": 1}}, "references": 1}
+    assert [_["kind"] for _ in lines[1:]] == ["resource", "resource", "reference"]
+    assert lines[1]["resource"]["birthDate"] == "2020-02-30"
+    assert {_["loc"] for _ in lines[2]["errors"]} == {"birthDate", "deceasedBoolean"}
+    assert lines[3] == {"kind": "reference", "resourceType": "DocumentReference", "path": "subject.reference", "count": 1, "examples": ["Patient/missing"]}
+
+
+class InterruptedPlan(prep.TransformerPlan):
+    """Raises after 40 resources, past the invalid Patients."""
+
+    calls = 0
+
+    def __call__(self, resource):
+        InterruptedPlan.calls += 1
+        if InterruptedPlan.calls > 40:
+            raise RuntimeError("interrupted")
+        return super().__call__(resource)
+
+
+def test_prep_collect_resume(invalid_meta_path, tmp_path, monkeypatch, run_prep):
+    run_prep(invalid_meta_path, tmp_path / "expected", "--on-error", "collect", exit_code=1)
+    output_path = tmp_path / "output"
+    args = ["--on-error", "collect", "--checkpoint-interval", "0.000001"]
+    with monkeypatch.context() as m:
+        m.setattr(prep, "TransformerPlan", InterruptedPlan)
+        run_prep(invalid_meta_path, output_path, *args, exit_code=None)
+    assert isinstance(run_prep.result.exception, RuntimeError)
+    run_prep(invalid_meta_path, output_path, *args, "--resume", exit_code=1)
+    assert (output_path / ERRORS_NAME).read_bytes() == (tmp_path / "expected" / ERRORS_NAME).read_bytes()
+
+
+def test_prep_collect_fingerprint(meta_path, tmp_path, run_prep):
+    """Every invalid resource of a shape is reported, the shape is only learned from one that passes."""
+    path = meta_path / "Patient.ndjson"
+    invalid_patients = [{"resourceType": "Patient", "id": f"invalid-{i}", "birthDate": "2020-02-30"} for i in range(5)]
+    path.write_bytes(b"".join(orjson.dumps(_) + b"\n" for _ in invalid_patients) + path.read_bytes())
+    run_prep.compare(meta_path, ["--validate-mode", "fingerprint", "--validate-sample", "0"], "--on-error", "collect", exit_code=1)
+    assert "Validation errors: 5 resources" in run_prep.result.output
+    report = (tmp_path / "output" / ERRORS_NAME).read_bytes()
+    assert report == (tmp_path / "expected" / ERRORS_NAME).read_bytes()
+    ids = [orjson.loads(_)["id"] for _ in report.splitlines()[1:]]
+    assert ids == [_["id"] for _ in invalid_patients]
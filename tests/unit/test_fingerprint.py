@@ -0,0 +1,73 @@
+import pickle
+import re
+
+from fhir_aggregator_submission.fingerprint import DATE_TIME, REFERENCE, ShapeSampler, fingerprint, formats, leaves
+
+
+def observation(i, **kwargs) -> dict:
+    return {
+        "resourceType": "Observation",
+        "id": f"obs-{i}",
+        "status": "final",
+        "subject": {"reference": f"Patient/{i}"},
+        "focus": [{"reference": f"Specimen/{_}"} for _ in range(i % 3 + 1)],
+        "effectiveDateTime": f"2020-01-{i % 28 + 1:02d}",
+        "valueInteger": i,
+        **kwargs,
+    }
+
+
+def test_fingerprint():
+    assert fingerprint(leaves(observation(1))) == fingerprint(leaves(observation(2)))
+    assert fingerprint(leaves(observation(1))) != fingerprint(leaves(observation(1, valueInteger="1")))
+    assert fingerprint(leaves(observation(1))) != fingerprint(leaves(observation(1, note=[])))
+    assert fingerprint(leaves(observation(1))) != fingerprint(leaves(observation(1, status=None)))
+
+
+def test_formats():
+    checks = formats(leaves(observation(1)))
+    assert checks["subject.reference"] == checks["focus.reference"] == REFERENCE
+    assert checks["effectiveDateTime"] == DATE_TIME
+    assert "status" not in checks
+    for value in ["Patient/1", "Patient/1/_history/2", "#p1", "urn:uuid:0b7c7e5a-1b4e-4f6a-8f3e-3c8e2b1f9a10", "https://example.org/fhir/Patient/1"]:
+        assert REFERENCE.fullmatch(value), value
+    for value in ["Patient", "patient/1", "Patient/", "Patient/a b"]:
+        assert not REFERENCE.fullmatch(value), value
+    for value in ["2020", "2020-01", "2020-01-31", "2020-01-31T10:00:00Z", "2020-01-31T10:00:00.123+05:00"]:
+        assert DATE_TIME.fullmatch(value), value
+    for value in ["2020-13", "2020-01-32", "2020-01-31T10:00:00", "20-01-01"]:
+        assert not DATE_TIME.fullmatch(value), value
+
+
+def test_shape_sampler():
+    sampler = ShapeSampler(sample_rate=0)
+    first = observation(0)
+    assert not sampler.check(first)
+    # a shape is only learned once a resource of it passed validation in full
+    assert not sampler.check(observation(1))
+    sampler.learn(first)
+    assert all(sampler.check(observation(i)) for i in range(1, 10))
+    # a new shape, and malformed primitives of a known one, are validated in full
+    assert not sampler.check(observation(10, valueInteger="10"))
+    assert not sampler.check(observation(11, subject={"reference": "Patient 11"}))
+    assert not sampler.check(observation(12, effectiveDateTime="yesterday"))
+    assert not sampler.check(observation(13, id="obs/13"))
+    assert (sampler.full, sampler.structural) == (6, 9)
+    assert sampler.report() == "Validated 6 resources in full, 9 by their shape"
+
+    sampler = ShapeSampler(sample_rate=1)
+    assert not any(sampler.check(observation(i)) for i in range(10))
+
+    # a worker process learns the shapes itself
+    worker = pickle.loads(pickle.dumps(ShapeSampler(sample_rate=0)))
+    assert (worker.sample_rate, worker.full) == (0, 0)
+    assert not worker.check(observation(0))
+
+
+def test_prep_fingerprint(meta_path, run_prep):
+    outputs = run_prep.compare(meta_path, ["--validate-mode", "fingerprint"])
+    match = re.search(r"Validated (\d+) resources in full, (\d+) by their shape", run_prep.result.output)
+    assert match, run_prep.result.output
+    full, structural = int(match[1]), int(match[2])
+    assert full + structural == sum(_.count(b"\n") for _ in outputs.values())
+    assert structural > full
@@ -0,0 +1,87 @@
+import shutil
+
+import orjson
+
+from fhir_aggregator_submission import models
+from fhir_aggregator_submission.incremental import MANIFEST_NAME, RunManifest, plan_units
+
+TRANSFORMERS = "assay,r4,part-of,vocabulary,validate"
+
+
+def reusable(meta_path, output_path, probe_path):
+    """The units a rerun would reuse, probed on a copy as prepare() moves the outputs aside."""
+    shutil.rmtree(probe_path, ignore_errors=True)
+    shutil.copytree(output_path, probe_path)
+    settings = orjson.loads((probe_path / MANIFEST_NAME).read_bytes())["settings"]
+    del settings["package_version"]
+    manifest = RunManifest(probe_path, settings)
+    units = plan_units(meta_path, TRANSFORMERS.split(","))
+    manifest.prepare(units)
+    return sorted(_.name for _ in units if manifest.reusable(_))
+
+
+def test_incremental_reuses_unchanged_units(meta_path, tmp_path, run_prep):
+    output_path = tmp_path / "output"
+    first = run_prep(meta_path, output_path, "--transformers", TRANSFORMERS, "--incremental")
+    assert (output_path / MANIFEST_NAME).exists()
+    assert reusable(meta_path, output_path, tmp_path / "probe") == ["Observation", "Patient", "ResearchStudy", "Specimen", "assay"]
+
+    # an unchanged rerun produces the same output
+    assert run_prep(meta_path, output_path, "--transformers", TRANSFORMERS, "--incremental") == first
+
+    # change one observation, only the Observation unit is reprocessed
+    lines = (meta_path / "Observation.ndjson").read_bytes().splitlines()
+    observation = orjson.loads(lines[0])
+    observation["code"]["coding"][0]["display"] = "Changed"
+    lines[0] = orjson.dumps(observation)
+    (meta_path / "Observation.ndjson").write_bytes(b"\n".join(lines) + b"\n")
+    assert reusable(meta_path, output_path, tmp_path / "probe") == ["Patient", "ResearchStudy", "Specimen", "assay"]
+
+    incremental = run_prep(meta_path, output_path, "--transformers", TRANSFORMERS, "--incremental")
+    assert incremental == run_prep(meta_path, tmp_path / "fresh", "--transformers", TRANSFORMERS)
+    assert incremental != first
+
+
+def test_incremental_settings_change(meta_path, tmp_path, run_prep):
+    output_path = tmp_path / "output"
+    run_prep(meta_path, output_path, "--transformers", TRANSFORMERS, "--incremental")
+    manifest = orjson.loads((output_path / MANIFEST_NAME).read_bytes())
+    settings = {k: v for k, v in manifest["settings"].items() if k != "package_version"}
+    assert settings == {
+        "transformers": TRANSFORMERS.split(","),
+        "seed": None,
+        "fhir_version": "R4",
+        "research_study_id": "test-research-study-id",
+    }
+    changed = RunManifest(output_path, {**settings, "seed": "other"})
+    changed.prepare(plan_units(meta_path, TRANSFORMERS.split(",")))
+    assert not any(changed.reusable(_) for _ in plan_units(meta_path, TRANSFORMERS.split(",")))
+
+
+def test_incremental_validation_change(meta_path, tmp_path, monkeypatch, run_prep):
+    """Units validated by their shape are validated again by a run that validates every resource."""
+    validated = []
+    model_validate = models.model_class("R4", "Patient").model_validate.__func__
+
+    def counting_validate(klass, resource, *args, **kwargs):
+        validated.append(resource["resourceType"])
+        return model_validate(klass, resource, *args, **kwargs)
+
+    monkeypatch.setattr(models.model_class("R4", "Patient"), "model_validate", classmethod(counting_validate))
+    # Patients of the same shape, the fingerprint run validates only the first in full
+    path = meta_path / "Patient.ndjson"
+    patient = orjson.loads(path.read_bytes().splitlines()[0])
+    path.write_bytes(path.read_bytes() + b"".join(orjson.dumps({**patient, "id": f"copy-{i}"}) + b"\n" for i in range(3)))
+    output_path = tmp_path / "output"
+    sampled = run_prep(meta_path, output_path, "--transformers", TRANSFORMERS, "--incremental", "--validate-mode", "fingerprint", "--validate-sample", "0")
+    settings = orjson.loads((output_path / MANIFEST_NAME).read_bytes())["settings"]
+    assert (settings["validate_mode"], settings["validate_sample"]) == ("fingerprint", 0)
+    patients = len((meta_path / "Patient.ndjson").read_bytes().splitlines())
+    assert validated.count("Patient") < patients
+    validated.clear()
+    assert run_prep(meta_path, output_path, "--transformers", TRANSFORMERS, "--incremental") == sampled
+    assert validated.count("Patient") == patients
+    # an unchanged fully validated rerun reuses the units
+    validated.clear()
+    run_prep(meta_path, output_path, "--transformers", TRANSFORMERS, "--incremental")
+    assert validated == []
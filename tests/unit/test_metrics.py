@@ -0,0 +1,57 @@
+import pickle
+import re
+
+import orjson
+
+from fhir_aggregator_submission.metrics import RunMetrics, to_prometheus
+
+
+def test_run_metrics():
+    metrics = RunMetrics()
+    drop_odd = metrics.timed("Observation", "r4", lambda resource: None if resource["id"] % 2 else resource)
+    resources = metrics.timed_iter("read", (({"resourceType": "Observation", "id": i}, None) for i in range(5)))
+    kept = [_ for _ in (drop_odd(resource) for resource, _ in resources) if _]
+    assert len(kept) == 3
+    assert metrics.stages[("Observation", "read")][:2] == [5, 5]
+    assert metrics.stages[("Observation", "r4")][:2] == [5, 3]
+    assert metrics.functions[("Observation", "r4")] == "<lambda>"
+
+    # a worker starts empty, its metrics are added to the parent's
+    worker = pickle.loads(pickle.dumps(metrics))
+    assert worker.stages == {}
+    worker.timed("Observation", "r4", lambda resource: resource)({"id": 0})
+    worker.read("Observation", 100)
+    metrics.merge(worker.to_dict())
+    assert metrics.stages[("Observation", "r4")][:2] == [6, 4]
+    assert metrics.bytes_read == {"Observation": 100}
+
+    report = metrics.report({"Observation": 10}, study="s")
+    r4 = next(_ for _ in report["stages"] if _["stage"] == "r4")
+    assert (r4["resources_in"], r4["resources_out"], r4["dropped"]) == (6, 4, 2)
+    assert report["resource_types"]["Observation"]["resources_read"] == 5
+    text = to_prometheus(report, {"study": 'a "quoted" study'})
+    assert 'fa_submit_prep_stage_dropped{study="a \\"quoted\\" study",resource_type="Observation",stage="r4"} 2' in text
+
+
+def test_prep_metrics(meta_path, tmp_path, run_prep):
+    output_path = tmp_path / "output"
+    metrics_path = tmp_path / "metrics.json"
+    textfile = tmp_path / "metrics.prom"
+    outputs = run_prep(meta_path, output_path, "--metrics", str(metrics_path), "--metrics-textfile", str(textfile))
+    report = orjson.loads(metrics_path.read_bytes())
+    assert report["study"] == "test-research-study-id"
+    assert report["peak_rss_bytes"] > 0
+    for name, data in outputs.items():
+        totals = report["resource_types"][name.removesuffix(".ndjson")]
+        assert totals["resources_written"] == data.count(b"\n")
+        assert totals["bytes_written"] == len(data)
+    stages = {(_["resource_type"], _["stage"]): _ for _ in report["stages"]}
+    assert stages[("Observation", "validate")]["resources_in"] == stages[("Observation", "read")]["resources_out"]
+    assert stages[("Observation", "part-of")]["function"] == "apply_part_of"
+    assert ("ServiceRequest", "assay") in stages
+    assert ("", "validate_references") in stages
+    assert report["bytes_read"] > 0
+
+    lines = textfile.read_text().splitlines()
+    assert all(re.fullmatch(r"# (HELP|TYPE) \w+ .+|\w+\{.*\} \S+", _) for _ in lines)
+    assert any(_.startswith('fa_submit_prep_stage_wall_seconds{study="test-research-study-id",resource_type="Observation",stage="validate"}') for _ in lines)
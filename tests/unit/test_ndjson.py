@@ -0,0 +1,81 @@
+import orjson
+import pytest
+
+from fhir_aggregator_submission import ndjson, shard
+from fhir_aggregator_submission.ndjson import LineReader, count_lines, index_path, line_offsets
+
+LINES = [orjson.dumps({"resourceType": "Observation", "id": "x" * (i % 11) + str(i)}) + b"\n" for i in range(50)]
+
+
+@pytest.fixture
+def path(tmp_path):
+    path = tmp_path / "Observation.ndjson"
+    path.write_bytes(b"".join(LINES))
+    return path
+
+
+@pytest.mark.parametrize("data", [b"", b"{}", b"{}\n", b"{}\n{}", b"\n\n{}\n"])
+def test_line_offsets(tmp_path, data):
+    path = tmp_path / "lines.ndjson"
+    path.write_bytes(data)
+    expected = [0]
+    for line in data.splitlines(keepends=True):
+        expected.append(expected[-1] + len(line))
+    assert line_offsets(path, cache=False).tolist() == expected
+    assert [bytes(_) for _ in LineReader(path)] == data.splitlines(keepends=True)
+
+
+def test_line_offsets_scanned_in_chunks(path, monkeypatch):
+    monkeypatch.setattr(ndjson, "SCAN_BYTES", 7)
+    assert count_lines(path) == len(LINES)
+    index_path(path).unlink()
+    assert [bytes(_) for _ in LineReader(path, len(LINES[0]))] == LINES[1:]
+
+
+def test_pages_released(tmp_path, monkeypatch):
+    # lines over several pages, their pages are released as they are read, and read back if used
+    lines = [orjson.dumps({"resourceType": "Observation", "id": str(i), "text": "x" * 3000}) + b"\n" for i in range(20)]
+    path = tmp_path / "Observation.ndjson"
+    path.write_bytes(b"".join(lines))
+    monkeypatch.setattr(ndjson, "RELEASE_BYTES", 1)
+    monkeypatch.setattr(ndjson, "SCAN_BYTES", 5000)
+    read = list(LineReader(path))
+    assert [bytes(_) for _ in read] == lines
+    assert [bytes(_) for _ in LineReader(path, len(lines[0]))] == lines[1:]
+
+
+def test_index_cached(path):
+    assert not index_path(path).exists()
+    assert len(LineReader(path)) == len(LINES)
+    assert index_path(path).exists()
+    assert LineReader(path).line(7) == LINES[7]
+
+    # rebuilt once the file changes
+    path.write_bytes(b"".join(LINES[:10]))
+    assert count_lines(path) == 10
+    assert LineReader(path).line(9) == LINES[9]
+
+
+@pytest.mark.parametrize("cached", [False, True])
+def test_read_range(path, cached, monkeypatch):
+    monkeypatch.setattr(ndjson, "BATCH_LINES", 3)
+    if cached:
+        line_offsets(path)
+    start = sum(len(_) for _ in LINES[:5])
+    end = start + sum(len(_) for _ in LINES[5:20])
+    reader = LineReader(path, start, end)
+    lines = list(reader)
+    assert all(isinstance(_, memoryview) for _ in lines)
+    assert [orjson.loads(_) for _ in lines] == [orjson.loads(_) for _ in LINES[5:20]]
+    assert reader.position == end
+
+
+def test_shards_from_index(path):
+    size = path.stat().st_size
+    for shard_bytes in [1, 30, 100, size - 1, size]:
+        offsets = shard.line_aligned_offsets(path, shard_bytes)
+        assert offsets[0] == 0 and offsets[-1] == size
+        # each shard ends at the first line boundary past shard_bytes
+        starts = line_offsets(path).tolist()
+        for start, end in zip(offsets, offsets[1:-1]):
+            assert end == min(_ for _ in starts if _ > start + shard_bytes)
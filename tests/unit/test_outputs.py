@@ -0,0 +1,89 @@
+import pytest
+
+from fhir_aggregator_submission import prep
+from fhir_aggregator_submission.outputs import output_parts, parse_part_name, part_name, read_range
+
+TRANSFORMERS = "assay,r4,part-of,vocabulary,validate"
+
+LINES = [f'{{"resourceType": "Observation", "id": "{"x" * (i % 7)}{i}"}}\n'.encode() for i in range(100)]
+
+
+def test_part_names():
+    assert part_name("Observation") == "Observation.ndjson"
+    assert part_name("Observation", 12) == "Observation.0012.ndjson"
+    assert parse_part_name("Observation.0012.ndjson") == ("Observation", 12)
+    assert parse_part_name("Observation.ndjson") == ("Observation", 0)
+
+
+@pytest.mark.parametrize("limits", [dict(max_bytes=200), dict(max_lines=7), dict(max_bytes=300, max_lines=5), dict(max_bytes=10)])
+def test_roll_over(tmp_path, run_prep, limits):
+    emitters = prep.Emitters(tmp_path / "lines", **limits)
+    (tmp_path / "lines").mkdir()
+    for line in LINES:
+        emitters.write("Observation", line)
+    emitters.write("Patient", b'{"resourceType": "Patient", "id": "1"}\n')
+    emitters.close()
+    expected = run_prep.outputs(tmp_path / "lines")
+    assert "Patient.ndjson" in expected
+    assert "Observation.ndjson" not in expected
+    parts = output_parts(tmp_path / "lines", "Observation")
+    assert [_.name for _ in parts] == [part_name("Observation", i + 1) for i in range(len(parts))]
+    assert b"".join(_.read_bytes() for _ in parts) == b"".join(LINES)
+    for part in parts:
+        data = part.read_bytes()
+        assert data.endswith(b"\n")
+        assert data.count(b"\n") <= limits.get("max_lines", len(LINES))
+        # only a line larger than max_bytes exceeds it, on its own
+        assert len(data) <= limits.get("max_bytes", len(data)) or data.count(b"\n") == 1
+
+    # the same parts, however the data is chunked
+    data = b"".join(LINES)
+    for size in [1, 13, 1000, len(data)]:
+        (tmp_path / str(size)).mkdir()
+        emitters = prep.Emitters(tmp_path / str(size), **limits)
+        for offset in range(0, len(data), size):
+            emitters.write("Observation", data[offset : offset + size])
+        emitters.write("Patient", b'{"resourceType": "Patient", "id": "1"}\n')
+        emitters.close()
+        assert run_prep.outputs(tmp_path / str(size)) == expected
+
+
+@pytest.mark.parametrize("lines", [0, 1, 13, 50, 99])
+def test_adopt_parts(tmp_path, run_prep, lines):
+    """Resume the output part way, as after a checkpoint, and get the same parts."""
+    (tmp_path / "expected").mkdir()
+    emitters = prep.Emitters(tmp_path / "expected", max_bytes=200, max_lines=7)
+    for line in LINES:
+        emitters.write("Observation", line)
+    emitters.close()
+
+    (tmp_path / "output").mkdir()
+    emitters = prep.Emitters(tmp_path / "output", max_bytes=200, max_lines=7)
+    for line in LINES:
+        emitters.write("Observation", line)
+    emitters.close()
+    length = sum(len(_) for _ in LINES[:lines])
+    emitters = prep.Emitters(tmp_path / "output", max_bytes=200, max_lines=7)
+    emitters.adopt("Observation", output_parts(tmp_path / "output", "Observation"), length)
+    assert emitters.sizes["Observation"] == length
+    if lines <= 1:
+        assert run_prep.outputs(tmp_path / "output") == {"Observation.ndjson": b"".join(LINES[:lines])}
+    for line in LINES[lines:]:
+        emitters.write("Observation", line)
+    emitters.close()
+    assert run_prep.outputs(tmp_path / "output") == run_prep.outputs(tmp_path / "expected")
+    parts = output_parts(tmp_path / "output", "Observation")
+    assert b"".join(read_range(parts, 100, 1000)) == b"".join(LINES)[100:1100]
+
+
+def test_prep_split(meta_path, tmp_path, run_prep):
+    expected = run_prep(meta_path, tmp_path / "expected", "--transformers", TRANSFORMERS)
+    run_prep(meta_path, tmp_path / "split", "--transformers", TRANSFORMERS, "--max-file-lines", "10")
+    for name, data in expected.items():
+        parts = output_parts(tmp_path / "split", parse_part_name(name)[0])
+        assert b"".join(_.read_bytes() for _ in parts) == data
+        assert all(_.read_bytes().count(b"\n") <= 10 for _ in parts)
+    assert len(output_parts(tmp_path / "split", "Observation")) > 1
+
+    # a later run that is not split removes the parts
+    assert run_prep(meta_path, tmp_path / "split", "--transformers", TRANSFORMERS) == expected
@@ -0,0 +1,66 @@
+import pytest
+
+from fhir_aggregator_submission import pipeline, prep
+from fhir_aggregator_submission.ndjson import LineReader
+from fhir_aggregator_submission.pipeline import PipelinedEmitters, PipelineStats, ThreadedReader
+
+TRANSFORMERS = "assay,r4,part-of,vocabulary,validate"
+
+
+@pytest.fixture
+def small_batches(monkeypatch):
+    """Exercise the batching and backpressure with tiny batches and queues."""
+    monkeypatch.setattr(pipeline, "READ_BATCH_BYTES", 100)
+    monkeypatch.setattr(pipeline, "WRITE_BATCH_BYTES", 100)
+    monkeypatch.setattr(pipeline, "QUEUE_DEPTH", 2)
+
+
+def test_threaded_reader(tmp_path, small_batches):
+    path = tmp_path / "lines.ndjson"
+    lines = [f'{{"line": {i}}}\n'.encode() for i in range(1000)]
+    path.write_bytes(b"".join(lines))
+    stats = PipelineStats()
+    reader = ThreadedReader(LineReader(path), stats)
+    read = []
+    for line in reader:
+        read.append(line)
+        # the position is that of the lines consumed, not those read ahead by the thread
+        assert reader.position == sum(len(_) for _ in read)
+    assert read == lines
+
+    # start part way, stop early
+    reader = ThreadedReader(LineReader(path, len(lines[0])), stats)
+    assert next(iter(reader)) == lines[1]
+
+
+def test_threaded_reader_error(tmp_path):
+    reader = ThreadedReader(LineReader(tmp_path / "missing.ndjson"), PipelineStats())
+    with pytest.raises(FileNotFoundError):
+        list(reader)
+
+
+def test_pipelined_emitters(tmp_path, small_batches):
+    emitters = PipelinedEmitters(prep.Emitters(tmp_path), PipelineStats())
+    expected = b""
+    for i in range(100):
+        resource = {"resourceType": "Patient", "id": str(i)}
+        emitters.emit(resource)
+        expected += prep.orjson.dumps(resource) + b"\n"
+    assert emitters.sizes == {"Patient": len(expected)}
+    emitters.flush()
+    assert (tmp_path / "Patient.ndjson").read_bytes() == expected
+    emitters.close()
+
+
+def test_prep_pipeline(meta_path, run_prep, small_batches):
+    run_prep.compare(meta_path, ["--pipeline"], "--transformers", TRANSFORMERS)
+
+
+def test_pipeline_report():
+    stats = PipelineStats()
+    stats.started -= 10
+    stats.running["read"] = 5
+    stats.waiting["read"] = 4
+    stats.running["write"] = 10
+    stats.waiting["transform"] = 8
+    assert stats.report() == "Pipeline utilisation: read 10%, transform 20%, write 100% (I/O bound)"
@@ -0,0 +1,101 @@
+import orjson
+import pytest
+from click.testing import CliRunner
+
+from fhir_aggregator_submission import prep
+from fhir_aggregator_submission.plan import TransformerPlan
+
+
+def generic_loop(resource, transformer_map, **kwargs):
+    """The transformer loop prep ran before plans were compiled."""
+    for transformer in transformer_map.values():
+        resource = transformer(resource=resource, **kwargs)
+    return resource
+
+
+def fixture_resources(research_study, patients, conditions, document_references):
+    part_of = {
+        "url": "http://fhir-aggregator.org/fhir/StructureDefinition/part-of-study",
+        "valueReference": {"reference": f"ResearchStudy/{research_study['id']}"},
+    }
+    research_study = {**research_study, "status": "active", "extension": [part_of]}
+    # part-of adds the study to the conditions
+    conditions = [{k: v for k, v in _.items() if k != "extension"} for _ in conditions]
+    # the generic loop can't handle r4 dropping documents attached to a specimen
+    document_references = [_ for _ in document_references if "Specimen" not in _["subject"]["reference"]]
+    return [research_study] + patients + conditions + document_references
+
+
+def test_plan_matches_generic_loop(research_study, patients, conditions, document_references):
+    resources = fixture_resources(research_study, patients, conditions, document_references)
+    kwargs = dict(research_study_id=research_study["id"], fhir_version="R4", seed="seed")
+    transformer_map = prep.get_transformer_map(["r4", "part-of", "reseed", "vocabulary"])
+    plan = TransformerPlan(transformer_map, **kwargs)
+    for resource in resources:
+        expected = generic_loop(orjson.loads(orjson.dumps(resource)), transformer_map, **kwargs)
+        assert plan(orjson.loads(orjson.dumps(resource))) == expected
+    prep.reset_collectors()
+
+
+def test_plan_skips_noop_stages(research_study_id):
+    transformer_map = prep.get_transformer_map(["r4", "part-of", "validate"])
+    plan = TransformerPlan(transformer_map, research_study_id=research_study_id, fhir_version="R4", seed=None)
+    assert plan.explain(["Patient", "ResearchStudy", "DocumentReference"]).splitlines() == [
+        "Patient: part-of -> validate",
+        "ResearchStudy: r4 (transform_researchstudy) -> validate",
+        "DocumentReference: part-of -> r4 (transform_documentreference) -> validate",
+    ]
+    assert TransformerPlan({}).explain(["Patient"]) == "Patient: (passthrough)"
+
+
+def test_plan_stops_when_resource_dropped(research_study_id):
+    transformer_map = prep.get_transformer_map(["r4", "part-of", "validate"])
+    plan = TransformerPlan(transformer_map, research_study_id=research_study_id, fhir_version="R4", seed=None)
+    document_reference = {"resourceType": "DocumentReference", "subject": {"reference": "Specimen/1"}}
+    assert plan(document_reference) is None
+
+
+def test_plan_unchanged(research_study, patients, conditions, document_references):
+    """A resource the plan says is unchanged comes out of the pipeline as it went in."""
+    resources = fixture_resources(research_study, patients, conditions, document_references)
+    kwargs = dict(research_study_id=research_study["id"], fhir_version="R4", seed="seed")
+    for transformers in [["part-of"], ["r4", "part-of", "vocabulary"], ["part-of", "reseed"], []]:
+        plan = TransformerPlan(prep.get_transformer_map(transformers), **kwargs)
+        unchanged = 0
+        for resource in resources:
+            if plan.unchanged(resource):
+                unchanged += 1
+                assert plan(orjson.loads(orjson.dumps(resource))) == resource
+        if "reseed" in transformers:
+            assert unchanged == 0
+        elif not transformers:
+            assert unchanged == len(resources)
+        else:
+            # the study and the patients already have the part-of extension, the conditions don't
+            assert 0 < unchanged < len(resources)
+        prep.reset_collectors()
+
+
+def test_prep_passthrough(meta_path, tmp_path):
+    """Unchanged resources are written as their input line."""
+    patients = (meta_path / "Patient.ndjson").read_bytes().splitlines()
+    patients[0] = orjson.dumps(orjson.loads(patients[0]), option=orjson.OPT_INDENT_2).replace(b"\n", b"")
+    (meta_path / "Patient.ndjson").write_bytes(b"\r\n".join(patients) + b"\r\n")
+    result = CliRunner().invoke(prep.cli, ["prep", str(meta_path), str(tmp_path / "output"), "--transformers", "part-of,validate"])
+    assert result.exit_code == 0, result.output
+    assert (tmp_path / "output" / "Patient.ndjson").read_bytes() == b"".join(_ + b"\n" for _ in patients)
+
+
+@pytest.mark.parametrize("transformers", [["r4", "part-of", "vocabulary"], ["r4", "part-of", "vocabulary", "validate"]])
+def test_plan_matches_generic_loop_collectors(research_study, patients, conditions, document_references, transformers):
+    """The compiled plan returns the same resources as the generic loop, and collects the same vocabulary and references."""
+    resources = fixture_resources(research_study, patients, conditions, document_references)
+    kwargs = dict(research_study_id=research_study["id"], fhir_version="R4", seed=None)
+    transformer_map = prep.get_transformer_map(transformers)
+    collected = []
+    for run in [lambda resource: generic_loop(resource, transformer_map, **kwargs), TransformerPlan(transformer_map, **kwargs)]:
+        prep.reset_collectors()
+        outputs = [run(orjson.loads(orjson.dumps(_))) for _ in resources]
+        collected.append((outputs, prep.VOCABULARY_COLLECTOR.research_study_vocabularies, prep.REFERENCE_INDEX.ids.to_array().tolist()))
+    assert collected[0] == collected[1]
+    prep.reset_collectors()
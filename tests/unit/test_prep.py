@@ -1,4 +1,5 @@
 import pathlib
+import uuid
 
 import pytest
 
@@ -6,6 +7,7 @@ from click.testing import CliRunner
 from orjson import orjson
 
 from fhir_aggregator_submission import prep
+from fhir_aggregator_submission.synth import Cardinalities, Study
 
 
 @pytest.fixture
@@ -30,3 +32,83 @@ def test_tcga(tcga_path, tmp_path):
                     vocabulary_observations.append(observation)
         assert len(vocabulary_observations) == 2
         assert sum([len(_['component']) for _ in vocabulary_observations]) == 232
+
+
+def test_create_assays_streaming(meta_path):
+    resources = list(prep.create_assays("R4", meta_path))
+    assert [_["resourceType"] for _ in resources] == [
+        "ServiceRequest",
+        "ServiceRequest",
+        "DocumentReference",
+        "DocumentReference",
+        "DocumentReference",
+        "Group",
+    ]
+    documents = [_ for _ in resources if _["resourceType"] == "DocumentReference"]
+    assert [_["subject"]["reference"].split("/")[0] for _ in documents] == ["Patient", "Patient", "Group"]
+    # a tiny memory budget spills the specimen and group indexes to sqlite
+    spilled = list(prep.create_assays("R4", meta_path, memory_budget=1))
+    assert spilled == resources
+
+
+def baseline_create_assays(fhir_version, input_path):
+    """create_assays as it was before streaming, loading every input in memory: the oracle of the streaming version."""
+    with open(pathlib.Path(input_path) / "DocumentReference.ndjson", "r") as doc_file:
+        document_references = [orjson.loads(line.strip()) for line in doc_file]
+    group_file_path = pathlib.Path(input_path) / "Group.ndjson"
+    groups = []
+    if group_file_path.exists():
+        with open(group_file_path, "r") as group_file:
+            groups = [orjson.loads(line.strip()) for line in group_file]
+    with open(pathlib.Path(input_path) / "Specimen.ndjson", "r") as specimen_file:
+        specimens = {spec["id"]: spec for spec in (orjson.loads(line.strip()) for line in specimen_file)}
+
+    document_references_by_group = {}
+    for doc in document_references:
+        document_references_by_group.setdefault(doc["subject"]["reference"].split("/")[1], []).append(doc)
+
+    assays = []
+    if groups:
+        groups_with_specimen = set()
+        for group in groups:
+            patient_reference = None
+            specimen_references = []
+            for member in group.get("member", []):
+                if "reference" in member["entity"] and member["entity"]["reference"].startswith("Specimen/"):
+                    specimen_id = member["entity"]["reference"].split("/")[1]
+                    specimen_references.append(member["entity"]["reference"])
+                    if specimen_id in specimens:
+                        patient_reference = specimens[specimen_id]["subject"]["reference"]
+            if not patient_reference or not specimen_references:
+                continue
+            groups_with_specimen.add(group["id"])
+            assay_dict = prep.create_assay_refactor_docs(group["id"], patient_reference, specimen_references, document_references_by_group.get(group["id"], []), prep.extract_researchstudy_id(group), fhir_version)
+            assay_dict["extension"] = group.get("extension", [])
+            assays.append(assay_dict)
+        groups = [group for group in groups if group["id"] not in groups_with_specimen]
+
+    for doc in document_references:
+        research_study_id = prep.extract_researchstudy_id(doc)
+        if not research_study_id:
+            continue
+        if doc["subject"]["reference"].startswith("Specimen/"):
+            specimen_id = doc["subject"]["reference"].split("/")[1]
+            assay_id = str(uuid.uuid5(uuid.NAMESPACE_DNS, doc["id"] + "-assay"))
+            assays.append(prep.create_assay_refactor_docs(assay_id, specimens[specimen_id]["subject"]["reference"], [doc["subject"]["reference"]], [doc], research_study_id, fhir_version))
+    yield from assays
+    yield from document_references
+    yield from groups
+
+
+@pytest.mark.parametrize("document_subject", ["group", "specimen"])
+def test_create_assays_matches_baseline(meta_path, tmp_path, document_subject):
+    study = Study("S", 5, Cardinalities(specimens_per_patient=2, documents_per_specimen=2, observations_per_patient=0, document_subject=document_subject))
+    study.write(tmp_path / "synth")
+    for input_path in [meta_path, tmp_path / "synth"]:
+        expected = [orjson.dumps(_) for _ in baseline_create_assays("R4", input_path)]
+        assert any(_.startswith(b'{"resourceType":"ServiceRequest"') for _ in expected)
+        for memory_budget in [prep.DEFAULT_MEMORY_BUDGET, 1]:
+            assert [orjson.dumps(_) for _ in prep.create_assays("R4", input_path, memory_budget=memory_budget)] == expected
+    # the synthetic study takes the group-subject or the specimen-subject path
+    documents = [orjson.loads(_) for _ in (tmp_path / "synth" / "DocumentReference.ndjson").read_bytes().splitlines()]
+    assert {_["subject"]["reference"].split("/")[0] for _ in documents} == {document_subject.capitalize()}
@@ -0,0 +1,117 @@
+import pathlib
+
+import numpy as np
+import orjson
+import pytest
+from click.testing import CliRunner
+
+from fhir_aggregator_submission import prep, references
+from fhir_aggregator_submission.references import (
+    ID_DTYPE,
+    INDEX_NAME,
+    HashLog,
+    ReferenceIndex,
+    find_references,
+    hash_strings,
+    reference_hash,
+)
+
+
+def test_hash_strings():
+    values = ["Patient/1", "Specimen/ü", "", "Observation/" + "x" * 300]
+    assert hash_strings(values).tolist() == [reference_hash(_) for _ in values]
+    assert len(set(hash_strings([f"Patient/{i}" for i in range(10000)]).tolist())) == 10000
+
+
+def test_find_references():
+    resource = {
+        "resourceType": "MedicationAdministration",
+        "subject": {"reference": "Patient/1"},
+        "medication": {"reference": {"reference": "Medication/1"}},
+        "extension": [{"url": "x", "valueReference": {"reference": "ResearchStudy/1"}}],
+        "partOf": [{"reference": "Procedure/1"}, {"reference": "Procedure/2"}],
+    }
+    assert sorted(find_references(resource)) == [
+        ("extension.valueReference.reference", "ResearchStudy/1"),
+        ("medication.reference.reference", "Medication/1"),
+        ("partOf.reference", "Procedure/1"),
+        ("partOf.reference", "Procedure/2"),
+        ("subject.reference", "Patient/1"),
+    ]
+    with pytest.raises(ValueError):
+        find_references({"subject": {"reference": 1}})
+
+
+def test_hash_log_spills(tmp_path, monkeypatch):
+    monkeypatch.setattr(references, "HASH_BATCH", 100)
+    log = HashLog(ID_DTYPE, memory_budget=8 * 250, directory=tmp_path)
+    values = [f"Patient/{i}" for i in range(1000)]
+    for value in values:
+        log.add(value)
+    log.extend(hash_strings(values[:10]))
+    assert log.spilled
+    assert len(log) == 1010
+    expected = np.concatenate([hash_strings(values), hash_strings(values[:10])])
+    assert (log.to_array() == expected).all()
+    assert (log.to_array(990, 1005) == expected[990:1005]).all()
+    # spilled in batches of 100 once past 250 entries, the rest is in memory
+    assert [len(_) for _ in log.chunks(size=300)] == [300, 300, 300, 110]
+    assert [len(_) for _ in log.chunks(850, size=100)] == [50, 100, 10]
+    log.close()
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_dangling(tmp_path):
+    index = ReferenceIndex(memory_budget=100, directory=tmp_path)
+    index.add_resource({"resourceType": "Patient", "id": "1"})
+    for i in range(20):
+        index.add_resource(
+            {
+                "resourceType": "Observation",
+                "id": str(i),
+                "subject": {"reference": f"Patient/{i % 2}"},
+                "focus": [{"reference": "Patient/1"}],
+            }
+        )
+    dangling = index.dangling()
+    assert len(dangling) == 10
+    assert {tuple(index.sources[_]) for _ in dangling["source"].tolist()} == {("Observation", "subject.reference")}
+    assert index.report(dangling) == "references not found: 10\n  Observation subject.reference: 10"
+
+
+def test_validate_references_report(meta_path, tmp_path):
+    lines = (meta_path / "Observation.ndjson").read_bytes().splitlines()
+    for i in (3, 7):
+        observation = orjson.loads(lines[i])
+        observation["subject"] = {"reference": f"Patient/missing-{i}"}
+        lines[i] = orjson.dumps(observation)
+    (meta_path / "Observation.ndjson").write_bytes(b"\n".join(lines) + b"\n")
+
+    output_path = tmp_path / "output"
+    result = CliRunner().invoke(prep.cli, ["prep", str(meta_path), str(output_path)])
+    assert result.exit_code == 1
+    assert "references not found: 2\n  Observation subject.reference: 2 e.g. Patient/missing-3, Patient/missing-7" in result.output
+    assert pathlib.Path(output_path / "Observation.ndjson").exists()
+
+
+def test_reference_index(meta_path, tmp_path):
+    """References may resolve to the ids of a study prepped earlier."""
+    shared = tmp_path / "R4" / "shared"
+    result = CliRunner().invoke(prep.cli, ["prep", str(meta_path), str(shared)])
+    assert result.exit_code == 0, result.output
+    index = np.load(shared / INDEX_NAME, mmap_mode="r")
+    ids = [f"{_['resourceType']}/{_['id']}" for path in shared.glob("*.ndjson") for _ in map(orjson.loads, path.read_bytes().splitlines())]
+    assert index.tolist() == sorted(set(hash_strings(ids).tolist()))
+
+    # a study whose Patients were prepped in the shared one
+    (meta_path / "Patient.ndjson").unlink()
+    study = tmp_path / "R4" / "study"
+    result = CliRunner().invoke(prep.cli, ["prep", str(meta_path), str(study)])
+    assert result.exit_code == 1
+    assert " subject.reference: " in result.output
+    assert not (study / INDEX_NAME).exists()
+
+    for reference_index in [shared / INDEX_NAME, tmp_path / "R4"]:
+        result = CliRunner().invoke(prep.cli, ["prep", str(meta_path), str(study), "--reference-index", str(reference_index)])
+        assert result.exit_code == 0, result.output
+        assert (study / INDEX_NAME).exists()
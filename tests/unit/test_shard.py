@@ -0,0 +1,71 @@
+import pathlib
+import subprocess
+import sys
+
+import orjson
+
+from fhir_aggregator_submission import shard
+from fhir_aggregator_submission.incremental import plan_units
+
+# without validation, so the resources of a skipped unit are not missed
+TRANSFORMERS = "part-of,vocabulary"
+
+
+def test_line_aligned_offsets(meta_path):
+    path = meta_path / "Observation.ndjson"
+    offsets = shard.line_aligned_offsets(path, 1000)
+    assert len(offsets) > 3
+    assert offsets[0] == 0 and offsets[-1] == path.stat().st_size
+    lines = []
+    for start, end in zip(offsets, offsets[1:]):
+        lines.extend(shard.read_lines(shard.Shard(0, str(path), start, end)))
+    assert b"".join(lines) == path.read_bytes()
+
+
+def test_plan_shards_numbered_in_input_order(meta_path):
+    paths = sorted(meta_path.glob("*.ndjson"))
+    shards = shard.plan_shards(paths, workers=2, first_number=1, shard_bytes=1000)
+    assert [_.number for _ in shards] == list(range(1, len(shards) + 1))
+    assert [_.path for _ in shards] == sorted([_.path for _ in shards], key=lambda p: paths.index(pathlib.Path(p)))
+
+
+def test_sharded_prep_is_byte_identical(meta_path, tmp_path, monkeypatch, run_prep):
+    # force small shards, planning happens in the parent process
+    monkeypatch.setattr(shard, "MIN_SHARD_BYTES", 1000)
+    outputs = run_prep.compare(meta_path, ["--workers", "3"])
+    assert not list((tmp_path / "output").glob(".prep-shards-*")), "work directory should be removed"
+    assert outputs.keys() == {
+        "DocumentReference.ndjson",
+        "Group.ndjson",
+        "Observation.ndjson",
+        "Patient.ndjson",
+        "ResearchStudy.ndjson",
+        "ServiceRequest.ndjson",
+        "Specimen.ndjson",
+    }
+
+
+def test_sharded_prep_as_main_module(meta_path, tmp_path, run_prep):
+    """`python -m fhir_aggregator_submission.prep` collects into the same prep module as its shards."""
+    serial = run_prep(meta_path, tmp_path / "serial")
+    sharded = tmp_path / "sharded"
+    result = subprocess.run([sys.executable, "-m", "fhir_aggregator_submission.prep", "prep", str(meta_path), str(sharded), "--workers", "3"], capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
+    assert run_prep.outputs(sharded) == serial
+
+
+def test_skipped_units_are_not_sent_to_workers(meta_path, tmp_path, run_prep):
+    """A unit whose type a reused unit emitted is skipped, as in a single process run, without being sent to a worker."""
+    units = plan_units(meta_path, TRANSFORMERS.split(","))
+    first, later = units[0].name, units[1].name
+    # the first unit's file also holds a resource of the later unit's type
+    resource = orjson.loads((meta_path / f"{later}.ndjson").read_bytes().splitlines()[0])
+    with open(meta_path / f"{first}.ndjson", "ab") as f:
+        f.write(orjson.dumps({**resource, "id": f"{resource['id']}-mixed"}) + b"\n")
+    serial = run_prep(meta_path, tmp_path / "serial", "--transformers", TRANSFORMERS)
+    output_path = tmp_path / "sharded"
+    run_prep(meta_path, output_path, "--transformers", TRANSFORMERS, "--incremental")
+    # the later unit was skipped, so it is not reusable, the first one is
+    assert run_prep(meta_path, output_path, "--transformers", TRANSFORMERS, "--incremental", "--workers", "2", "--trace", str(tmp_path / "trace.json")) == serial
+    shards = [_["name"] for _ in orjson.loads((tmp_path / "trace.json").read_bytes())["traceEvents"] if _.get("cat") == "shard"]
+    assert not [_ for _ in shards if _.startswith(later)]
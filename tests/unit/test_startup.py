@@ -0,0 +1,36 @@
+import subprocess
+import sys
+
+# Run the CLI in a fresh interpreter and print the modules it loaded.
+CODE = """
+import sys
+from fhir_aggregator_submission.prep import cli
+try:
+    cli(sys.argv[1:])
+except SystemExit:
+    pass
+print(" ".join(sys.modules))
+"""
+
+
+def loaded_modules(*args) -> set[str]:
+    result = subprocess.run([sys.executable, "-c", CODE, *args], capture_output=True, text=True, check=True)
+    return set(result.stdout.splitlines()[-1].split())
+
+
+def test_help_does_not_load_models():
+    modules = loaded_modules("--help")
+    assert not {_ for _ in modules if _.startswith(("fhir.resources", "pydantic"))}
+
+
+def test_models_loaded_per_resource_type(meta_path, tmp_path):
+    modules = loaded_modules("prep", str(meta_path), str(tmp_path / "part-of"), "--transformers", "part-of")
+    assert not {_ for _ in modules if _.startswith("fhir.resources")}
+    assert "fhir_aggregator_submission.synth" not in modules
+
+    args = ["--transformers", "part-of,validate", "--fhir-version", "R4"]
+    modules = loaded_modules("prep", str(meta_path), str(tmp_path / "validate"), *args)
+    assert {"fhir.resources.R4B.patient", "fhir.resources.R4B.observation"} <= modules
+    # only the models of the types in the study
+    assert "fhir.resources.R4B.medicationadministration" not in modules
+    assert "fhir.resources.observation" not in modules
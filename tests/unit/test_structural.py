@@ -0,0 +1,123 @@
+import copy
+import pickle
+import re
+
+import pytest
+
+from fhir_aggregator_submission import models, structural
+from fhir_aggregator_submission.structural import StructuralSampler, load
+from fhir_aggregator_submission.synth import Cardinalities, Study
+
+BAD_VALUES = [None, "", " ", 0, -1, 1.5, True, 2**40, "x y", "abc", "2020-02-30", "2020-01-31T10:00:00", "10:00:60", "YQ=", "Patient 1", [], {}, [None], {"x": 1}]
+
+
+def study_resources() -> list[dict]:
+    study = Study("S", 1, Cardinalities(specimens_per_patient=1, documents_per_specimen=1, observations_per_patient=1))
+    return [resource for resource_type in study.counts() for resource in study.resources(resource_type)]
+
+
+def paths(value, path=()):
+    yield path
+    items = value.items() if isinstance(value, dict) else enumerate(value) if isinstance(value, list) else []
+    for key, item in items:
+        yield from paths(item, (*path, key))
+
+
+def replaced(resource: dict, path: tuple, value) -> dict:
+    resource = copy.deepcopy(resource)
+    parent = resource
+    for key in path[:-1]:
+        parent = parent[key]
+    if value is KeyError:
+        del parent[path[-1]]
+    else:
+        parent[path[-1]] = value
+    return resource
+
+
+def mutations(resource: dict):
+    """The resource with each of its values replaced, removed, wrapped in a list, and extra keys."""
+    for path in list(paths(resource))[1:]:
+        for value in BAD_VALUES:
+            yield replaced(resource, path, value)
+        yield replaced(resource, path, KeyError)
+        value = resource
+        for key in path:
+            value = value[key]
+        yield replaced(resource, path, [value])
+        if isinstance(value, list) and value:
+            yield replaced(resource, path, value[0])
+        if isinstance(value, dict):
+            for key in ["valueString", "valueBoolean", "reference", "resourceType", "_value", "unknown"]:
+                yield replaced(resource, (*path, key), "x")
+    for key in ["valueString", "effectiveDateTime", "_status", "contained", "unknown"]:
+        yield {**resource, key: "2020"}
+
+
+def test_valid_resources_pass():
+    for resource in study_resources():
+        assert load("R5", resource["resourceType"])(resource), resource
+
+
+def test_never_passes_what_validation_fails(research_study, patients, document_references):
+    """Whenever a validator passes a resource, so does full validation."""
+    resources = {"R5": study_resources(), "R4": [research_study, *patients, *document_references]}
+    for fhir_version, version_resources in resources.items():
+        passed = 0
+        for resource in version_resources:
+            validator = load(fhir_version, resource["resourceType"])
+            klass = models.model_class(fhir_version, resource["resourceType"])
+            for mutation in mutations(resource):
+                if validator(mutation):
+                    passed += 1
+                    klass.model_validate(mutation)
+        assert passed > 100
+
+
+def test_validator():
+    validate = load("R5", "Observation")
+    observation = {"resourceType": "Observation", "id": "o1", "status": "final", "code": {"text": "x"}, "subject": {"reference": "Patient/1"}, "effectiveDateTime": "2020-01-31T10:00:00Z", "valueQuantity": {"value": 1.5}}
+    assert validate(observation)
+    for key, value in [("status", None), ("code", None), ("id", None), ("resourceType", "Patient"), ("unknown", 1), ("_status", {"extension": []}), ("contained", [{"resourceType": "Patient", "id": "p"}]), ("category", {"text": "x"}), ("subject", {"reference": "Patient 1"}), ("effectiveDateTime", "2020-02-30"), ("valueString", "x"), ("status", "a  b")]:
+        assert not validate({**observation, key: value}), (key, value)
+    assert not load("R5", "NotAResource")(observation)
+    assert not load("R5", "../Observation")(observation)
+
+
+def test_generated_in_memory(validation_cache_directory, monkeypatch):
+    validate = load("R4", "Patient")
+    # nothing is written to, or read back from, the cache directory
+    assert not [_ for _ in validation_cache_directory.rglob("*") if _.suffix == ".py"]
+
+    # a validator is generated once per process
+    monkeypatch.setattr(structural, "Generator", None)
+    patient = {"resourceType": "Patient", "id": "p1", "gender": "female"}
+    assert validate(patient) and load("R4", "Patient") is validate
+    load.cache_clear()
+    with pytest.raises(TypeError):
+        load("R4", "Patient")
+
+
+def test_structural_sampler():
+    sampler = StructuralSampler("R5", sample_rate=0)
+    resources = study_resources()
+    assert all(sampler.check(_) for _ in resources)
+    assert not sampler.check({**resources[0], "unknown": 1})
+    assert (sampler.full, sampler.structural) == (1, len(resources))
+    assert sampler.report() == f"Validated 1 resources in full, {len(resources)} structurally"
+
+    sampler = StructuralSampler("R5", sample_rate=1)
+    assert not any(sampler.check(_) for _ in resources)
+
+    # a worker process generates the validators itself
+    worker = pickle.loads(pickle.dumps(sampler))
+    assert (worker.fhir_version, worker.sample_rate, worker.full) == ("R5", 1, 0)
+
+
+def test_prep_structural(meta_path, run_prep):
+    outputs = run_prep.compare(meta_path, ["--validate-mode", "structural"])
+    match = re.search(r"Validated (\d+) resources in full, (\d+) structurally", run_prep.result.output)
+    assert match, run_prep.result.output
+    full, structural_count = int(match[1]), int(match[2])
+    assert full + structural_count == sum(_.count(b"\n") for _ in outputs.values())
+    assert structural_count > full
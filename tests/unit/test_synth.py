@@ -0,0 +1,64 @@
+import uuid
+
+import orjson
+from click.testing import CliRunner
+from nested_lookup import nested_lookup
+
+from fhir_aggregator_submission import prep
+from fhir_aggregator_submission.synth import Cardinalities, Study, resource_id
+
+
+def read(path) -> dict[str, list[dict]]:
+    return {_.stem: [orjson.loads(line) for line in _.read_bytes().splitlines()] for _ in sorted(path.glob("*.ndjson"))}
+
+
+def test_resource_id():
+    assert resource_id("S", "Patient", 7) == str(uuid.uuid5(uuid.NAMESPACE_URL, "S/Patient/7"))
+
+
+def test_synth_study(tmp_path):
+    cardinalities = Cardinalities(specimens_per_patient=3, documents_per_specimen=2, observations_per_patient=5, codes=4)
+    study = Study("S", 10, cardinalities, seed=1)
+    counts = study.write(tmp_path / "a")
+    assert counts == {"ResearchStudy": 1, "Patient": 10, "Specimen": 30, "Group": 30, "DocumentReference": 60, "Observation": 50}
+    assert sum(counts.values()) == 1 + 10 * cardinalities.per_patient()
+    resources = read(tmp_path / "a")
+    assert {k: len(v) for k, v in resources.items()} == counts
+
+    # every reference resolves
+    ids = {f"{_['resourceType']}/{_['id']}" for type_resources in resources.values() for _ in type_resources}
+    references = {_ for type_resources in resources.values() for resource in type_resources for _ in nested_lookup("reference", resource)}
+    assert references <= ids
+    assert len({_["code"]["coding"][0]["code"] for _ in resources["Observation"]}) <= 4
+
+    # the same seed writes the same files, another seed other values for the same ids
+    study.write(tmp_path / "b")
+    Study("S", 10, cardinalities, seed=2).write(tmp_path / "c")
+    for path in (tmp_path / "a").glob("*.ndjson"):
+        assert path.read_bytes() == (tmp_path / "b" / path.name).read_bytes()
+    assert resources["Observation"] != read(tmp_path / "c")["Observation"]
+    assert [_["id"] for _ in resources["Observation"]] == [_["id"] for _ in read(tmp_path / "c")["Observation"]]
+
+
+def test_synth_prep(tmp_path):
+    runner = CliRunner()
+    for document_subject in ["group", "specimen"]:
+        input_path = tmp_path / document_subject / "META"
+        output_path = tmp_path / document_subject / "output"
+        result = runner.invoke(prep.cli, ["synth", str(input_path), "--resources", "500", "--document-subject", document_subject])
+        assert result.exit_code == 0, result.output
+        counts = {_.stem: len(_.read_bytes().splitlines()) for _ in input_path.glob("*.ndjson")}
+        assert 450 < sum(counts.values()) <= 500
+        assert ("Group" in counts) == (document_subject == "group")
+
+        result = runner.invoke(prep.cli, ["prep", str(input_path), str(output_path)])
+        assert result.exit_code == 0, result.output
+        # an assay per Group, or per DocumentReference about a Specimen
+        assays = counts["Group"] if document_subject == "group" else counts["DocumentReference"]
+        assert len((output_path / "ServiceRequest.ndjson").read_bytes().splitlines()) == assays
+
+
+def test_synth_defaults():
+    """The synth command's defaults are those of Cardinalities, prep doesn't import synth to read them."""
+    defaults = {_.name: _.default for _ in prep.synth.params}
+    assert {k: defaults[k] for k in Cardinalities._fields} == Cardinalities()._asdict()
@@ -0,0 +1,36 @@
+import pickle
+
+import orjson
+
+from fhir_aggregator_submission.trace import Tracer
+
+
+def test_batches():
+    tracer = Tracer()
+    assert list(tracer.batches("transform Observation", range(5), seconds=0)) == list(range(5))
+    assert [_["args"]["resources"] for _ in tracer.events] == [1] * 5
+    tracer = Tracer()
+    assert list(tracer.batches("transform Observation", range(5), seconds=60)) == list(range(5))
+    assert [_["args"]["resources"] for _ in tracer.events] == [5]
+    with tracer.span("validate_references", "validate", files=2):
+        pass
+    event = tracer.events[-1]
+    assert (event["ph"], event["cat"], event["args"]) == ("X", "validate", {"files": 2})
+    assert event["dur"] >= 0
+
+    # a worker records its own events
+    assert pickle.loads(pickle.dumps(tracer)).events == []
+
+
+def test_prep_trace(meta_path, tmp_path, run_prep):
+    trace_path = tmp_path / "trace.json"
+    run_prep(meta_path, tmp_path / "output", "--trace", str(trace_path))
+    events = orjson.loads(trace_path.read_bytes())["traceEvents"]
+    spans = [_ for _ in events if _["ph"] == "X"]
+    assert all(_["ts"] >= 0 and _["dur"] >= 0 for _ in spans)
+    categories = {_["cat"] for _ in spans}
+    assert {"assay", "transform", "vocabulary", "validate"} <= categories
+    assert not {"shard", "merge"} & categories
+    assert {_["args"]["name"] for _ in events if _["ph"] == "M"} == {"prep"}
+    transformed = sum(_["args"]["resources"] for _ in spans if _["cat"] == "transform" and _["name"] == "transform Observation")
+    assert transformed == (meta_path / "Observation.ndjson").read_bytes().count(b"\n")
@@ -0,0 +1,89 @@
+import pickle
+
+import numpy as np
+
+from fhir_aggregator_submission import models
+from fhir_aggregator_submission.validation_cache import (
+    INDEX_NAME,
+    SEGMENT_GLOB,
+    ValidationCache,
+    merge,
+    resource_key,
+)
+
+
+def test_resource_key():
+    resource = {"resourceType": "Patient", "id": "1", "gender": "male"}
+    assert resource_key(resource) == resource_key({"gender": "male", "id": "1", "resourceType": "Patient"})
+    assert resource_key(resource) != resource_key(dict(resource, gender="female"))
+
+
+def test_cache(tmp_path):
+    cache = ValidationCache("R4", tmp_path)
+    assert cache.directory.parent == tmp_path and cache.directory.name.startswith("R4-fhir.resources-")
+    keys = [resource_key({"resourceType": "Patient", "id": str(i)}) for i in range(10)]
+    assert not any(_ in cache for _ in keys)
+    for key in keys[:5]:
+        cache.add(key)
+    assert all(_ in cache for _ in keys[:5])
+
+    # a worker process reads the cache itself
+    worker = pickle.loads(pickle.dumps(cache))
+    assert keys[0] not in worker
+    cache.flush()
+    worker = pickle.loads(pickle.dumps(cache))
+    assert keys[0] in worker and keys[5] not in worker
+    worker.add(keys[5])
+    worker.flush()
+    assert len(list(cache.directory.glob(SEGMENT_GLOB))) == 2
+
+    cache.compact()
+    assert list(cache.directory.glob(SEGMENT_GLOB)) == []
+    assert sorted(np.load(cache.directory / INDEX_NAME)[0].tolist()) == sorted(keys[:6])
+    assert [_ in cache for _ in keys] == [True] * 6 + [False] * 4
+    # another version of FHIR has its own cache
+    assert keys[0] not in ValidationCache("R5", tmp_path)
+
+
+def test_merge_evicts():
+    now = 1_000_000
+    old = np.array([[1, 2, 3], [now - 100, now - 100, now - 100]], dtype="<u8")
+    new = np.array([[3, 4, 5], [now, now - 10, now - 5]], dtype="<u8")
+    merged = merge([old, new], now)
+    assert merged.tolist() == [[1, 2, 3, 4, 5], [now - 100, now - 100, now, now - 10, now - 5]]
+    assert merge([old, new], now, max_age=50).tolist() == [[3, 4, 5], [now, now - 10, now - 5]]
+    assert merge([old, new], now, max_entries=2).tolist() == [[3, 5], [now, now - 5]]
+
+
+def test_prep_validation_cache(meta_path, tmp_path, monkeypatch, validation_cache_directory, run_prep):
+    validated = []
+    model_validate = models.model_class("R4", "Patient").model_validate.__func__
+
+    def counting_validate(klass, resource, *args, **kwargs):
+        validated.append(resource["resourceType"])
+        return model_validate(klass, resource, *args, **kwargs)
+
+    for name in ["Patient", "Observation"]:
+        monkeypatch.setattr(models.model_class("R4", name), "model_validate", classmethod(counting_validate))
+
+    # the cache is opt-in, a default run validates every resource and writes nothing to it
+    expected = run_prep(meta_path, tmp_path / "default")
+    first = list(validated)
+    assert "Patient" in first and "Observation" in first
+    assert not list(validation_cache_directory.rglob(INDEX_NAME))
+
+    validated.clear()
+    assert run_prep(meta_path, tmp_path / "cached", "--validation-cache") == expected
+    assert validated == first
+    assert list(validation_cache_directory.rglob(INDEX_NAME))
+    # the resources that passed validation are not validated again
+    validated.clear()
+    assert run_prep(meta_path, tmp_path / "reused", "--validation-cache") == expected
+    assert validated == []
+
+    # a resource that changed is validated again
+    lines = (meta_path / "Patient.ndjson").read_bytes().splitlines(keepends=True)
+    (meta_path / "Patient.ndjson").write_bytes(lines[0].replace(b'"id"', b'"active": true, "id"', 1) + b"".join(lines[1:]))
+    validated.clear()
+    run_prep(meta_path, tmp_path / "changed", "--validation-cache")
+    assert validated == ["Patient"]
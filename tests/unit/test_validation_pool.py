@@ -0,0 +1,48 @@
+import numpy as np
+import orjson
+
+from fhir_aggregator_submission import prep
+from fhir_aggregator_submission.references import INDEX_NAME, ReferenceIndex
+from fhir_aggregator_submission.synth import Cardinalities, Study
+from fhir_aggregator_submission.validation_cache import ValidationCache, resource_key
+from fhir_aggregator_submission.validation_pool import ValidationPool
+
+
+def test_pool_collects_like_validate(tmp_path):
+    study = Study("S", 3, Cardinalities(specimens_per_patient=1, documents_per_specimen=1, observations_per_patient=2))
+    resources = [resource for resource_type in study.counts() for resource in study.resources(resource_type)]
+    prep.reset_collectors()
+    cache = ValidationCache("R5", tmp_path)
+    pool = ValidationPool("R5", 2, cache, batch_size=2)
+    try:
+        for resource in resources:
+            assert prep.validate(resource, "R5", validation_pool=pool) is resource
+        pool.drain()
+    finally:
+        pool.close()
+    expected = ReferenceIndex()
+    for resource in resources:
+        expected.add_resource(resource)
+    # in the order they were submitted, whichever worker validated them
+    assert np.array_equal(prep.REFERENCE_INDEX.ids.to_array(), expected.ids.to_array())
+    assert np.array_equal(prep.REFERENCE_INDEX.references.to_array(), expected.references.to_array())
+    assert prep.REFERENCE_INDEX.sources == expected.sources
+    # the parent's cache remembers what the workers validated
+    assert all(resource_key(_) in cache for _ in resources)
+
+
+def test_prep_validate_workers(meta_path, tmp_path, run_prep):
+    run_prep.compare(meta_path, ["--validate-workers", "2"])
+    assert (tmp_path / "output" / INDEX_NAME).read_bytes() == (tmp_path / "expected" / INDEX_NAME).read_bytes()
+
+    run_prep(meta_path, tmp_path / "sharded", "--validate-workers", "2", "--workers", "2", exit_code=1)
+    assert "not with --workers" in run_prep.result.output
+
+
+def test_prep_validate_workers_error(meta_path, tmp_path, run_prep):
+    path = meta_path / "Patient.ndjson"
+    patients = [orjson.loads(_) for _ in path.read_bytes().splitlines()]
+    patients[-1]["birthDate"] = "2020-02-30"
+    path.write_bytes(b"".join(orjson.dumps(_) + b"\n" for _ in patients))
+    run_prep(meta_path, tmp_path / "output", "--validate-workers", "2", exit_code=1)
+    assert "Validation error: R4" in run_prep.result.output and "2020-02-30" in run_prep.result.output
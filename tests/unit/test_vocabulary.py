@@ -158,3 +158,19 @@ def test_vocabulary_collector_document_references(document_references, research_
     paths = [_['path'] for _ in simplified if _['code'] in ['VCF', 'TSV']]
     assert paths == ['DocumentReference.type', 'DocumentReference.type'], "expected paths"
 
+
+
+def test_vocabulary_collector_merge(patients, document_references):
+    resources = patients + document_references
+    single = VocabularyCollector()
+    for resource in resources:
+        single.collect(resource)
+
+    merged = VocabularyCollector()
+    for part in [resources[:1], resources[1:3], resources[3:]]:
+        collector = VocabularyCollector()
+        for resource in part:
+            collector.collect(resource)
+        merged.merge(collector)
+
+    assert json.dumps(merged.to_observations()) == json.dumps(single.to_observations())